@@ -35,7 +35,7 @@ from keras import utils
 from keras import models
 import tensorflow as tf
 
-def identity_block(input_tensor,Dropout, kernel_size, filters, stage, block):
+def identity_block(input_tensor,Dropout, kernel_size, filters, stage, block, Dropout_On = True):
     """The identity block is the block that has no conv layer at shortcut.
 
     # Arguments
@@ -45,6 +45,7 @@ def identity_block(input_tensor,Dropout, kernel_size, filters, stage, block):
         filters: list of integers, the filters of 3 conv layer at main path
         stage: integer, current stage label, used for generating layer names
         block: 'a','b'..., current block label, used for generating layer names
+        Dropout_On: True to apply the dropout also during inference, None to apply it only during training
 
     # Returns
         Output tensor for the block.
@@ -61,7 +62,7 @@ def identity_block(input_tensor,Dropout, kernel_size, filters, stage, block):
                       kernel_initializer='he_normal',
                       name=conv_name_base + '2a')(input_tensor)
     if Dropout is not None:
-        x = layers.Dropout(Dropout, seed = 1)(x, training = True)
+        x = layers.Dropout(Dropout, seed = 1, name = 'drop' + str(stage) + block)(x, training = Dropout_On)
     x = layers.BatchNormalization(axis=bn_axis, name=bn_name_base + '2a')(x)
     x = layers.Activation('relu')(x)
 
@@ -150,6 +151,7 @@ def ResNet50(input_shape,
              #input_shape=None,
              pooling=None,
              classes=1000,
+             Dropout_On=True,
              **kwargs):
     """Instantiates the ResNet50 architecture.
 
@@ -186,6 +188,8 @@ def ResNet50(input_shape,
         classes: optional number of classes to classify images
             into, only to be specified if `include_top` is True, and
             if no `weights` argument is specified.
+        Dropout_On: True to apply the dropout also during inference
+            for Monte Carlo dropout, None to apply it only during training.
 
     # Returns
         A Keras model instance.
@@ -233,24 +237,24 @@ def ResNet50(input_shape,
     x = layers.MaxPooling2D((3, 3), strides=(2, 2))(x)
 
     x = conv_block(x, 3, [64, 64, 256], stage=2, block='a', strides=(1, 1))
-    x = identity_block(x, Dropout, 3, [64, 64, 256], stage=2, block='b')
-    x = identity_block(x,Dropout, 3, [64, 64, 256], stage=2, block='c')
+    x = identity_block(x, Dropout, 3, [64, 64, 256], stage=2, block='b', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [64, 64, 256], stage=2, block='c', Dropout_On=Dropout_On)
 
     x = conv_block(x, 3, [128, 128, 512], stage=3, block='a')
-    x = identity_block(x,Dropout, 3, [128, 128, 512], stage=3, block='b')
-    x = identity_block(x,Dropout, 3, [128, 128, 512], stage=3, block='c')
-    x = identity_block(x,Dropout, 3, [128, 128, 512], stage=3, block='d')
+    x = identity_block(x,Dropout, 3, [128, 128, 512], stage=3, block='b', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [128, 128, 512], stage=3, block='c', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [128, 128, 512], stage=3, block='d', Dropout_On=Dropout_On)
 
     x = conv_block(x, 3, [256, 256, 1024], stage=4, block='a')
-    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='b')
-    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='c')
-    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='d')
-    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='e')
-    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='f')
+    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='b', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='c', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='d', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='e', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [256, 256, 1024], stage=4, block='f', Dropout_On=Dropout_On)
 
     x = conv_block(x, 3, [512, 512, 2048], stage=5, block='a')
-    x = identity_block(x,Dropout, 3, [512, 512, 2048], stage=5, block='b')
-    x = identity_block(x,Dropout, 3, [512, 512, 2048], stage=5, block='c')
+    x = identity_block(x,Dropout, 3, [512, 512, 2048], stage=5, block='b', Dropout_On=Dropout_On)
+    x = identity_block(x,Dropout, 3, [512, 512, 2048], stage=5, block='c', Dropout_On=Dropout_On)
 
     if include_top:
         x = layers.GlobalAveragePooling2D(name='avg_pool')(x)
@@ -14,7 +14,9 @@ class Classification(object):
                     image_size = None,
                     seeds = False,
                     calculate_uncertainty = False,
-                    evaluation = True):
+                    evaluation = True,
+                    normalization_args = None,
+                    **options):
 
         self.use_algorithm = "Classification"
         self.path = path
@@ -26,6 +28,14 @@ class Classification(object):
         self.image_size = image_size
         self.calculate_uncertainty = calculate_uncertainty
         self.evaluation = evaluation
+        if normalization_args is None:
+            self.normalization_args = dict()
+        else:
+            self.normalization_args = normalization_args
+        # Classification resizes the images and uses all Monte Carlo samples
+        set_pipeline_options(self, options, uncertainty_modes = ("mc_dropout", "last_layer"),
+                             ignored_options = ("patch_size", "patches_per_epoch", "tile_size", "tile_overlap", "tile_batchsize",
+                                                "writer_threads", "mc_tolerance"))
         if data_gen_args is None:
             self.data_gen_args = dict()
         else:
@@ -64,7 +74,7 @@ class Classification(object):
         data_path = self.path + '/train'
         train_image_files, val_image_files = training_validation_data_split(data_path)
 
-        steps_per_epoch = int(len(train_image_files)/self.batchsize)
+        steps_per_epoch = int(np.ceil(len(train_image_files)/self.batchsize))
 
         self.epochs = self.iterations_over_dataset
         logging.info("Making: %d steps per Epoch" % steps_per_epoch)
@@ -73,31 +83,52 @@ class Classification(object):
 
 
 
-    def data_generator(self, data_path, Training_Input_shape, num_channels, train_image_files):
+    def data_generator(self, data_path, Training_Input_shape, num_channels, train_image_files, val_image_files):
         '''
         Prepare data in Training and Validation set 
         '''
         assert isinstance(self.num_classes, int), \
             logging.error("Number of classes has not been set. You net to set num_classes!")
-            
-        
-        TrainingDataGenerator = training_data_generator_classification(Training_Input_shape,
+
+        # The labels are imported once and shared by the training and validation generator
+        label_index = load_classification_labels(os.path.join(data_path + '/groundtruth/', 'groundtruth.csv'),
+                                                    os.listdir(data_path + "/image/"))
+
+        TrainingDataGenerator = ClassificationDataSequence(Training_Input_shape,
                                                                            self.batchsize,
                                                                            num_channels,
                                                                            self.num_classes,
                                                                            train_image_files,
                                                                            self.data_gen_args,
                                                                            data_path,
-                                                                           self.use_algorithm)
+                                                                           self.use_algorithm,
+                                                                           normalization_args = self.normalization_args,
+                                                                           label_index = label_index,
+                                                                           decode_threads = self.decode_threads,
+                                                                           prefetch = self.prefetch,
+                                                                           augment_workers = self.augment_workers,
+                                                                           dataset_cache = self.cache_dataset,
+                                                                           augmentation_variants = self.augmentation_variants,
+                                                                           augmentation_refresh = self.augmentation_refresh,
+                                                                           dtype = self.dtype)
 
-        ValidationDataGenerator = training_data_generator_classification(   Training_Input_shape,
+        ValidationDataGenerator = ClassificationDataSequence(   Training_Input_shape,
                                                                             self.batchsize,
                                                                             num_channels,
                                                                             self.num_classes,
-                                                                            train_image_files,
+                                                                            val_image_files,
                                                                             self.data_gen_args,
                                                                             data_path,
-                                                                            self.use_algorithm)
+                                                                            self.use_algorithm,
+                                                                            normalization_args = self.normalization_args,
+                                                                            label_index = label_index,
+                                                                            shuffle = False,
+                                                                            decode_threads = self.decode_threads,
+                                                                            prefetch = self.prefetch,
+                                                                            augment_workers = self.augment_workers,
+                                                                            dataset_cache = self.cache_dataset,
+                                                                            augmentation_variants = self.augmentation_variants,
+                                                                            dtype = self.dtype)
         return TrainingDataGenerator, ValidationDataGenerator
     
     def load_model(self, network_input_size):
@@ -110,13 +141,16 @@ class Classification(object):
         returns:
             A 2D or 3D UNet model
         '''
+        # For the last layer uncertainty the dropout is only active during training, so that the trunk of the
+        # trained model is deterministic during inference
         model = ResNet50(network_input_size,
                             Dropout = 0.1,
                              include_top=True,
                              weights=self.pretrained_weights,
                              input_tensor=None,
                              pooling='max',
-                             classes=self.num_classes)
+                             classes=self.num_classes,
+                             Dropout_On = None if self.uncertainty_mode == "last_layer" else True)
         if (self.pretrained_weights):
             model.load_weights(self.pretrained_weights, by_name=True, skip_mismatch=True)
         else:
@@ -143,7 +177,7 @@ class Classification(object):
             steps_per_epoch: The number of train steps in one epoch
             val_image_files: List of validation files
         returns:
-            The trained model and the checkpoint file path
+            The trained model with the weights of the best epoch and the checkpoint file path
         '''
         early_stopping = EarlyStopping(monitor='val_loss', patience=5, mode='auto', verbose=0)
         path = copy.deepcopy(self.path)
@@ -156,19 +190,25 @@ class Classification(object):
         logging.info("Tensorboard log is created at: logs/  it can be opend using tensorboard --logdir=logs for a terminal in the Project folder")
 
         #################################################if self.use_algorithm == "Classification":
-        callbacks_list = [model_checkpoint, tensorboard, early_stopping]
+        best_weights = BestWeights(monitor = 'val_loss')
+        callbacks_list = [model_checkpoint, tensorboard, early_stopping, best_weights]
 
         '''
         Train the model given the initialized model and the data from the data generator
+        With augment_workers the batches are loaded by threads, as the augmentation process pool can not be
+        started from the daemonic worker processes of keras
         '''
         model.fit_generator(TrainingDataGenerator,
                                 steps_per_epoch=steps_per_epoch,
                                 validation_data=ValidationDataGenerator,
-                                validation_steps=int(len(val_image_files)/self.batchsize),
-                                max_queue_size=50,
+                                validation_steps=len(ValidationDataGenerator),
+                                max_queue_size=self.max_queue_size,
+                                workers=self.workers,
                                 epochs=self.epochs,
                                 callbacks = callbacks_list,
-                                use_multiprocessing=True)
+                                use_multiprocessing=self.augment_workers <= 0)
+        TrainingDataGenerator.close()
+        ValidationDataGenerator.close()
         logging.info('finished Model.fit_generator')
         return model, checkpoint_filepath
 
@@ -190,9 +230,14 @@ class Classification(object):
         '''
         Initialize the testset generator
         '''
-        testGene = testGenerator(Training_Input_shape, self.path, num_channels, test_image_files, self.use_algorithm)
+        testGene = TestDataSequence(Training_Input_shape, self.test_batchsize, self.path, num_channels, test_image_files, self.use_algorithm,
+                                            normalization_args = self.normalization_args,
+                                            dataset_cache = self.cache_dataset,
+                                            decode_threads = self.decode_threads,
+                                            dtype = self.dtype)
+        test_image_files = testGene.test_image_files
         logging.info('finished testGene')
-        results = model.predict_generator(testGene, steps=num_test_img, use_multiprocessing=False, verbose=1)
+        results = model.predict_generator(testGene, steps=len(testGene), use_multiprocessing=False, verbose=1)
         logging.info("results %s" % str(np.shape(results)))
         logging.info('finished model.predict_generator')
         
@@ -208,9 +253,8 @@ class Classification(object):
         return results,test_image_files, num_test_img
         ################################################# if calculate_uncertainty == True:
     def uncertainty_prediction(self,
+                               model,
                                results,
-                               checkpoint_filepath,
-                               network_input_size,
                                Training_Input_shape,
                                num_channels,
                                test_image_files,
@@ -219,49 +263,34 @@ class Classification(object):
         Start uncertainty prediction if selected for regression or semantic segmentation
         As suggested by Gal et. al.: https://arxiv.org/abs/1506.02142
         And as implemented in: https://openreview.net/pdf?id=Sk_P2Q9sG
+        The trained model, which holds the weights of the best epoch, is reused for the Monte Carlo samples
         Args:
-            checkpoint_filepath: the directory where checkpoints are saved
-            network_input_size: the dimensions of the input to the network
+            model: the trained model with dropout active during inference,
+                    or without active dropout for the last_layer mode
+            results: the predicted labels of the testset
             Training_Input_shape: the shape of the images in the train dataset
             num_channels: number of channels (e.g.: 3 for RGB)
             test_image_files: list of filenames contained in the testset
             num_test_img: number of filenames in the testset
-            data_dimensions: image dimensions
-            num_channels_label: number of channels of the groundtruth (e.g.: 3 for RGB)
-            Input_image_shape: The shape of the input images
         returns:
             Saves the results to the 'results' directory and the uncertainty estimations to the 'uncertainty' directory
         '''
-        if self.epochs > 0:
-            uncertainty_weights = checkpoint_filepath
-        else:
-            uncertainty_weights = self.pretrained_weights
-        model = ResNet50(   network_input_size,
-                            Dropout = 0.5,
-                            include_top=True,
-                            weights=uncertainty_weights,
-                            input_tensor=None,
-                            pooling='max',
-                            classes=self.num_classes)
+        if self.uncertainty_mode == "last_layer":
+            # Only the last identity block of the ResNet50 is stochastic
+            model = last_layer_mc_model(model, "drop5c")
         logging.info("Starting Uncertainty estimation")
-        resultsMCD = []
-        for i in range(0, 20):
-            logging.info("Testing Uncertainty Number: %s" % str(i))
-            testGene = testGenerator(Training_Input_shape, self.path, num_channels, test_image_files, self.use_algorithm)
-            resultsMCD_pred = model.predict_generator(testGene,
-                                                              steps=num_test_img,
-                                                              use_multiprocessing=False,
-                                                              verbose=1)
-            resultsMCD.append(resultsMCD_pred)
-        resultsMCD = np.array(resultsMCD)
-        argmax_MC_Pred = (np.argmax(resultsMCD, axis=-1))
-        average_MC_Pred = []
-        for i in range(len(argmax_MC_Pred[1])):
-            bincount = np.bincount(argmax_MC_Pred[:,i])
-            average_MC_Pred.append(np.argmax(bincount))
-        average_MC_Pred = np.array(average_MC_Pred)
+        '''
+        Every test batch is read once and predicted with all Monte Carlo samples
+        The predictions of the test set count as the first sample, the votes and the entropy of the samples
+        are accumulated while the samples arrive
+        '''
+        testGene = TestDataSequence(Training_Input_shape, self.test_batchsize, self.path, num_channels, test_image_files, self.use_algorithm,
+                                            normalization_args = self.normalization_args,
+                                            dataset_cache = self.cache_dataset,
+                                            decode_threads = self.decode_threads,
+                                            dtype = self.dtype)
         assert self.num_classes > 1
-        combined_certainty = np.mean(-1 * np.sum(resultsMCD * np.log(resultsMCD + 10e-6), axis=-1), axis = 0)
+        average_MC_Pred, combined_certainty = mc_dropout_classification(model, testGene, self.mc_samples, results = results)
         combined_certainty = combined_certainty/ np.log(self.num_classes) # normalize to values between 0 and 1
         saveResult_classification_uncertainty(  self.path + "/results/",
                                                 test_image_files,
@@ -285,7 +314,8 @@ class Classification(object):
         TrainingDataGenerator, ValidationDataGenerator = self.data_generator(  data_path, 
                                                                                     Training_Input_shape, 
                                                                                     num_channels, 
-                                                                                    train_image_files)
+                                                                                    train_image_files,
+                                                                                    val_image_files)
         tf.random.set_random_seed(1)
         import random as python_random
         python_random.seed(1)
@@ -302,9 +332,8 @@ class Classification(object):
                                                                                 num_channels)
 
         if self.calculate_uncertainty == True:
-            self.uncertainty_prediction(    results,
-                                            checkpoint_filepath,
-                                            network_input_size,
+            self.uncertainty_prediction(    model,
+                                            results,
                                             Training_Input_shape,
                                             num_channels,
                                             test_image_files,
@@ -0,0 +1,185 @@
+'''
+InstantDL
+Offline augmentation cache
+Every file of the train folder is augmented several times and the variants are stored in a HDF5 file in the cache
+folder of the project directory, from which the training reads a random variant of each file instead of augmenting
+the batches in every step. A new set of variants can be written in a background process, which replaces the file
+once it is complete, so that the variants rotate over long trainings while the loaders keep reading the old file.
+'''
+
+import numpy as np
+import h5py
+import json
+import hashlib
+import multiprocessing
+import threading
+import logging
+import os
+from instantdl.data_generator.dataset_cache import get_cache_file
+from instantdl.data_generator.dataset_statistics import folder_fingerprint
+
+# The variants are stored in float16, which halves the size of the cache compared to float32
+CACHE_DTYPE = np.float16
+
+def get_augmentation_cache_file(data_path):
+    '''
+    Returns the path of the HDF5 file with the augmented variants of the train folder in the project directory
+    e.g. project/cache/train_augmented.h5
+    '''
+    return os.path.splitext(get_cache_file(data_path))[0] + "_augmented.h5"
+
+def augmentation_fingerprint(sequence, image_files, variants):
+    '''
+    Creates a fingerprint of everything the variants depend on: the files of the data folders,
+    the image shapes, the normalization, the augmentation settings and the number of variants
+    '''
+    hasher = hashlib.sha1()
+    for index, folder_name, shape, num_channels in sequence.folders:
+        hasher.update(folder_fingerprint(sequence.data_path + folder_name, image_files).encode())
+        hasher.update(("%s:%s:%s:%s;" % (folder_name, tuple(shape), sequence.X_min[index], sequence.X_max[index])).encode())
+    hasher.update(json.dumps(sequence.data_gen_args, sort_keys = True, default = str).encode())
+    hasher.update(("variants:%d" % variants).encode())
+    return hasher.hexdigest()
+
+def write_variants(sequence, image_files, variants, cache_file, fingerprint):
+    '''
+    Loads the files batch by batch, augments each batch variants times and writes the variants to a temporary file,
+    which replaces the cache file when it is complete
+
+    Args
+        sequence: the DataSequence with which the files are loaded and augmented
+        image_files: list of the files which are augmented
+        variants: number of augmented variants of each file
+        cache_file: path of the HDF5 file
+        fingerprint: the augmentation_fingerprint, which is stored with the variants
+    '''
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temporary_file = cache_file + ".%d.tmp" % os.getpid()
+    logging.info("Writing %s augmented variants of %s files to %s" % (variants, len(image_files), cache_file))
+    with h5py.File(temporary_file, 'w') as cache:
+        X_dataset = cache.create_dataset("X", shape = (len(image_files), variants) + tuple(sequence.X_shape),
+                                            dtype = CACHE_DTYPE, chunks = (1, 1) + tuple(sequence.X_shape))
+        Y_dataset = None
+        if sequence.Y_shape is not None:
+            Y_dataset = cache.create_dataset("Y", shape = (len(image_files), variants) + tuple(sequence.Y_shape),
+                                                dtype = CACHE_DTYPE, chunks = (1, 1) + tuple(sequence.Y_shape))
+        for start in range(0, len(image_files), sequence.batchsize):
+            batch_files = image_files[start:start + sequence.batchsize]
+            X, Y = sequence.load_files(batch_files)
+            for variant in range(variants):
+                # The augmentation may change its inputs in place, so each variant starts from a copy
+                X_augmented, Y_augmented = sequence.augment_batch(batch_files, X.copy(), Y.copy() if Y is not None else None)
+                X_dataset[start:start + len(batch_files), variant] = np.nan_to_num(X_augmented)
+                if Y_dataset is not None:
+                    Y_dataset[start:start + len(batch_files), variant] = np.nan_to_num(Y_augmented)
+        cache.attrs["fingerprint"] = fingerprint
+    os.replace(temporary_file, cache_file)
+
+class AugmentationCache(object):
+    '''
+    Augmented variants of all files of the train folder, shared by the training and validation data
+
+    Args
+        sequence: the DataSequence whose files are augmented
+        variants: number of augmented variants of each file
+        refresh_epochs: a new set of variants is written in the background after every refresh_epochs epochs,
+                        0 keeps the variants for the whole training
+    '''
+    def __init__(self, sequence, variants, refresh_epochs = 0):
+        self.cache_file = get_augmentation_cache_file(sequence.data_path)
+        self.image_files = sorted(os.listdir(sequence.data_path + "/image/"))
+        self.rows = dict((img_file, row) for row, img_file in enumerate(self.image_files))
+        self.variants = variants
+        self.refresh_epochs = refresh_epochs
+        self.epoch = 0
+        self.seed = 0
+        self.fingerprint = augmentation_fingerprint(sequence, self.image_files, variants)
+        self._file = None
+        self._pid = None
+        self._inode = None
+        self._writer = None
+        self._lock = threading.Lock()
+        if self.is_current() == True:
+            logging.info("Using the augmented variants from %s" % self.cache_file)
+        else:
+            write_variants(sequence, self.image_files, variants, self.cache_file, self.fingerprint)
+
+    def __getstate__(self):
+        # Open HDF5 files, processes and locks can not be copied to other processes
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_writer"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def is_current(self):
+        if os.path.isfile(self.cache_file) == False:
+            return False
+        with h5py.File(self.cache_file, 'r') as cache:
+            return cache.attrs.get("fingerprint") == self.fingerprint
+
+    def open(self):
+        '''
+        Opens the cache file in this process, it is opened again when it was replaced by a new set of variants
+        '''
+        inode = os.stat(self.cache_file).st_ino
+        if self._file is None or self._pid != os.getpid() or self._inode != inode:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = h5py.File(self.cache_file, 'r')
+            self._pid = os.getpid()
+            self._inode = inode
+        return self._file
+
+    def read(self, files, batch_index):
+        '''
+        Reads a random variant of each of the given files
+        The variants only depend on the epoch and the batch index, so that each worker reads the same variants
+
+        Args:
+            files: list of file names
+            batch_index: the index of the batch in the epoch
+
+        return:
+            X, Y: arrays with the dimensions (number of files, image shape) in float32, Y is None if there is no groundtruth
+        '''
+        random_state = np.random.RandomState((self.seed + batch_index) % 2**32)
+        variants = random_state.randint(0, self.variants, len(files))
+        # The loading threads share the file, which must not be replaced while one of them reads from it
+        with self._lock:
+            cache = self.open()
+            X = np.stack([cache["X"][self.rows[img_file], variant] for img_file, variant in zip(files, variants)])
+            Y = None
+            if "Y" in cache:
+                Y = np.stack([cache["Y"][self.rows[img_file], variant] for img_file, variant in zip(files, variants)])
+        return X.astype(np.float32), (Y.astype(np.float32) if Y is not None else None)
+
+    def on_epoch_end(self, sequence):
+        '''
+        Draws the seed of the variants of the next epoch and starts writing a new set of variants in a background
+        process after every refresh_epochs epochs, unless the previous set is still being written
+        '''
+        self.epoch += 1
+        self.seed = np.random.randint(0, 2**31 - 1)
+        if self.refresh_epochs <= 0 or self.epoch % self.refresh_epochs != 0:
+            return
+        if self._writer is not None and self._writer.is_alive():
+            logging.info("The augmented variants of epoch %s are still written, the current variants are kept" % self.epoch)
+            return
+        # The writer is spawned instead of forked, as a fork could copy locks held by the loading threads
+        self._writer = multiprocessing.get_context("spawn").Process(target = write_variants, daemon = True,
+                                                args = (sequence, self.image_files, self.variants, self.cache_file, self.fingerprint))
+        self._writer.start()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.terminate()
+            self._writer.join()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
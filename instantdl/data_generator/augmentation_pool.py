@@ -0,0 +1,117 @@
+'''
+InstantDL
+Process pool for the data augmentation
+The decoded batches are copied into slots of shared memory, the images of a batch are split into chunks which
+the worker processes augment in place, so that the augmentation scales with the number of cores and no arrays
+are pickled between the processes. The number of slots bounds the number of batches which are augmented at once.
+'''
+
+import numpy as np
+import random
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import queue
+from instantdl.data_generator.data_augmentation import data_augentation
+
+# The slots and augmentation settings of a worker process, which are set once when the worker is started
+worker_state = {}
+
+def slot_array(buffer, shape):
+    '''
+    Returns a float32 numpy view of a shared memory buffer with the batch dimensions shape
+    '''
+    return np.frombuffer(buffer, dtype = np.float32).reshape(shape)
+
+def init_worker(slots, X_shape, Y_shape, data_gen_args, seed, counter):
+    '''
+    Stores the shared slots in the worker and seeds its random number generators
+    Each worker takes the next index from the shared counter, so that the workers of a pool always use the
+    seeds seed, seed + 1, ...
+    '''
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    np.random.seed((seed + index) % 2**32)
+    random.seed(seed + index)
+    worker_state["slots"] = [(slot_array(X, X_shape), slot_array(Y, Y_shape) if Y is not None else None) for X, Y in slots]
+    worker_state["data_gen_args"] = data_gen_args
+
+def augment_chunk(slot, start, stop, data_path_file_name):
+    '''
+    Augments the images start to stop of the batch in a slot in place
+    '''
+    X, Y = worker_state["slots"][slot]
+    X_chunk = X[start:stop]
+    Y_chunk = Y[start:stop] if Y is not None else X_chunk
+    X_augmented, Y_augmented = data_augentation(X_chunk, Y_chunk, worker_state["data_gen_args"], data_path_file_name)
+    X_chunk[...] = X_augmented
+    if Y is not None:
+        Y_chunk[...] = Y_augmented
+
+class AugmentationPool(object):
+    '''
+    Worker processes which augment the batches of a DataSequence
+
+    Args
+        batchsize: the maximal number of images of a batch
+        X_shape: the dimensions of one image in X
+        Y_shape: the dimensions of one groundtruth image in Y, None if there is no groundtruth
+        data_gen_args: the augmentation settings passed to data_augentation
+        workers: number of worker processes
+        depth: number of slots, i.e. the maximal number of batches which are augmented at once
+        seed: the seed of the first worker, by default drawn from np.random, so that it follows the global seed
+    '''
+    def __init__(self, batchsize, X_shape, Y_shape, data_gen_args, workers, depth = 3, seed = None):
+        self.X_shape = (batchsize,) + tuple(X_shape)
+        self.Y_shape = (batchsize,) + tuple(Y_shape) if Y_shape is not None else None
+        self.workers = workers
+        self.depth = depth
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        self.slots = [(RawArray("f", int(np.prod(self.X_shape))),
+                        RawArray("f", int(np.prod(self.Y_shape))) if self.Y_shape is not None else None)
+                            for slot in range(depth)]
+        self.free_slots = queue.Queue()
+        for slot in range(depth):
+            self.free_slots.put(slot)
+        self.pool = multiprocessing.Pool(workers, initializer = init_worker,
+                                            initargs = (self.slots, self.X_shape, self.Y_shape, data_gen_args,
+                                                        seed, multiprocessing.Value("i", 0)))
+
+    def augment(self, X, Y, data_path_file_name):
+        '''
+        Augments a batch in the worker processes and returns copies of the augmented X and Y
+        Blocks while all slots are in use
+
+        Args
+            X: the batch of images
+            Y: the batch of groundtruth images, None to augment only X
+            data_path_file_name: the name passed to data_augentation, e.g. for saving the augmented images
+
+        return:
+            X, Y: the augmented batches, Y is None if no groundtruth was given
+        '''
+        slot = self.free_slots.get()
+        try:
+            X_slot = slot_array(self.slots[slot][0], self.X_shape)[:len(X)]
+            X_slot[...] = X
+            Y_slot = None
+            if Y is not None:
+                Y_slot = slot_array(self.slots[slot][1], self.Y_shape)[:len(Y)]
+                Y_slot[...] = Y
+            # Every image has its own augmentation parameters, so the chunks are augmented independently
+            bounds = np.linspace(0, len(X), min(self.workers, len(X)) + 1).astype(int)
+            results = [self.pool.apply_async(augment_chunk, (slot, start, stop, data_path_file_name))
+                            for start, stop in zip(bounds[:-1], bounds[1:])]
+            # All chunks are finished before an error is raised, so that the slot is not written after it is freed
+            for result in results:
+                result.wait()
+            for result in results:
+                result.get()
+            return X_slot.copy(), (Y_slot.copy() if Y_slot is not None else None)
+        finally:
+            self.free_slots.put(slot)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -5,38 +5,242 @@ Written by Dominik Waibel
 '''
 
 import numpy as np
-import skimage as sk
 import random
 from instantdl.data_generator.data import plot2images
-from scipy.ndimage.interpolation import rotate
 from scipy.ndimage.filters import gaussian_filter
 import math
 import os
 
-def data_augentation(X, Y, data_gen_args, data_path_file_name):
+def plane_axes(X):
+    """ The axes of the image plane in which rotation, shifts and zoom are applied, i.e. height and width
+    # Arguments
+        X: tensor, a batch of images with the dimensions (batch, (depth), height, width, channels)
+        or a single image with the dimensions (height, width, channels)
+        returns: tuple of the two axes
+    """
+    return (np.ndim(X) - 3, np.ndim(X) - 2)
 
-    if "horizontal_flip" in data_gen_args:
+def plane_shape(X):
+    return tuple(np.shape(X)[axis] for axis in plane_axes(X))
+
+def per_image(values, X):
+    """ Reshapes one value per image of the batch so that it broadcasts over the other dimensions of X """
+    return np.reshape(values, (-1,) + (1,) * (np.ndim(X) - 1))
+
+def sample_chance(batchsize, probability):
+    """ Draws for every image of the batch independently whether an augmentation is applied
+    # Arguments
+        batchsize: int, the number of images
+        probability: float, the chance that the augmentation is applied to an image
+        returns: boolean array with one value per image
+    """
+    return np.random.rand(batchsize) < probability
+
+def compose(transform, step):
+    """ Appends an augmentation step to a transform in homogeneous coordinates of the image plane
+    Both map output coordinates to input coordinates, therefore the step which is applied last is
+    multiplied from the right
+    # Arguments
+        transform: 3x3 array, or an array of one 3x3 matrix per image, or None for the identity
+        step: 3x3 array or an array of one 3x3 matrix per image
+        returns: 3x3 array or an array of one 3x3 matrix per image
+    """
+    if transform is None:
+        return step
+    return np.matmul(transform, step)
+
+def rotation_matrix(angle, shape):
+    """ Rotation by the angle in degrees around the center of the image plane, as scipy.ndimage.rotate
+    # Arguments
+        angle: float or array of one angle per image, the rotation angle in degrees
+        shape: tuple, height and width of the image plane
+        returns: 3x3 array or an array of one 3x3 matrix per angle
+    """
+    angle = np.radians(np.asarray(angle, dtype = np.float64))
+    center = (np.asarray(shape, dtype = np.float64) - 1) / 2
+    matrix = np.zeros(np.shape(angle) + (3, 3))
+    matrix[..., 0, 0] = np.cos(angle)
+    matrix[..., 0, 1] = np.sin(angle)
+    matrix[..., 1, 0] = -np.sin(angle)
+    matrix[..., 1, 1] = np.cos(angle)
+    matrix[..., 2, 2] = 1
+    matrix[..., :2, 2] = center - np.matmul(matrix[..., :2, :2], center)
+    return matrix
+
+def crop_matrix(start, length, shape):
+    """ Crops the window of the length at the start position and stretches it to the shape of the image plane,
+    as a crop followed by skimage.transform.resize
+    # Arguments
+        start: tuple, position of the window in height and width, each a number or an array of one value per image
+        length: tuple, height and width of the window, each a number or an array of one value per image
+        shape: tuple, height and width of the image plane
+        returns: 3x3 array or an array of one 3x3 matrix per image
+    """
+    start = np.stack(np.broadcast_arrays(*start), axis = -1).astype(np.float64)
+    scale = np.stack(np.broadcast_arrays(*length), axis = -1) / np.asarray(shape, dtype = np.float64)
+    start, scale = np.broadcast_arrays(start, scale)
+    matrix = np.zeros(scale.shape[:-1] + (3, 3))
+    matrix[..., 0, 0] = scale[..., 0]
+    matrix[..., 1, 1] = scale[..., 1]
+    matrix[..., 2, 2] = 1
+    matrix[..., :2, 2] = start + 0.5 * scale - 0.5
+    return matrix
+
+def nearest_index(coordinates, size):
+    """ Rounds the coordinates to the nearest pixel, coordinates outside of the image take the value of the edge """
+    return np.clip(np.floor(coordinates + 0.5), 0, size - 1).astype(np.intp)
+
+def linear_weights(coordinates, size):
+    """ Returns the lower and upper neighbour of each coordinate and the weight of the upper neighbour
+    Coordinates outside of the image take the value of the edge, as mode 'nearest' in scipy.ndimage
+    """
+    coordinates = np.clip(coordinates, 0, size - 1)
+    lower = np.floor(coordinates).astype(np.intp)
+    upper = np.minimum(lower + 1, size - 1)
+    return lower, upper, coordinates - lower
+
+def interpolate_axis(planes, coordinates, axis, order):
+    """ Resamples the planes along one axis at the coordinates, which is one pass of a separable interpolation
+    # Arguments
+        planes: tensor with the dimensions (planes, height, width)
+        coordinates: array, the input coordinate of each output pixel along the axis
+        axis: int, 1 for the height, 2 for the width
+        order: int, 1 for linear interpolation, 0 for nearest neighbour
+        returns: tensor, in which the axis has the length of the coordinates
+    """
+    if order == 0:
+        return np.take(planes, nearest_index(coordinates, planes.shape[axis]), axis = axis)
+    lower, upper, weight = linear_weights(coordinates, planes.shape[axis])
+    weight = weight.reshape([-1 if dimension == axis else 1 for dimension in range(planes.ndim)]).astype(planes.dtype)
+    lower_values = np.take(planes, lower, axis = axis)
+    return lower_values + (np.take(planes, upper, axis = axis) - lower_values) * weight
+
+def warp_planes(planes, matrix, order):
+    """ Resamples a stack of image planes, e.g. the slices and channels of one volume, with the same transform
+    The input coordinates of the output pixels are computed once and shared by all planes. Transforms without
+    rotation, i.e. shifts and zoom, are interpolated separably along the height and then the width, and transforms
+    which map pixels onto pixels, e.g. shifts by whole pixels, are copied without interpolation
+    # Arguments
+        planes: tensor with the dimensions (planes, height, width)
+        matrix: 3x3 array which maps output coordinates to input coordinates of the image plane
+        order: int, 1 for linear interpolation, 0 for nearest neighbour
+        returns: tensor, which has the same dimensions as the input
+    """
+    if np.allclose(matrix, np.eye(3)):
+        return planes.copy()
+    if np.allclose(matrix[:2], np.round(matrix[:2])):
+        order = 0
+    shape = planes.shape[-2:]
+    if np.allclose(matrix[0, 1], 0) and np.allclose(matrix[1, 0], 0):
+        warped = planes
+        for axis in (0, 1):
+            warped = interpolate_axis(warped, matrix[axis, axis] * np.arange(shape[axis]) + matrix[axis, 2], axis + 1, order)
+        return warped
+    rows, columns = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing = 'ij')
+    row_coordinates = (matrix[0, 0] * rows + matrix[0, 1] * columns + matrix[0, 2]).ravel()
+    column_coordinates = (matrix[1, 0] * rows + matrix[1, 1] * columns + matrix[1, 2]).ravel()
+    flat = planes.reshape(len(planes), -1)
+    if order == 0:
+        index = nearest_index(row_coordinates, shape[0]) * shape[1] + nearest_index(column_coordinates, shape[1])
+        return np.take(flat, index, axis = 1).reshape(planes.shape)
+    row_lower, row_upper, row_weight = linear_weights(row_coordinates, shape[0])
+    column_lower, column_upper, column_weight = linear_weights(column_coordinates, shape[1])
+    row_weight, column_weight = row_weight.astype(planes.dtype), column_weight.astype(planes.dtype)
+    top_left = np.take(flat, row_lower * shape[1] + column_lower, axis = 1)
+    bottom_left = np.take(flat, row_upper * shape[1] + column_lower, axis = 1)
+    top = top_left + (np.take(flat, row_lower * shape[1] + column_upper, axis = 1) - top_left) * column_weight
+    bottom = bottom_left + (np.take(flat, row_upper * shape[1] + column_upper, axis = 1) - bottom_left) * column_weight
+    return (top + (bottom - top) * row_weight).reshape(planes.shape)
+
+def affine_warp(X, transform, order, axes = None):
+    """ Resamples each image plane of the tensor once with the transform
+    The planes are resampled in the image plane only, as the interpolation over the batch, depth and channel axes
+    would multiply the cost without changing the result. All planes of an image, e.g. the slices of a volume,
+    share the coordinates of the transform. Images with the identity transform are copied
+    # Arguments
+        X: tensor, the images
+        transform: 3x3 array which maps output coordinates to input coordinates of the image plane,
+                    or an array of one 3x3 matrix per image of the batch
+        order: int, 1 for linear interpolation of images, 0 for nearest neighbour of masks
+        axes: tuple, the axes of the image plane, by default the plane_axes of X
+        returns: tensor, which has the same dimensions as the input
+    """
+    if axes is None:
+        axes = plane_axes(X)
+    transform = np.asarray(transform, dtype = np.float64)
+    planes = np.moveaxis(X, axes, (-2, -1))
+    shape = planes.shape
+    if transform.ndim == 2:
+        transform = transform[np.newaxis]
+    planes = planes.reshape((len(transform), -1) + shape[-2:])
+    warped = np.empty_like(planes)
+    for sample, matrix in enumerate(transform):
+        warped[sample] = warp_planes(planes[sample], matrix, order)
+    return np.moveaxis(warped.reshape(shape), (-2, -1), axes)
+
+def rotate_quarter_turns(X, quarter_turns, axes):
+    """ Rotates each image of the batch by its number of quarter turns in the image plane, which only permutes
+    the pixels, in the same direction as rotation_matrix
+    # Arguments
+        X: tensor, a batch of images
+        quarter_turns: array of ints, one number of quarter turns per image
+        axes: tuple, the axes of the image plane in X
+        returns: tensor, which has the same dimensions as the input
+    """
+    rotated = np.flatnonzero(np.asarray(quarter_turns) % 4)
+    if len(rotated) == 0:
+        return X
+    X = X.copy()
+    for index in rotated:
+        X[index] = np.rot90(X[index], quarter_turns[index], axes = (axes[0] - 1, axes[1] - 1))
+    return X
+
+def data_augentation(X, Y, data_gen_args, data_path_file_name, dtype = np.float32):
+    """ Augments the image and groundtruth on the fly
+    The augmentations are computed in float32 (or the given dtype), the interpolations of scipy and
+    skimage promote to float64, therefore X and Y are converted back before they are returned
+    Every image of the batch is augmented with its own random parameters, which are drawn for the whole
+    batch at once. Rotation, shifts and zoom are composed to a single affine transform per image, so that
+    the image is interpolated linearly and the groundtruth with nearest neighbour only once
+    """
+    X = np.asarray(X, dtype = dtype)
+    Y = np.asarray(Y, dtype = dtype)
+    # A single image, e.g. of the Mask RCNN, is augmented as a batch of one image
+    single_image = np.ndim(X) == 3
+    if single_image:
+        X, Y = X[np.newaxis], Y[np.newaxis]
+    batchsize = len(X)
+    # The axes are taken from X, as the groundtruth may have no channel axis
+    axes = plane_axes(X)
+
+    if "horizontal_flip" in data_gen_args and data_gen_args["horizontal_flip"] == True:
         """ Flip image and groundtruth horizontally by a chance of 33% 
         # Arguments
             X: tensor, the input image
             Y: tensor, the groundtruth
             returns: two tensors, X, Y, which have the same dimensions as the input 
         """
-        if data_gen_args["horizontal_flip"] == True & random.choice([True, False, False]) == True:
-            X = np.flip(X, len(np.shape(X))-1)
-            Y = np.flip(Y, len(np.shape(Y))-1)
+        flip = sample_chance(batchsize, 1 / 3)
+        if flip.any():
+            X = np.where(per_image(flip, X), np.flip(X, axes[1]), X)
+            Y = np.where(per_image(flip, Y), np.flip(Y, axes[1]), Y)
 
-    if "vertical_flip" in data_gen_args:
+    if "vertical_flip" in data_gen_args and data_gen_args["vertical_flip"] == True:
         """ Flip image and groundtruth vertically by a 33% chance
         # Arguments
             X: tensor, the input image
             Y: tensor, the groundtruth
             returns: two tensors, X, Y, which have the same dimensions as the input
         """
-        if data_gen_args["vertical_flip"] == True & random.choice([True, False, False]) == True:
-            X = np.flip(X, len(np.shape(X))-2)
-            Y = np.flip(Y, len(np.shape(Y))-2)
+        flip = sample_chance(batchsize, 1 / 3)
+        if flip.any():
+            X = np.where(per_image(flip, X), np.flip(X, axes[0]), X)
+            Y = np.where(per_image(flip, Y), np.flip(Y, axes[0]), Y)
 
+    # Rotation, shifts and zoom are composed to one affine transform per image, which maps the coordinates of
+    # the augmented image to the coordinates of the input, so that X and Y are resampled only once
+    transform = None
+    shape = plane_shape(X)
     if "rotation_range" in data_gen_args and data_gen_args["rotation_range"] > 0:
         """ Rotate image and groundtruth by a random angle within the rotation range 
         # Arguments
@@ -44,26 +248,20 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
             Y: tensor, the groundtruth
             returns: two tensors, X, Y, which have the same dimensions as the input
         """
-        angle =  np.random.choice(int(data_gen_args["rotation_range"]*100))/100
-        if len(np.shape(X))-1 == 3:
-            X = np.nan_to_num(rotate(X, angle, mode='nearest', axes=(2, 3), reshape=False))
-            Y = np.nan_to_num(rotate(Y, angle, mode='nearest', axes=(2, 3), reshape=False))
-        else:
-            X = np.nan_to_num(rotate(X, angle, mode='nearest', axes=(1, 2), reshape=False))
-            Y = np.nan_to_num(rotate(Y, angle, mode='nearest', axes=(1, 2), reshape=False))
+        angle =  np.random.choice(int(data_gen_args["rotation_range"]*100), batchsize)/100
+        if shape[0] == shape[1]:
+            # Whole quarter turns of square planes only permute the pixels, so only the remaining angle is interpolated
+            quarter_turns = np.round(angle / 90).astype(int)
+            angle = angle - 90 * quarter_turns
+            X = rotate_quarter_turns(X, quarter_turns, axes)
+            Y = rotate_quarter_turns(Y, quarter_turns, axes)
         # Zoom so that there are no empty edges
-        shape_X = np.shape(X)
-        shape_Y = np.shape(Y)
-        length_X = np.max(shape_X)
-        zoom_length_X = length_X / (np.cos(math.radians(angle)) + np.sin(math.radians(angle)))
-        zoom_length_Y = length_X / (np.cos(math.radians(angle)) + np.sin(math.radians(angle)))
-        X = X[..., int((length_X - zoom_length_X) / 2) : int(length_X -  ((length_X - zoom_length_X) / 2)), int((length_X - zoom_length_X) / 2) : int(length_X - ((length_X - zoom_length_X) / 2)), :]
-        X = np.nan_to_num(sk.transform.resize(X, shape_X))
-        Y = Y[..., int((length_X - zoom_length_Y) / 2) : int(length_X -  ((length_X - zoom_length_Y) / 2)), int((length_X - zoom_length_Y) / 2) : int(length_X - ((length_X - zoom_length_Y) / 2)), :]
-        Y = np.nan_to_num(sk.transform.resize(Y, shape_Y))
-
-
-    if "width_shift_range" in data_gen_args and data_gen_args["width_shift_range"] > 0 & random.choice([True, False]) == True:
+        zoom = np.cos(np.radians(np.abs(angle))) + np.sin(np.radians(np.abs(angle)))
+        transform = compose(transform, rotation_matrix(angle, shape))
+        transform = compose(transform, crop_matrix(((shape[0] - shape[0] / zoom) / 2, (shape[1] - shape[1] / zoom) / 2),
+                                                    (shape[0] / zoom, shape[1] / zoom), shape))
+
+    if "width_shift_range" in data_gen_args and data_gen_args["width_shift_range"] > 0:
         """ Shift the image and groundtruth width by a number within the width shift range by a 50% chance
         # Arguments
             X: tensor, the input image
@@ -71,21 +269,13 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
             width shift range: float, amound of width shift
             returns: two tensors, X, Y, which have the same dimensions as the input
         """
-        width_shift = np.random.choice(int(data_gen_args["width_shift_range"] * 100))
-        shape_X = np.shape(X)
-        shape_Y = np.shape(Y)
-        if len(np.shape(X))-1 == 3:
-            size = np.size(X[0, 0, :, 0, 0])
-        else:
-            size = np.size(X[0, 0, :, 0,])
-        start_width_shift = np.random.choice(int(size - (size - width_shift)+1))
-
-        X = X[:, :, start_width_shift: int(size - int(size * width_shift / 100)),...]
-        X = np.nan_to_num(sk.transform.resize(X, shape_X))
-        Y = Y[:, :, start_width_shift: int(size - int(size * width_shift / 100)),...]
-        Y = np.nan_to_num(sk.transform.resize(Y, shape_Y))
-
-    if "height_shift_range" in data_gen_args and data_gen_args["height_shift_range"] > 0 & random.choice([True, False]) == True:
+        # The images which are not shifted keep the identity transform
+        width_shift = np.random.choice(int(data_gen_args["width_shift_range"] * 100), batchsize) * sample_chance(batchsize, 1 / 2)
+        length = np.maximum(shape[1] - (shape[1] * width_shift / 100).astype(int), 1)
+        start_width_shift = (np.random.rand(batchsize) * (shape[1] - length + 1)).astype(int)
+        transform = compose(transform, crop_matrix((0, start_width_shift), (shape[0], length), shape))
+
+    if "height_shift_range" in data_gen_args and data_gen_args["height_shift_range"] > 0:
         """ Shift the image and groundtruth height by a number within the width shift range by a 50% chance
         # Arguments
             X: tensor, the input image
@@ -93,20 +283,12 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
             height shift range: float, amound of height shift
             returns: two tensors, X, Y, which have the same dimensions as the input
         """
-        height_shift = np.random.choice(int(data_gen_args["height_shift_range"] * 100))
-        shape_X = np.shape(X)
-        shape_Y = np.shape(Y)
-        if len(np.shape(X))-1 == 3:
-            size = np.size(X[0, 0, :, 0, 0])
-        else:
-            size = np.size(X[0, 0, :, 0,])
-        start_heigth_shift = np.random.choice(int(size - (size - height_shift)+1))
-        X = X[..., start_heigth_shift: int(size - int(size * height_shift / 100)), :]
-        X = np.nan_to_num(sk.transform.resize(X, shape_X))
-        Y = Y[..., start_heigth_shift: int(size - int(size * height_shift / 100)), :]
-        Y = np.nan_to_num(sk.transform.resize(Y, shape_Y))
-
-    if "zoom_range" in data_gen_args and data_gen_args["zoom_range"] > 0 & random.choice([True, False]) == True:
+        height_shift = np.random.choice(int(data_gen_args["height_shift_range"] * 100), batchsize) * sample_chance(batchsize, 1 / 2)
+        length = np.maximum(shape[0] - (shape[0] * height_shift / 100).astype(int), 1)
+        start_heigth_shift = (np.random.rand(batchsize) * (shape[0] - length + 1)).astype(int)
+        transform = compose(transform, crop_matrix((start_heigth_shift, 0), (length, shape[1]), shape))
+
+    if "zoom_range" in data_gen_args and data_gen_args["zoom_range"] > 0:
         """ Zooms the image and groundtruth to a random magnification in the zoom range and to a random position in the image by a 50% chance
         # Arguments
             X: tensor, the input image
@@ -114,21 +296,16 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
             zoom range: float, amound of zoom
             returns: two tensors, X, Y, which have the same dimensions as the input
         """
-        zoom = np.random.choice(int(data_gen_args["zoom_range"] * 100)) + 1
-        shape_X = np.shape(X)
-        shape_Y = np.shape(Y)
-        if len(np.shape(X))-1 == 3:
-            size = np.size(X[0, 0, :, 0, 0])
-        else:
-            size = np.size(X[0, 0, :, 0,])
-        x_position = np.random.choice(zoom)
-        y_position = np.random.choice(zoom)
-        X = X[..., x_position: int(x_position + size - zoom), y_position: int(y_position + size - zoom), :]
-        X = np.nan_to_num(sk.transform.resize(X, shape_X))
-        Y = Y[..., x_position:int(x_position + size - zoom), y_position: int(y_position + size - zoom), :]
-        Y = np.nan_to_num(sk.transform.resize(Y, shape_Y))
-
-    if "gaussian_noise" in data_gen_args and data_gen_args["gaussian_noise"] > 0 and random.choice([True, False, False]) == True:
+        zoom = np.minimum(np.random.choice(int(data_gen_args["zoom_range"] * 100), batchsize) + 1, min(shape) - 1) * sample_chance(batchsize, 1 / 2)
+        x_position = (np.random.rand(batchsize) * zoom).astype(int)
+        y_position = (np.random.rand(batchsize) * zoom).astype(int)
+        transform = compose(transform, crop_matrix((x_position, y_position), (shape[0] - zoom, shape[1] - zoom), shape))
+
+    if transform is not None:
+        X = affine_warp(X, transform, order = 1, axes = axes)
+        Y = affine_warp(Y, transform, order = 0, axes = axes)
+
+    if "gaussian_noise" in data_gen_args and data_gen_args["gaussian_noise"] > 0:
         """ Adds gaussian noise to the image by a one-third chance
         # Arguments
             X: tensor, the input image
@@ -136,9 +313,10 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
             returns: one tensors, X, which have the same dimensions as the input
         """
         value = data_gen_args["gaussian_noise"]
-        X = X + np.random.normal(0, value)
+        noise = np.random.normal(0, value, batchsize) * sample_chance(batchsize, 1 / 3)
+        X = X + per_image(noise, X).astype(X.dtype)
 
-    if "gaussian_blur_image" in data_gen_args and data_gen_args["gaussian_blur_image"] > 0 and random.choice([True, False, False]) == True:
+    if "gaussian_blur_image" in data_gen_args and data_gen_args["gaussian_blur_image"] > 0:
         """ Blurs the input image in gaussian fashin by a 33% chance
         # Arguments
             X: tensor, the input image
@@ -146,9 +324,13 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
             returns: one tensor, X, which have the same dimensions as the input
         """
         value = data_gen_args["gaussian_blur_image"]
-        X = gaussian_filter(X, sigma=value)
+        blur = np.flatnonzero(sample_chance(batchsize, 1 / 3))
+        if len(blur) > 0:
+            X = X.copy()
+            for index in blur:
+                X[index] = gaussian_filter(X[index], sigma=value)
 
-    if "gaussian_blur_label" in data_gen_args and data_gen_args["gaussian_blur_label"] > 0 and random.choice([True, False, False]) == True:
+    if "gaussian_blur_label" in data_gen_args and data_gen_args["gaussian_blur_label"] > 0:
         """ Blurs the groundtruth image in gaussian fashin by a 33% chance
         # Arguments
             Y: tensor, the groundtruth image
@@ -156,48 +338,52 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
             returns: one tensor, Y, which have the same dimensions as the input
         """
         value = data_gen_args["gaussian_blur_label"]
-        Y = gaussian_filter(Y, sigma=value)
+        blur = np.flatnonzero(sample_chance(batchsize, 1 / 3))
+        if len(blur) > 0:
+            Y = Y.copy()
+            for index in blur:
+                Y[index] = gaussian_filter(Y[index], sigma=value)
 
-    if "contrast_range" in data_gen_args and random.choice([True, False, False]) == True:
+    if "contrast_range" in data_gen_args:
         """ Increases or decreases the contrast of the input in by the range given by a 33% chance
         # Arguments
             X: tensor, the groundtruth image
             contrast_range: float, amound of contrast added or removed
             returns: one tensor, X, which have the same dimensions as the input
         """
-        range = np.random.uniform(-1,1) * data_gen_args["contrast_range"] + 1
-        min_X = np.min(X)
-        X = (X - min_X) * range + min_X
+        range = np.where(sample_chance(batchsize, 1 / 3), np.random.uniform(-1, 1, batchsize) * data_gen_args["contrast_range"] + 1, 1)
+        min_X = per_image(X.reshape(batchsize, -1).min(axis = 1), X)
+        X = (X - min_X) * per_image(range, X).astype(X.dtype) + min_X
 
-    if "brightness_range" in data_gen_args and random.choice([True, False]) == True:
+    if "brightness_range" in data_gen_args:
         """ Increases or decreases the brightness of the input in by the range given by a 50% chance
         # Arguments
             X: tensor, the groundtruth image
             brightness_range: float, amound of gaussian noise added
             returns: one tensor, X, which have the same dimensions as the input
         """
-        range = np.random.uniform(-1,1) * data_gen_args["brightness_range"]
-        X = X + range * X
+        range = np.where(sample_chance(batchsize, 1 / 2), np.random.uniform(-1, 1, batchsize) * data_gen_args["brightness_range"], 0)
+        X = X + per_image(range, X).astype(X.dtype) * X
 
-    if "threshold_background_image" in data_gen_args and random.choice([True, False, False]) == True:
+    if "threshold_background_image" in data_gen_args:
         """ Thresholds the input image at the mean and sets every pixelvalue below the mean to zero by a 33% chance
         # Arguments
             X: tensor, the groundtruth image
             threshold_background_image: True or False
             returns: one tensor, X, which have the same dimensions as the input
         """
-        mean_X = np.mean(X)
-        X[X < mean_X] = 0
+        mean_X = per_image(X.reshape(batchsize, -1).mean(axis = 1), X)
+        X = np.where(per_image(sample_chance(batchsize, 1 / 3), X) & (X < mean_X), 0, X)
 
-    if "threshold_background_groundtruth" in data_gen_args and random.choice([True, False, False]) == True :
+    if "threshold_background_groundtruth" in data_gen_args:
         """ Thresholds the groundtruth image at the mean and sets every pixelvalue below the mean to zero by a 33% chance
         # Arguments
             Y: tensor, the groundtruth image
             threshold_background_groundtruth: True or False
             returns: one tensor, Y, which have the same dimensions as the input
         """
-        mean_Y = np.mean(Y) * 0.8
-        Y[Y < mean_Y] = 0
+        mean_Y = per_image(Y.reshape(batchsize, -1).mean(axis = 1), Y) * 0.8
+        Y = np.where(per_image(sample_chance(batchsize, 1 / 3), Y) & (Y < mean_Y), 0, Y)
 
     if "binarize_mask" in data_gen_args and data_gen_args["binarize_mask"] == True:
         """ Binarize the groundtruth image at the mean and sets every pixelvalue below the mean to zero and every above to one
@@ -234,4 +420,6 @@ def data_augentation(X, Y, data_gen_args, data_path_file_name):
         elif len(np.shape(X)) == 4 and np.shape(X)[-1] == 1:
             plot2images(X[0, ..., 0], Y[0, :, :, 0], Aug_path, title)
     #logging.info("Augmented Dimensions:", np.shape(X), np.shape(Y))
-    return X, Y
\ No newline at end of file
+    if single_image:
+        X, Y = X[0], Y[0]
+    return np.asarray(X, dtype = dtype), np.asarray(Y, dtype = dtype)
\ No newline at end of file
@@ -9,15 +9,44 @@ import numpy as np
 from skimage.io import imread
 from skimage.transform import resize
 from instantdl.data_generator.data_augmentation import data_augentation
+from instantdl.data_generator.dataset_statistics import compute_min_max, get_dataset_min_max
+from instantdl.data_generator.dataset_cache import DatasetCache
+from instantdl.data_generator.augmentation_pool import AugmentationPool
+from instantdl.data_generator.augmentation_cache import AugmentationCache
 import os
 import csv as csv
 import sys
 import copy
 import glob
 import logging
-from keras.utils import to_categorical
+from keras.utils import to_categorical, Sequence
 from skimage.color import gray2rgb
 import warnings
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# Data types of the batches passed to keras, the computations in the data pipeline are always executed in float32
+DTYPES = {"float32": np.float32, "float16": np.float16}
+
+def get_dtype(dtype):
+    '''
+    Returns the numpy data type of the dtype policy of the data pipeline
+
+    Args:
+        dtype (str): "float32" (default) or "float16", which halves the memory of the batches in the queues
+    
+    return: 
+        the numpy data type
+    '''
+    if dtype not in DTYPES:
+        raise ValueError("The dtype %s is not supported, use one of %s" % (dtype, list(DTYPES.keys())))
+    return DTYPES[dtype]
+
 
 def get_min_max(data_path, folder_name, image_files):
     '''
@@ -26,22 +55,13 @@ def get_min_max(data_path, folder_name, image_files):
     Args:
         data_path (str): path to project folder
         folder_name (str): one of the data folder names, e.g. image or groundtruth
-        train_image_files (list): list of image files
+        image_files (list): list of image files
     
     return: 
         min_value: the minimum pixel value of the dataset 
         max_value: the maximum pixel value of the dataset
     '''
-    num_img = len(image_files)
-    Xmin = np.empty(num_img)
-    Xmax = np.empty(num_img)
-    for i, img_file in enumerate(image_files):
-        if img_file.endswith(".npy"):
-            Xmin[i] = np.min(np.array(np.load(data_path + folder_name + img_file)))
-            Xmax[i] = np.max(np.array(np.load(data_path + folder_name + img_file)))
-        else:
-            Xmin[i] = np.min(np.array(imread(data_path + folder_name + img_file)))
-            Xmax[i] = np.max(np.array(imread(data_path + folder_name + img_file)))
+    Xmin, Xmax = compute_min_max([data_path + folder_name + img_file for img_file in image_files])
     
     min_value = np.min(Xmin)
     max_value = np.max(Xmax)
@@ -50,19 +70,20 @@ def get_min_max(data_path, folder_name, image_files):
                                             (folder_name, min_value, max_value))
     return min_value, max_value
 
-def import_image(path_name):
+def import_image(path_name, mmap_mode = None):
     '''
     This function loads the image from the specified path
     NOTE: The alpha channel is removed (if existing) for consistency
 
     Args:
         path_name (str): path to image file
+        mmap_mode: if 'r' .npy files are memory mapped instead of read, so only the accessed parts are read from disk
     
     return: 
         image_data: numpy array containing the image data in at the given path. 
     '''
     if path_name.endswith('.npy'):
-        image_data = np.array(np.load(path_name))
+        image_data = np.load(path_name, mmap_mode = mmap_mode)
     else:
         image_data = imread(path_name)
         # If has an alpha channel, remove it for consistency
@@ -71,9 +92,150 @@ def import_image(path_name):
     return image_data
 
 
+def resize_image(image_data, Training_Input_shape):
+    '''
+    This function resizes an image to the Training_Input_shape and keeps its original value range
+    Images which only lack or have an additional channel dimension of size one are reshaped without a copy
+
+    Args:
+        image_data: numpy array containing the image data
+        Training_Input_shape: The dimensions of one image used for training. Can be set in the config.json file
+    return:
+        image_data: the resized image data
+    '''
+    image_shape = tuple(np.shape(image_data))
+    Training_Input_shape = tuple(Training_Input_shape)
+    if image_shape + (1,) == Training_Input_shape or image_shape == Training_Input_shape + (1,):
+        return np.reshape(image_data, Training_Input_shape)
+    if image_shape != Training_Input_shape:
+        #The Resizing fundtion changes the array values, therefore shift them back to the original range
+        min_value = np.min(image_data)
+        max_value = np.max(image_data)
+        image_data = resize(image_data, Training_Input_shape)
+        newmin = np.min(image_data)
+        newmax = np.max(image_data)
+        image_data = ((image_data - newmin) / (newmax - newmin)) * (max_value - min_value) + min_value
+    return image_data
+
+
+def load_resized_image(path_name, Training_Input_shape):
+    '''
+    This function imports one image and resizes it to the Training_Input_shape
+
+    return:
+        image_data: the resized image data
+        dtype: the dtype of the image file
+    '''
+    image_data = import_image(path_name, mmap_mode = 'r')
+    return resize_image(image_data, Training_Input_shape), image_data.dtype
+
+
+def normalize_image(image_data, X_min, X_max, out = None):
+    '''
+    This function normalizes image data with the minimum and maximum pixel value of the dataset
+    If out is given the result is written into it, so memory mapped data is copied directly into the batch
+    '''
+    if out is None:
+        return (image_data - X_min) / (X_max - X_min)
+    if np.ndim(image_data) < np.ndim(out):
+        image_data = image_data[..., np.newaxis]
+    np.subtract(image_data, X_min, out = out)
+    out /= (X_max - X_min)
+    return out
+
+
+def load_image(path_name, Training_Input_shape, X_min, X_max, out = None):
+    '''
+    This function imports one image, resizes it to the Training_Input_shape and normalizes it
+    .npy files are memory mapped, so images which do not need to be resized are copied directly from disk
+
+    Args:
+        path_name (str): path to image file
+        Training_Input_shape: The dimensions of one image used for training. Can be set in the config.json file
+        X_min: the minimum pixel value of this dataset
+        X_max: the maximum pixel value of this dataset
+        out: optional slot of a preallocated batch into which the image is written
+    return:
+        image_data: the normalized image data
+    '''
+    image_data = resize_image(import_image(path_name, mmap_mode = 'r'), Training_Input_shape)
+    return normalize_image(image_data, X_min, X_max, out)
+
+
+def get_image_shape(path_name):
+    '''
+    Returns the shape of an image, .npy and tiff files are not decoded for this
+    '''
+    if path_name.endswith('.npy'):
+        return np.shape(np.load(path_name, mmap_mode = 'r'))
+    if tifffile is not None and path_name.lower().endswith(('.tif', '.tiff')):
+        with tifffile.TiffFile(path_name) as tif:
+            return tuple(tif.series[0].shape)
+    return np.shape(imread(path_name))
+
+
+def read_region(path_name, corner, patch_size):
+    '''
+    Reads the region of an image which starts at the corner and has the patch_size
+    .npy files and uncompressed tiff files are memory mapped, so only the region is read from disk,
+    all other files are decoded completely
+    NOTE: The alpha channel is removed (if existing) for consistency
+
+    Args:
+        path_name (str): path to image file
+        corner: the position of the region in the spatial dimensions
+        patch_size: the size of the region in the spatial dimensions
+    return:
+        image_data: the region, which is smaller than the patch_size if it exceeds the image
+    '''
+    image_data = None
+    if path_name.endswith('.npy'):
+        image_data = np.load(path_name, mmap_mode = 'r')
+    elif tifffile is not None and path_name.lower().endswith(('.tif', '.tiff')):
+        try:
+            image_data = tifffile.memmap(path_name, mode = 'r')
+        except ValueError:
+            # Compressed and tiled tiff files can not be memory mapped
+            image_data = None
+    if image_data is None:
+        image_data = imread(path_name)
+    image_data = image_data[tuple(slice(c, c + p) for c, p in zip(corner, patch_size))]
+    if np.array(np.shape(image_data))[-1] == 4:
+        image_data = image_data[..., 0:3]
+    return image_data
+
+
+def load_patch(path_name, corner, patch_size, X_min, X_max, out):
+    '''
+    This function reads a patch of an image and writes it normalized into the slot of a batch
+    Patches which exceed the image are padded with zeros
+    '''
+    image_data = read_region(path_name, corner, patch_size)
+    region = tuple(slice(0, size) for size in np.shape(image_data)[:len(patch_size)])
+    if np.shape(image_data)[:len(patch_size)] != tuple(patch_size):
+        out[...] = 0
+    return normalize_image(image_data, X_min, X_max, out[region])
+
+
+def allocate_batch(batchsize, Training_Input_shape, dtype = np.float32):
+    '''
+    Allocates a batch for images which are resized to the Training_Input_shape
+    '''
+    return np.empty((batchsize,) + tuple(Training_Input_shape), dtype = dtype)
+
+
+def add_channel_axis(X, num_channels):
+    '''
+    This function adds the channel dimension to a batch if it is missing
+    '''
+    if np.shape(X)[-1] != num_channels:
+       X= X[..., np.newaxis]
+    return X
+
+
 def image_generator(    Training_Input_shape, batchsize, num_channels, 
                         train_image_file, folder_name, data_path, 
-                        X_min, X_max, use_algorithm):
+                        X_min, X_max, use_algorithm, executor = None, dtype = np.float32):
     '''
     This function normalizes the imported images, resizes them and create batches
 
@@ -86,35 +248,428 @@ def image_generator(    Training_Input_shape, batchsize, num_channels,
         data_path: the project directory
         X_min: the minimum pixel value of this dataset
         X_max: the maximum pixel value of this dataset
+        executor: optional thread pool with which the files are decoded concurrently
+        dtype: the data type of the batch
     return: 
         X: a batch of image data with dimensions (batchsize, x-dim, y-dim, [z-dim], channels)
     '''
-    X = []
-    for i in range(0, batchsize):
-        img_file = train_image_file[i]
-        image_data = import_image(data_path + folder_name + img_file)
-        if np.shape(image_data) != tuple(Training_Input_shape):
-            #The Resizing fundtion changes the array values, therefore shift them back to the original range
-            min_value = np.min(image_data)
-            max_value = np.max(image_data)
-            image_data = resize(image_data, Training_Input_shape)
-            newmin = np.min(image_data)
-            newmax = np.max(image_data)
-            image_data = ((image_data - newmin) / (newmax - newmin)) * (max_value - min_value) + min_value
-        image_data = (image_data - X_min) / (X_max - X_min)
-        X.append(image_data)
-    X = np.stack(X, axis = 0)
-    if np.shape(X)[-1] != num_channels:
-       X= X[..., np.newaxis]
-    return X
+    path_names = [data_path + folder_name + train_image_file[i] for i in range(0, batchsize)]
+    X = allocate_batch(batchsize, Training_Input_shape, dtype)
+    if executor is None:
+        for i, path_name in enumerate(path_names):
+            load_image(path_name, Training_Input_shape, X_min, X_max, X[i])
+    else:
+        list(executor.map(lambda i: load_image(path_names[i], Training_Input_shape, X_min, X_max, X[i]), range(batchsize)))
+    return add_channel_axis(X, num_channels)
+
+
+class DataSequence(Sequence):
+    '''
+    Base class of the index based loaders
+    Each batch is loaded from its index, so that workers of fit_generator with use_multiprocessing=True
+    load distinct batches in parallel. The last batch contains the remaining files if the number of files
+    is not a multiple of the batchsize
+    The files of a batch are decoded concurrently in a thread pool across all data folders and the next
+    batch can be decoded in advance while the current batch is augmented
+    The batches are written into a ring of preallocated float32 buffers, the image folders directly into their
+    channel slices of X and the groundtruth into Y. A buffer is reused ring_size batches later, therefore
+    __getitem__ returns the batches as owned arrays, which stay valid while the queue of fit_generator holds them
+
+    Args
+        train_image_files: list of files in the dataset
+        batchsize: the batchsize used for training
+        data_path: path to the project directory
+        folders: list of (folder index, folder name, image shape, number of channels) of the existing data folders
+        X_min: array with the minimum pixel value of each folder
+        X_max: array with the maximum pixel value of each folder
+        shuffle: if True the order of the files is shuffled after each epoch
+        decode_threads: number of threads which decode the files of a batch, 1 decodes the files sequentially
+        prefetch: if True the next batch is decoded while the current batch is augmented
+        dataset_cache: if True the files are decoded and resized once into a HDF5 file in the cache folder
+                        of the project directory, from which the batches are read
+        augment_workers: number of processes which augment the batches, 0 augments in the loading thread
+        augmentation_variants: number of augmented variants of each file, which are written once to a HDF5 file in the
+                        cache folder of the project directory and read instead of augmenting the batches, 0 augments every batch
+        augmentation_refresh: a new set of variants is written in the background after every augmentation_refresh epochs,
+                        0 keeps the variants for the whole training
+        ring_size: number of preallocated batch buffers, also the number of batches which are augmented at once
+        dtype: data type of the returned batches, "float32" or "float16"
+    '''
+    def __init__(self, train_image_files, batchsize, data_path, folders, X_min, X_max,
+                        shuffle = True, decode_threads = 4, prefetch = False, dataset_cache = False,
+                        augment_workers = 0, augmentation_variants = 0, augmentation_refresh = 0,
+                        ring_size = 3, dtype = "float32"):
+        self.train_image_files = list(train_image_files)
+        self.batchsize = batchsize
+        self.data_path = data_path
+        self.folders = folders
+        self.X_min = X_min
+        self.X_max = X_max
+        self.shuffle = shuffle
+        self.decode_threads = decode_threads
+        self.prefetch = prefetch
+        self.augment_workers = augment_workers
+        if dataset_cache == True:
+            # The cache contains all files of the train folder, so it is shared by the training and validation data
+            self.dataset_cache = DatasetCache(data_path, folders, os.listdir(data_path + "/image/"),
+                                                load_resized_image, decode_threads)
+        else:
+            self.dataset_cache = None
+        # The image folders are concatenated along the channel axis of X, the groundtruth is stored in Y
+        self.layout = []
+        x_channels = 0
+        self.Y_shape = None
+        for index, folder_name, shape, num_channels in folders:
+            batch_shape = tuple(shape) if shape[-1] == num_channels else tuple(shape) + (1,)
+            if "groundtruth" in folder_name:
+                self.Y_shape = batch_shape
+                self.layout.append(("Y", slice(None)))
+            else:
+                self.X_shape = batch_shape[:-1] + (x_channels + batch_shape[-1],)
+                self.layout.append(("X", slice(x_channels, x_channels + batch_shape[-1])))
+                x_channels += batch_shape[-1]
+        self.ring_size = ring_size
+        self.dtype = get_dtype(dtype)
+        self.indexes = np.arange(len(self.train_image_files))
+        self._reset_workers()
+        self.augmentation_cache = None
+        self.on_epoch_end()
+        # The variants are written once the sequence is complete, as they are loaded and augmented with its buffers
+        if augmentation_variants > 0:
+            self.augmentation_cache = AugmentationCache(self, augmentation_variants, augmentation_refresh)
+
+    def __len__(self):
+        return int(np.ceil(len(self.train_image_files) / float(self.batchsize)))
+
+    def __getstate__(self):
+        # Thread pools and locks can not be copied to other processes, they are recreated when needed
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_lock"] = None
+        state["_prefetched"] = None
+        state["_ring"] = None
+        state["_augmentation_pool"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_workers()
+
+    def _reset_workers(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._prefetched = None
+        self._ring = [None] * self.ring_size
+        self._ring_position = 0
+        self._augmentation_pool = None
+        self._pid = os.getpid()
+
+    def executor(self):
+        '''
+        Returns the decoding thread pool of this process, after a fork the thread pool is created again
+        '''
+        if self._pid != os.getpid():
+            self._reset_workers()
+        if self.decode_threads <= 1:
+            return None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = self.decode_threads)
+        return self._executor
+
+    def augmentation_pool(self):
+        '''
+        Returns the augmentation process pool of this process, None if the batches are augmented in the loading thread
+        Daemonic processes, e.g. the workers of keras with use_multiprocessing, can not start worker processes
+        '''
+        if self._pid != os.getpid():
+            self._reset_workers()
+        if self.augment_workers <= 0 or multiprocessing.current_process().daemon == True:
+            return None
+        with self._lock:
+            if self._augmentation_pool is None:
+                self._augmentation_pool = AugmentationPool(self.batchsize, self.X_shape, self.Y_shape, self.data_gen_args,
+                                                            self.augment_workers, depth = self.ring_size)
+        return self._augmentation_pool
+
+    def augment_batch(self, train_image_file, X, Y):
+        '''
+        Augments a batch with data_augentation, in the augmentation process pool if augment_workers is set
+        If Y is None only X is augmented and None is returned for Y
+        '''
+        data_path_file_name = self.data_path + str(tuple(train_image_file))
+        augmentation_pool = self.augmentation_pool()
+        if augmentation_pool is not None:
+            return augmentation_pool.augment(X, Y, data_path_file_name)
+        if Y is None:
+            return data_augentation(X, X, self.data_gen_args, data_path_file_name)[0], None
+        return data_augentation(X, Y, self.data_gen_args, data_path_file_name)
+
+    def augmented_batch(self, batch_index):
+        '''
+        Returns the files and the augmented batches X and Y of a batch
+        With the augmentation cache a random variant of each file is read instead
+        '''
+        if self.augmentation_cache is not None:
+            train_image_file = self.batch_files(batch_index)
+            X, Y = self.augmentation_cache.read(train_image_file, batch_index)
+            return train_image_file, X, Y
+        train_image_file, X, Y = self.load_batch(batch_index)
+        X, Y = self.augment_batch(train_image_file, X, Y)
+        return train_image_file, X, Y
+
+    def close(self):
+        '''
+        Stops the augmentation worker processes and the writing of the augmented variants
+        '''
+        if self._augmentation_pool is not None:
+            self._augmentation_pool.close()
+            self._augmentation_pool = None
+        if self.augmentation_cache is not None:
+            self.augmentation_cache.close()
+
+    def on_epoch_end(self):
+        if self.shuffle == True:
+            np.random.shuffle(self.indexes)
+        if self._prefetched is not None:
+            # Wait until the discarded batch is written, so that its buffer can be reused
+            for future in self._prefetched[1][1][2]:
+                future.result()
+        self._prefetched = None
+        if self.augmentation_cache is not None:
+            self.augmentation_cache.on_epoch_end(self)
+
+    def batch_files(self, batch_index):
+        return [self.train_image_files[i] for i in self.indexes[batch_index * self.batchsize:(batch_index + 1) * self.batchsize]]
+
+    def ring_buffers(self, batchsize):
+        '''
+        Returns the next X and Y buffers of the ring, which are allocated when they are used for the first time
+        '''
+        with self._lock:
+            position = self._ring_position
+            self._ring_position = (position + 1) % self.ring_size
+            if self._ring[position] is None:
+                X = allocate_batch(self.batchsize, self.X_shape, np.float32)
+                Y = allocate_batch(self.batchsize, self.Y_shape, np.float32) if self.Y_shape is not None else None
+                self._ring[position] = (X, Y)
+            X, Y = self._ring[position]
+        return X[:batchsize], (Y[:batchsize] if Y is not None else None)
+
+    def submit_batch(self, batch_index, executor):
+        '''
+        Starts decoding the files of a batch in all data folders
+        '''
+        return self.submit_files(self.batch_files(batch_index), executor)
+
+    def submit_files(self, train_image_file, executor):
+        '''
+        Starts decoding the given files in all data folders
+        Each file is written directly into its channel slice of the batch buffer
+        '''
+        X, Y = self.ring_buffers(len(train_image_file))
+        futures = []
+        for (index, folder_name, shape, num_channels), (output, channels) in zip(self.folders, self.layout):
+            batch = (Y if output == "Y" else X)[..., channels]
+            if self.dataset_cache is not None:
+                normalize_image(self.dataset_cache.read(folder_name, train_image_file), self.X_min[index], self.X_max[index], batch)
+                continue
+            for i, img_file in enumerate(train_image_file):
+                path_name = self.data_path + folder_name + img_file
+                if executor is None:
+                    load_image(path_name, shape, self.X_min[index], self.X_max[index], batch[i])
+                else:
+                    futures.append(executor.submit(load_image, path_name, shape, self.X_min[index], self.X_max[index], batch[i]))
+        return train_image_file, (X, Y, futures)
+
+    def load_files(self, train_image_file):
+        '''
+        Decodes the given files into the next batch buffers and returns the batches X and Y
+        '''
+        train_image_file, (X, Y, futures) = self.submit_files(train_image_file, self.executor())
+        for future in futures:
+            future.result()
+        return X, Y
+
+    def load_batch(self, batch_index):
+        '''
+        Returns the files of a batch, the batch of the image folders X and of the groundtruth Y
+        Y is None if there is no groundtruth folder
+        '''
+        executor = self.executor()
+        with self._lock:
+            prefetched = self._prefetched
+            self._prefetched = None
+        if prefetched is not None and prefetched[0] == batch_index:
+            train_image_file, (X, Y, futures) = prefetched[1]
+        else:
+            train_image_file, (X, Y, futures) = self.submit_batch(batch_index, executor)
+        if executor is not None and self.prefetch == True and batch_index + 1 < len(self):
+            next_batch = self.submit_batch(batch_index + 1, executor)
+            with self._lock:
+                self._prefetched = (batch_index + 1, next_batch)
+        for future in futures:
+            future.result()
+        return train_image_file, X, Y
+
+
+class TrainingDataSequence(DataSequence):
+    '''
+    Index based loader of images and groundtruth for regression and segmentation
+
+    Args
+        Training_Input_shape: The dimensions of one image used for training. Can be set in the config.json file
+        batchsize: the batchsize used for training
+        num_channels: the number of channels of one image. Typically 1 (grayscale) or 3 (rgb)
+        num_channels_label: the number of channels of one groundtruth image. Typically 1 (grayscale) or 3 (rgb)
+        train_image_files: list of files in the training dataset
+        data_gen_args: augmentation arguments
+        data_dimensions: the dimensions of one image or the dimension to which the image should be resized
+        data_path: path to the project directory
+        use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        normalization_args: settings for the computation of the min and max values used for normalization
+        shuffle: if True the order of the files is shuffled after each epoch
+        decode_threads: number of threads which decode the files of a batch, 1 decodes the files sequentially
+        prefetch: if True the next batch is decoded while the current batch is augmented
+        dataset_cache: if True the batches are read from a pre-decoded HDF5 copy of the train folder
+        augment_workers: number of processes which augment the batches, 0 augments in the loading thread
+        augmentation_variants: number of augmented variants of each file which are cached, 0 augments every batch
+        augmentation_refresh: a new set of variants is written in the background after every augmentation_refresh epochs
+        dtype: data type of the returned batches, "float32" or "float16"
+    '''
+    Folder_Names = ["/groundtruth/", "/image/", "/image1/", "/image2/", "/image3/", "/image4/", "/image5/", "/image6/", "/image7/"]
+
+    def __init__(self, Training_Input_shape, batchsize, num_channels,
+                        num_channels_label, train_image_files,
+                        data_gen_args, data_dimensions, data_path, use_algorithm,
+                        normalization_args = None, shuffle = True, decode_threads = 4, prefetch = False,
+                        dataset_cache = False, augment_workers = 0, augmentation_variants = 0, augmentation_refresh = 0,
+                        dtype = "float32"):
+        self.Training_Input_shape = Training_Input_shape
+        self.num_channels = num_channels
+        self.num_channels_label = num_channels_label
+        self.data_gen_args = data_gen_args
+        self.data_dimensions = data_dimensions
+        self.use_algorithm = use_algorithm
+        # The statistics are computed on all files in the train folder, so the validation data reuses them
+        X_min, X_max = get_dataset_min_max(data_path, self.Folder_Names, os.listdir(data_path + "/image/"),
+                                                normalization_args = normalization_args)
+        folders = []
+        for index, folder_name in enumerate(self.Folder_Names):
+            if os.path.isdir(data_path + folder_name) == True:
+                if "groundtruth" in folder_name:
+                    GT_Input_image_shape = np.array(copy.deepcopy(Training_Input_shape))
+                    GT_Input_image_shape[-1] = num_channels_label
+                    GT_Input_image_shape = tuple(GT_Input_image_shape)
+                    if GT_Input_image_shape[-1] == 0:
+                        GT_Input_image_shape = GT_Input_image_shape[0:-1]
+                    folders.append((index, folder_name, GT_Input_image_shape, num_channels_label))
+                else:
+                    folders.append((index, folder_name, Training_Input_shape, num_channels))
+        super(TrainingDataSequence, self).__init__(train_image_files, batchsize, data_path, folders, X_min, X_max,
+                                                    shuffle = shuffle, decode_threads = decode_threads, prefetch = prefetch,
+                                                    dataset_cache = dataset_cache, augment_workers = augment_workers,
+                                                    augmentation_variants = augmentation_variants,
+                                                    augmentation_refresh = augmentation_refresh, dtype = dtype)
+
+    def __getitem__(self, batch_index):
+        train_image_file, X_train, Y = self.augmented_batch(batch_index)
+        X_train = np.nan_to_num(X_train, copy = False)
+        Y = np.nan_to_num(Y, copy = False)
+        # The ring buffers are reused, so the batch is returned as a copy
+        return (X_train.astype(self.dtype), Y.astype(self.dtype))
+
+
+class PatchDataSequence(TrainingDataSequence):
+    '''
+    Index based loader of random patches of images and groundtruth for regression and segmentation
+    Instead of resizing the images to the Training_Input_shape, one epoch consists of patches_per_epoch patches
+    of the patch_size, which are cropped from random positions of images of any size. The images are drawn with
+    a probability proportional to their size. Only the region of the patch is read from .npy and uncompressed
+    tiff files, so the training cost scales with the patch size and not with the image size
+
+    Args
+        patch_size: the spatial dimensions of one patch, e.g. [256, 256]
+        batchsize: the batchsize used for training
+        num_channels: the number of channels of one image. Typically 1 (grayscale) or 3 (rgb)
+        num_channels_label: the number of channels of one groundtruth image. Typically 1 (grayscale) or 3 (rgb)
+        train_image_files: list of files in the training dataset
+        data_gen_args: augmentation arguments
+        data_dimensions: the dimensions of one image
+        data_path: path to the project directory
+        use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        patches_per_epoch: the number of patches in one epoch
+        normalization_args: settings for the computation of the min and max values used for normalization
+        shuffle: if True new patch positions are drawn after each epoch, else the same patches are used in every epoch
+        decode_threads: number of threads which decode the files of a batch, 1 decodes the files sequentially
+        prefetch: if True the next batch is decoded while the current batch is augmented
+        augment_workers: number of processes which augment the batches, 0 augments in the loading thread
+        dtype: data type of the returned batches, "float32" or "float16"
+    '''
+    def __init__(self, patch_size, batchsize, num_channels,
+                        num_channels_label, train_image_files,
+                        data_gen_args, data_dimensions, data_path, use_algorithm,
+                        patches_per_epoch = 1000, normalization_args = None, shuffle = True,
+                        decode_threads = 4, prefetch = False, augment_workers = 0, dtype = "float32"):
+        self.patch_size = tuple(patch_size)
+        self.patches_per_epoch = patches_per_epoch
+        self.seed = 0
+        image_shapes = [get_image_shape(data_path + "/image/" + img_file)[:len(self.patch_size)] for img_file in train_image_files]
+        self.image_weights = np.array([np.prod(image_shape) for image_shape in image_shapes], dtype = np.float64)
+        self.image_weights /= np.sum(self.image_weights)
+        self.image_shapes = image_shapes
+        super(PatchDataSequence, self).__init__(self.patch_size + (num_channels,), batchsize, num_channels,
+                                                num_channels_label, train_image_files,
+                                                data_gen_args, data_dimensions, data_path, use_algorithm,
+                                                normalization_args = normalization_args, shuffle = shuffle,
+                                                decode_threads = decode_threads, prefetch = prefetch,
+                                                augment_workers = augment_workers, dtype = dtype)
+
+    def __len__(self):
+        return int(np.ceil(self.patches_per_epoch / float(self.batchsize)))
+
+    def on_epoch_end(self):
+        if self.shuffle == True:
+            self.seed = np.random.randint(0, 2**31 - 1)
+        super(PatchDataSequence, self).on_epoch_end()
+
+    def patch_positions(self, batch_index):
+        '''
+        Returns the files and corners of the patches of a batch
+        The positions only depend on the epoch and the batch index, so that each worker draws the same patches
+        '''
+        random_state = np.random.RandomState((self.seed + batch_index) % 2**32)
+        num_patches = min(self.batchsize, self.patches_per_epoch - batch_index * self.batchsize)
+        files = random_state.choice(len(self.train_image_files), num_patches, p = self.image_weights)
+        corners = [tuple(random_state.randint(0, max(size - patch, 0) + 1) for size, patch in zip(self.image_shapes[i], self.patch_size))
+                        for i in files]
+        return [self.train_image_files[i] for i in files], corners
+
+    def submit_batch(self, batch_index, executor):
+        '''
+        Starts reading the patches of a batch in all data folders
+        '''
+        train_image_file, corners = self.patch_positions(batch_index)
+        X, Y = self.ring_buffers(len(train_image_file))
+        futures = []
+        for (index, folder_name, shape, num_channels), (output, channels) in zip(self.folders, self.layout):
+            batch = (Y if output == "Y" else X)[..., channels]
+            for i, (img_file, corner) in enumerate(zip(train_image_file, corners)):
+                args = (self.data_path + folder_name + img_file, corner, self.patch_size, self.X_min[index], self.X_max[index], batch[i])
+                if executor is None:
+                    load_patch(*args)
+                else:
+                    futures.append(executor.submit(load_patch, *args))
+        return train_image_file, (X, Y, futures)
 
 
 def training_data_generator(Training_Input_shape, batchsize, num_channels, 
                             num_channels_label, train_image_files, 
-                            data_gen_args, data_dimensions,data_path, use_algorithm):
+                            data_gen_args, data_dimensions,data_path, use_algorithm,
+                            normalization_args = None):
     '''
     Generate the data for training and return images and groundtruth 
     for regression and segmentation
+    The batches are loaded with the TrainingDataSequence, which should be used directly with fit_generator
 
     Args
         Training_Input_shape: The dimensions of one image used for training. Can be set in the config.json file
@@ -126,51 +681,117 @@ def training_data_generator(Training_Input_shape, batchsize, num_channels,
         data_dimensions: the dimensions of one image or the dimension to which the image should be resized
         data_path: path to the project directory
         use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        normalization_args: settings for the computation of the min and max values used for normalization
     
     return: 
         X_train: batched training data
         Y: label or ground truth
     '''
-    Folder_Names = ["/groundtruth/", "/image/", "/image1/", "/image2/", "/image3/", "/image4/", "/image5/", "/image6/", "/image7/"]
-    X_min = np.zeros((len(Folder_Names)))
-    X_max = np.zeros((len(Folder_Names)))
-    for i, folder_name in enumerate(Folder_Names):
-        if os.path.isdir(data_path + folder_name) == True:
-            X_min[i], X_max[i] = get_min_max(data_path, folder_name, train_image_files)
-
+    sequence = TrainingDataSequence(Training_Input_shape, batchsize, num_channels,
+                                    num_channels_label, train_image_files,
+                                    data_gen_args, data_dimensions, data_path, use_algorithm,
+                                    normalization_args = normalization_args, shuffle = False)
     while True:
-        def grouped(train_image_files, batchsize):
-            return zip(*[iter(train_image_files)] * batchsize)
-        for train_image_file in grouped(train_image_files, batchsize):
-            for index, folder_name in enumerate(Folder_Names):
-                if os.path.isdir(data_path + folder_name) == True:
-                    if "groundtruth" in folder_name:
-                        GT_Input_image_shape = np.array(copy.deepcopy(Training_Input_shape))
-                        GT_Input_image_shape[-1] = num_channels_label
-                        GT_Input_image_shape = tuple(GT_Input_image_shape)
-                        if GT_Input_image_shape[-1] == 0:
-                            GT_Input_image_shape = GT_Input_image_shape[0:-1]
-                        Y = image_generator(GT_Input_image_shape, batchsize, num_channels_label, 
-                                                train_image_file, folder_name, data_path, X_min[index], X_max[index], use_algorithm)
-                    if "image" in folder_name and index > 1:
-                        imp = image_generator(Training_Input_shape, batchsize, num_channels, train_image_file, 
-                                                folder_name, data_path, X_min[index], X_max[index], use_algorithm)
-                        X = np.concatenate([X, imp], axis = -1)
-                    if "image" in folder_name and index == 1:
-                        X = image_generator(Training_Input_shape, batchsize, num_channels, 
-                        train_image_file, folder_name, data_path, X_min[index], X_max[index], use_algorithm)
-            X_train, Y = data_augentation(X, Y, data_gen_args, data_path + str(train_image_file))
-            X_train = np.nan_to_num(X_train)
-            Y = np.nan_to_num(Y)
-            yield (X_train, Y)
+        for index in range(len(sequence)):
+            yield sequence[index]
+
+
+def load_classification_labels(csvfilepath, image_files):
+    '''
+    Parses the groundtruth.csv file once into an index from filename to label
+    The index is checked at startup so that missing or duplicate labels fail immediately
+
+    Args
+        csvfilepath: path to the groundtruth.csv file with the columns filename and groundtruth
+        image_files: list of filenames which need a label
+
+    return:
+        label_index: dictionary containing the label of each filename
+    '''
+    label_index = dict()
+    with open(csvfilepath) as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if row['filename'] in label_index:
+                raise ValueError("The file %s has more than one label in %s" % (row['filename'], csvfilepath))
+            label_index[row['filename']] = int(float(row['groundtruth']))
+    missing_labels = [img_file for img_file in image_files if img_file not in label_index]
+    if len(missing_labels) > 0:
+        raise KeyError("%s files have no label in %s, e.g.: %s" % (len(missing_labels), csvfilepath, missing_labels[:5]))
+    logging.info("Imported %s labels from %s" % (len(label_index), csvfilepath))
+    return label_index
+
+
+class ClassificationDataSequence(DataSequence):
+    '''
+    Index based loader of images and labels for classification
+
+    Args
+        Training_Input_shape: The dimensions of one image used for training. Can be set in the config.json file
+        batchsize: the batchsize used for training
+        num_channels: the number of channels of one image. Typically 1 (grayscale) or 3 (rgb)
+        num_classes: the number of classes of the dataset, set in the config.json
+        train_image_files: list of filenames in the training dataset
+        data_gen_args: augmentation arguments
+        data_path: path to the project directory
+        use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        normalization_args: settings for the computation of the min and max values used for normalization
+        label_index: dictionary from filename to label, if None it is imported from the groundtruth.csv file
+        shuffle: if True the order of the files is shuffled after each epoch
+        decode_threads: number of threads which decode the files of a batch, 1 decodes the files sequentially
+        prefetch: if True the next batch is decoded while the current batch is augmented
+        dataset_cache: if True the batches are read from a pre-decoded HDF5 copy of the train folder
+        augment_workers: number of processes which augment the batches, 0 augments in the loading thread
+        augmentation_variants: number of augmented variants of each file which are cached, 0 augments every batch
+        augmentation_refresh: a new set of variants is written in the background after every augmentation_refresh epochs
+        dtype: data type of the returned batches, "float32" or "float16"
+    '''
+    Folder_Names = ["/image/", "/image1/", "/image2/", "/image3/", "/image4/", "/image5/", "/image6/", "/image7/"]
+
+    def __init__(self, Training_Input_shape, batchsize, num_channels,
+                        num_classes, train_image_files,
+                        data_gen_args, data_path, use_algorithm,
+                        normalization_args = None, label_index = None, shuffle = True,
+                        decode_threads = 4, prefetch = False, dataset_cache = False, augment_workers = 0,
+                        augmentation_variants = 0, augmentation_refresh = 0, dtype = "float32"):
+        self.Training_Input_shape = Training_Input_shape
+        self.num_channels = num_channels
+        self.num_classes = num_classes
+        self.data_gen_args = data_gen_args
+        self.use_algorithm = use_algorithm
+        csvfilepath = os.path.join(data_path + '/groundtruth/', 'groundtruth.csv')
+        if label_index is None:
+            label_index = load_classification_labels(csvfilepath, train_image_files)
+        self.label_index = label_index
+        # The statistics are computed on all files in the train folder, so the validation data reuses them
+        X_min, X_max = get_dataset_min_max(data_path, self.Folder_Names, os.listdir(data_path + "/image/"),
+                                                normalization_args = normalization_args)
+        logging.info("array of min values: %s" % X_min)
+        logging.info("array of max values: %s" % X_max)
+        folders = [(index, folder_name, Training_Input_shape, num_channels) for index, folder_name in enumerate(self.Folder_Names)
+                        if os.path.isdir(data_path + folder_name) == True]
+        super(ClassificationDataSequence, self).__init__(train_image_files, batchsize, data_path, folders, X_min, X_max,
+                                                    shuffle = shuffle, decode_threads = decode_threads, prefetch = prefetch,
+                                                    dataset_cache = dataset_cache, augment_workers = augment_workers,
+                                                    augmentation_variants = augmentation_variants,
+                                                    augmentation_refresh = augmentation_refresh, dtype = dtype)
+
+    def __getitem__(self, batch_index):
+        train_image_file, X, Trash = self.augmented_batch(batch_index)
+        label = np.array([self.label_index[img_file] for img_file in train_image_file])
+        label = to_categorical(label, self.num_classes)
+        # The ring buffers are reused, so the batch is returned as a copy
+        return (X.astype(self.dtype), label.astype(self.dtype, copy = False))
 
 
 def training_data_generator_classification(Training_Input_shape, 
                                             batchsize, num_channels, 
                                             num_classes, train_image_files, 
-                                            data_gen_args, data_path, use_algorithm):
+                                            data_gen_args, data_path, use_algorithm,
+                                            normalization_args = None, label_index = None):
     '''
     Generate the data for training and return images and groundtruth for classification
+    The batches are loaded with the ClassificationDataSequence, which should be used directly with fit_generator
 
     Args
         Training_Input_shape: The dimensions of one image used for training. Can be set in the config.json file
@@ -181,50 +802,122 @@ def training_data_generator_classification(Training_Input_shape,
         data_gen_args: augmentation arguments
         data_path: path to the project directory
         use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        normalization_args: settings for the computation of the min and max values used for normalization
+        label_index: dictionary from filename to label, if None it is imported from the groundtruth.csv file
     
     return: 
         X: batched training data
         Y: groundtruth labels
     '''
-    csvfilepath = os.path.join(data_path + '/groundtruth/', 'groundtruth.csv')
-    Folder_Names = ["/image/", "/image1/", "/image2/", "/image3/", "/image4/", "/image5/", "/image6/", "/image7/"]
-    X_min = np.zeros((len(Folder_Names)))
-    X_max = np.zeros((len(Folder_Names)))
-    for i, folder_name in enumerate(Folder_Names):
-        if os.path.isdir(data_path + folder_name) == True:
-            X_min[i], X_max[i] = get_min_max(data_path, folder_name, train_image_files)
-    logging.info("array of min values: %s" % X_min)
-    logging.info("array of max values: %s" % X_max)
+    sequence = ClassificationDataSequence(Training_Input_shape, batchsize, num_channels,
+                                            num_classes, train_image_files,
+                                            data_gen_args, data_path, use_algorithm,
+                                            normalization_args = normalization_args,
+                                            label_index = label_index, shuffle = False)
     while True:
-        def grouped(train_image_files, batchsize):
-            return zip(*[iter(train_image_files)] * batchsize)
-        for train_image_file in grouped(train_image_files, batchsize):
-            for index, folder_name in enumerate(Folder_Names):
-                if os.path.isdir(data_path + folder_name) == True:
-                    if "image" in folder_name and index > 0:
-                        imp = image_generator(Training_Input_shape, batchsize, num_channels, 
-                                                        train_image_file, folder_name, data_path, 
-                                                        X_min[index], X_max[index], use_algorithm)
-                                                        
-                        X = np.concatenate([X, imp], axis = -1)
-                    if "image" in folder_name and index == 0:
-                        X = image_generator(Training_Input_shape, batchsize, num_channels, 
-                        train_image_file, folder_name, data_path, X_min[index], X_max[index], use_algorithm)
-            
-            X, Trash = data_augentation(X, X, data_gen_args, data_path + str(train_image_file))
-            label = np.zeros((batchsize))
-            for j in range(0, batchsize):
-                img_file = train_image_file[j]
-                with open(csvfilepath) as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        if row['filename'] == img_file:
-                            label[j] = row['groundtruth']
-            label = to_categorical(label, num_classes)
-            yield (X, label)
-
- 
-def testGenerator(Input_image_shape, path, num_channels, test_image_files, use_algorithm):
+        for index in range(len(sequence)):
+            yield sequence[index]
+
+
+class TestDataSequence(DataSequence):
+    '''
+    Index based loader of batches of test images for segmentation, regression and classification
+    If Input_image_shape is given all images are resized to it, else the images keep their original size and
+    images of the same size are bucketed together, so each batch contains images of one size. The last batch
+    of each bucket contains the remaining images. The images are predicted in the order of test_image_files of
+    the sequence, which differs from the given order if the images are bucketed
+
+    Args
+        Input_image_shape: The dimensions of one image used for training or None to keep the original sizes
+        batchsize: the number of images in one batch
+        path: path to the project directory
+        num_channels: the number of channels of one image. Typically 1 (grayscale) or 3 (rgb)
+        test_image_files: list of filenames in the test dataset
+        use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        normalization_args: settings for the computation of the min and max values used for normalization
+        dataset_cache: if True the resized images are read from a pre-decoded HDF5 copy of the test folder
+        decode_threads: number of threads which decode the files of a batch, 1 decodes the files sequentially
+        dtype: data type of the returned batches, "float32" or "float16"
+    '''
+    Folder_Names = ["/image/", "/image1/", "/image2/", "/image3/", "/image4/", "/image5/", "/image6/", "/image7/"]
+
+    def __init__(self, Input_image_shape, batchsize, path, num_channels, test_image_files, use_algorithm,
+                        normalization_args = None, dataset_cache = False, decode_threads = 4, dtype = "float32"):
+        test_path = path + "/test/"
+        self.use_algorithm = use_algorithm
+        self.num_channels = num_channels
+        test_image_files = list(test_image_files)
+        X_min, X_max = get_dataset_min_max(test_path, self.Folder_Names, test_image_files,
+                                            normalization_args = normalization_args)
+        if Input_image_shape is None:
+            buckets = dict()
+            for img_file in test_image_files:
+                image_shape = tuple(get_image_shape(test_path + "/image/" + img_file))
+                if image_shape[-1] == 4:
+                    image_shape = image_shape[:-1] + (3,)
+                buckets.setdefault(image_shape, []).append(img_file)
+            folder_shape = (num_channels,)
+        else:
+            buckets = {tuple(Input_image_shape): test_image_files}
+            folder_shape = tuple(Input_image_shape)
+        self.batches = []
+        self.image_shapes = []
+        for image_shape, files in buckets.items():
+            for start in range(0, len(files), batchsize):
+                self.batches.append(files[start:start + batchsize])
+                self.image_shapes.append(image_shape)
+        folders = [(index, folder_name, folder_shape, num_channels) for index, folder_name in enumerate(self.Folder_Names)
+                        if os.path.isdir(test_path + folder_name) == True]
+        super(TestDataSequence, self).__init__(sum(self.batches, []), batchsize, test_path, folders, X_min, X_max,
+                                                shuffle = False, decode_threads = decode_threads,
+                                                dataset_cache = dataset_cache and Input_image_shape is not None,
+                                                dtype = dtype)
+        logging.info("Testing on %s files in %s batches" % (len(self.train_image_files), len(self.batches)))
+
+    @property
+    def test_image_files(self):
+        return self.train_image_files
+
+    def __len__(self):
+        return len(self.batches)
+
+    def batch_files(self, batch_index):
+        return self.batches[batch_index]
+
+    def image_shape(self, batch_index):
+        return self.image_shapes[batch_index]
+
+    def submit_batch(self, batch_index, executor):
+        '''
+        Starts decoding the files of a batch in all image folders
+        A new batch is allocated for each batch, as predict_generator queues the batches
+        '''
+        train_image_file = self.batch_files(batch_index)
+        image_shape = self.image_shape(batch_index)
+        spatial_shape = image_shape[:-1] if image_shape[-1] == self.num_channels else image_shape
+        X = allocate_batch(len(train_image_file), spatial_shape + (self.X_shape[-1],))
+        futures = []
+        for (index, folder_name, shape, num_channels), (output, channels) in zip(self.folders, self.layout):
+            batch = X[..., channels]
+            if self.dataset_cache is not None:
+                normalize_image(self.dataset_cache.read(folder_name, train_image_file), self.X_min[index], self.X_max[index], batch)
+                continue
+            for i, img_file in enumerate(train_image_file):
+                args = (self.data_path + folder_name + img_file, image_shape, self.X_min[index], self.X_max[index], batch[i])
+                if executor is None:
+                    load_image(*args)
+                else:
+                    futures.append(executor.submit(load_image, *args))
+        return train_image_file, (X, None, futures)
+
+    def __getitem__(self, batch_index):
+        train_image_file, X, Y = self.load_batch(batch_index)
+        # The ring buffers are reused, so the batch is returned as a copy
+        return np.nan_to_num(X, copy = False).astype(self.dtype)
+
+
+def testGenerator(Input_image_shape, path, num_channels, test_image_files, use_algorithm,
+                                            normalization_args = None, dataset_cache = False, dtype = "float32"):
     '''
     Generate test images for segmentation, regression and classification
 
@@ -234,33 +927,44 @@ def testGenerator(Input_image_shape, path, num_channels, test_image_files, use_a
         num_channels: the number of channels of one image. Typically 1 (grayscale) or 3 (rgb)
         test_image_files: list of filenames in the test dataset
         use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        normalization_args: settings for the computation of the min and max values used for normalization
+        dataset_cache: if True the images are read from a pre-decoded HDF5 copy of the test folder
+        dtype: data type of the returned images, "float32" or "float16"
     
     return: 
         X: one image on which a model prediction is executed
     '''
     test_path = path + "/test/"
     batchsize = 1
+    dtype = get_dtype(dtype)
     Folder_Names = ["/image/", "/image1/", "/image2/", "/image3/", 
                         "/image4/", "/image5/", "/image6/", "/image7/"]
-    X_min = np.zeros((len(Folder_Names)))
-    X_max = np.zeros((len(Folder_Names)))
-    for i, folder_name in enumerate(Folder_Names):
-        if os.path.isdir(test_path + folder_name) == True:
-            X_min[i], X_max[i] = get_min_max(test_path, folder_name, test_image_files)
+    X_min, X_max = get_dataset_min_max(test_path, Folder_Names, test_image_files,
+                                        normalization_args = normalization_args)
     logging.info(test_image_files)
     logging.info("len test files %s" % len(test_image_files))
+    cache = None
+    if dataset_cache == True:
+        folders = [(index, folder_name, Input_image_shape, num_channels) for index, folder_name in enumerate(Folder_Names)
+                        if os.path.isdir(test_path + folder_name) == True]
+        cache = DatasetCache(test_path, folders, test_image_files, load_resized_image)
     while True:
         for test_file in test_image_files:
             test_file = [test_file]
             for index, folder_name in enumerate(Folder_Names):
                 if os.path.isdir(test_path + folder_name) == True:
-                    imp = image_generator(Input_image_shape, batchsize, num_channels, 
-                                    test_file, folder_name, test_path, X_min[index], X_max[index], use_algorithm)
+                    if cache is not None:
+                        imp = allocate_batch(batchsize, Input_image_shape)
+                        imp = normalize_image(cache.read(folder_name, test_file), X_min[index], X_max[index], imp)
+                        imp = add_channel_axis(imp, num_channels)
+                    else:
+                        imp = image_generator(Input_image_shape, batchsize, num_channels, 
+                                        test_file, folder_name, test_path, X_min[index], X_max[index], use_algorithm)
                     if index > 0 :
                         X = np.concatenate([X, imp], axis = -1)
                     else:
                         X = imp
-            yield X
+            yield X.astype(dtype, copy = False)
 
 
 def saveUncertainty(path, test_image_files, epi_uncertainty, ali_uncertainty):
@@ -281,21 +985,22 @@ def saveUncertainty(path, test_image_files, epi_uncertainty, ali_uncertainty):
             writer.writerow([test_image_files[i], np.mean(epi_uncertainty[i,...])+np.mean(ali_uncertainty[i,...]), np.mean(epi_uncertainty[i,...]), np.median(epi_uncertainty[i,...]), np.mean(ali_uncertainty[i,...]), np.median(ali_uncertainty[i,...])])
 
 
-def saveResult(path, test_image_files, results, Input_image_shape):
+def saveResult(path, test_image_files, results, Input_image_shape = None):
     '''
     saves the predicted segmentation or image to the Results 
                             folder in the project directory
+    The images are scaled one at a time, so that only one image is copied at once
     
     Args:
         path: path to the project directory
         test_image_files: list of filenames in the test dataset
         results: the predicted segmentation or image
         Input_image_shape: The dimensions of one image used for 
-                            training. Can be set in the config.json file
+                            training. Can be set in the config.json file.
+                            If None the predictions are saved in their own size
     
     return: None
     '''
-    results = results * 255.
     logging.info("Save result")
     os.makedirs(path, exist_ok=True)
     logging.info("shape npyfile %s" % (np.shape(results),))
@@ -304,16 +1009,183 @@ def saveResult(path, test_image_files, results, Input_image_shape):
         logging.info("filename %s" % test_image_files[i])
         titlenpy = (test_image_files[i] + "_predict")
         logging.info(i)
-        if np.shape(results)[-1] == 0:
-            results = results[:,:,:,0]
-        minnpy = np.min(results[i, ...])
-        maxnpy = np.max(results[i, ...])
-        npy_resized = np.squeeze(resize(results[i, ...], Input_image_shape))
+        result = np.asarray(results[i], dtype = np.float32) * np.float32(255.)
+        if Input_image_shape is None:
+            plottestimage_npy(np.squeeze(result).astype("uint8"), path, titlenpy)
+            continue
+        minnpy = np.min(result)
+        maxnpy = np.max(result)
+        npy_resized = np.squeeze(resize(result, Input_image_shape)).astype(np.float32)
         newmin = np.min(npy_resized)
         newmax = np.max(npy_resized)
         npy_resized = ((npy_resized - newmin) / (newmax - newmin)) * (maxnpy - minnpy) + minnpy
         plottestimage_npy(npy_resized.astype("uint8"), path, titlenpy)
 
+def predict_to_sink(model, test_sequence, sink):
+    '''
+    Predicts the test set batch by batch and hands the predictions of each batch to the sink
+    as soon as they are predicted, so that the memory does not grow with the number of test images
+
+    Args:
+        model: the trained model
+        test_sequence: TestDataSequence of the test set
+        sink: function which is called with the filenames and the predictions of each batch,
+                e.g. functools.partial(saveResult, path + "/results/", Input_image_shape = Input_image_shape)
+
+    return:
+        num_predicted: the number of predicted images
+    '''
+    num_predicted = 0
+    for batch_index in range(len(test_sequence)):
+        predictions = model.predict_on_batch(test_sequence[batch_index])
+        test_image_files = test_sequence.batch_files(batch_index)
+        sink(test_image_files, predictions)
+        num_predicted += len(test_image_files)
+        logging.info("Predicted %d of %d test images" % (num_predicted, len(test_sequence.test_image_files)))
+    return num_predicted
+
+class ResultWriter(object):
+    '''
+    Saves the predictions with a pool of writer threads, so that the predictions are resized and written
+    while the next batches are predicted. It can be used as the sink of predict_to_sink
+    The number of predictions which wait to be written is bounded, so that the memory does not grow
+    if the writers are slower than the model. Errors of the writers are raised in the calling thread
+    at the latest when the writer is closed
+
+    Args:
+        path: path to which the predictions are saved
+        Input_image_shape: the shape to which the predictions are resized, None to save them in their own size
+        writer_threads: the number of threads which save the predictions
+        max_pending: the maximal number of predictions which wait to be written, by default twice the number of threads
+    '''
+    def __init__(self, path, Input_image_shape = None, writer_threads = 4, max_pending = None):
+        self.path = path
+        self.Input_image_shape = Input_image_shape
+        if max_pending is None:
+            max_pending = 2 * writer_threads
+        self.executor = ThreadPoolExecutor(max_workers = writer_threads)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, test_image_file, result):
+        try:
+            saveResult(self.path, [test_image_file], result[np.newaxis], self.Input_image_shape)
+        finally:
+            self.pending.release()
+
+    def check(self):
+        '''
+        Raises the first error of the finished writes and forgets the finished writes
+        '''
+        running = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                running.append(future)
+        self.futures = running
+
+    def __call__(self, test_image_files, results):
+        self.check()
+        for test_image_file, result in zip(test_image_files, results):
+            self.pending.acquire()
+            self.futures.append(self.executor.submit(self.write, test_image_file, result))
+
+    def close(self):
+        '''
+        Waits until all predictions are written and raises the first error of the writers
+        '''
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown(wait = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original error behind an error of the writers
+            self.futures = []
+            self.executor.shutdown(wait = True)
+        return False
+
+class UncertaintyWriter(object):
+    '''
+    Saves the uncertainty estimates batch by batch. The summed uncertainty maps are saved to the uncertainty folder
+    with a ResultWriter and the statistics of each image are written to insights/uncertainty.csv
+    It can be used as the sink of mc_dropout_uncertainty
+
+    Args:
+        path: path to the project directory
+        Input_image_shape: the shape to which the uncertainty maps are resized
+        writer_threads: the number of threads which save the uncertainty maps
+    '''
+    def __init__(self, path, Input_image_shape = None, writer_threads = 4):
+        self.result_writer = ResultWriter(path + "/uncertainty/", Input_image_shape, writer_threads = writer_threads)
+        os.makedirs(path + "/insights/", exist_ok=True)
+        self.csv_file = open(path + "/insights/uncertainty.csv", 'w')
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(['filename', 'summed uncertainty', 'mean epistemic uncertainty', 'median epistemic uncertainty', 'mean aleatoric uncertainty', 'median aleatoric uncertainty'])
+
+    def __call__(self, test_image_files, epi_uncertainty, ali_uncertainty):
+        for i in range(len(test_image_files)):
+            self.csv_writer.writerow([test_image_files[i], np.mean(epi_uncertainty[i,...])+np.mean(ali_uncertainty[i,...]), np.mean(epi_uncertainty[i,...]), np.median(epi_uncertainty[i,...]), np.mean(ali_uncertainty[i,...]), np.median(ali_uncertainty[i,...])])
+        self.result_writer(test_image_files, epi_uncertainty + ali_uncertainty)
+
+    def close(self):
+        try:
+            self.result_writer.close()
+        finally:
+            self.csv_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.csv_file.close()
+        return self.result_writer.__exit__(exc_type, exc_value, traceback)
+
+class HeteroscedasticSink(object):
+    '''
+    Splits the predictions of a UNet with a heteroscedastic head into the prediction and the predicted
+    log variance. The prediction is handed to the result sink and the variance as aleatoric uncertainty
+    to the uncertainty sink, so that the uncertainty is estimated in a single forward pass.
+    A single forward pass has no epistemic uncertainty, which is therefore zero
+
+    Args:
+        result_sink: function which is called with the filenames and the predictions of each batch, e.g. ResultWriter
+        uncertainty_sink: function which is called with the filenames, the epistemic and the aleatoric uncertainty
+                            of each batch, e.g. UncertaintyWriter. None to discard the uncertainty
+    '''
+    def __init__(self, result_sink, uncertainty_sink = None):
+        self.result_sink = result_sink
+        self.uncertainty_sink = uncertainty_sink
+
+    def __call__(self, test_image_files, results):
+        results = np.asarray(results, dtype = np.float32)
+        channels = np.shape(results)[-1] // 2
+        self.result_sink(test_image_files, results[..., :channels])
+        if self.uncertainty_sink is not None:
+            aleatoric_uncertainty = np.exp(results[..., channels:])
+            self.uncertainty_sink(test_image_files, np.zeros_like(aleatoric_uncertainty), aleatoric_uncertainty)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.uncertainty_sink is not None:
+                self.uncertainty_sink.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.result_sink.__exit__(exc_type, exc_value, traceback)
+        return False
+
 def saveResult_classification(path, test_image_files, results):
     '''
     saves a .csv file to the results folder in the project directory
@@ -391,13 +1263,14 @@ def training_validation_data_split(data_path):
     return train_image_files, val_image_files
 
 
-def get_input_image_sizes(path, use_algorithm):
+def get_input_image_sizes(path, use_algorithm, check_size = True):
     '''
     Get the size of the input images and check dimensions
 
     Args:
         path: path to project directory
         use_algorithm: the selected network (UNet, ResNet50 or MRCNN)
+        check_size: if True the pixel dimensions need to be a power of two, this is not needed for patch based training
     
     return: 
         Training_Input_shape: the shape of the training data
@@ -406,9 +1279,9 @@ def get_input_image_sizes(path, use_algorithm):
     '''
     data_path = path + '/train'
     img_file = os.listdir(data_path + "/image/")[0]
-    Input_image_shape = np.array(np.shape(np.array(import_image(data_path + "/image/" + img_file))))
+    Input_image_shape = np.array(np.shape(import_image(data_path + "/image/" + img_file, mmap_mode = 'r')))
     logging.info("Input shape Input_image_shape %s" % Input_image_shape)
-    if use_algorithm in ["Regression", "Segmentation"]:
+    if use_algorithm in ["Regression", "Segmentation"] and check_size == True:
         logging.info("Input_image_shape %s" % Input_image_shape)
         if int(Input_image_shape[0]) not in [int(16), int(32),int(64),int(128),int(256),int(512),int(1024),int(2048)]:
             if int(Input_image_shape[1]) not in [int(16), int(32),int(64),int(128),int(256),int(512),int(1024),int(2048)]:
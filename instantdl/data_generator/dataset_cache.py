@@ -0,0 +1,132 @@
+'''
+InstantDL
+Pre-decoded dataset cache
+The files of the data folders are decoded and resized once and stored in a chunked HDF5 file
+in the cache folder of the project directory, from which the batches are read by slicing.
+The cache is rebuilt automatically when files are added, removed or modified.
+'''
+
+import numpy as np
+import h5py
+from concurrent.futures import ThreadPoolExecutor
+from instantdl.data_generator.dataset_statistics import folder_fingerprint
+import logging
+import os
+
+def get_cache_file(data_path):
+    '''
+    Returns the path of the HDF5 cache file for the train or test folder in the project directory
+    e.g. project/cache/train.h5
+    '''
+    project_path, split = os.path.split(os.path.normpath(data_path))
+    return os.path.join(project_path, "cache", split + ".h5")
+
+def to_native_dtype(image_data, dtype):
+    '''
+    Converts resized image data back to the dtype of the original file, integers are rounded and clipped
+    NaN values, e.g. of resized constant images, are set to zero before the cast like in the batches
+    '''
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        image_data = np.clip(np.round(np.nan_to_num(image_data)), info.min, info.max)
+    return np.asarray(image_data).astype(dtype)
+
+class DatasetCache(object):
+    '''
+    Chunked HDF5 copy of the data folders of the train or test folder
+    Each data folder is stored as one dataset with the dimensions (number of files, image shape),
+    the images are already resized and stored in the dtype of the original files with one chunk per image
+
+    Args
+        data_path: path to the train or test folder in the project directory
+        folders: list of (folder index, folder name, image shape, number of channels) of the data folders
+        image_files: list of all files in the data folders
+        load_function: function(path_name, shape) which imports one file and resizes it to shape
+        decode_threads: number of threads which decode the files while the cache is built
+    '''
+    def __init__(self, data_path, folders, image_files, load_function, decode_threads = 4):
+        self.data_path = data_path
+        self.cache_file = get_cache_file(data_path)
+        self.image_files = sorted(image_files)
+        self.rows = dict((img_file, row) for row, img_file in enumerate(self.image_files))
+        self._file = None
+        self._pid = None
+        self.materialize(folders, load_function, decode_threads)
+
+    def __getstate__(self):
+        # Open HDF5 files can not be copied to other processes, they are opened again when needed
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def outdated_folders(self, folders):
+        '''
+        Returns the folders whose cached version is missing, was created from other files or has another shape
+        '''
+        if os.path.isfile(self.cache_file) == False:
+            return [(folder, folder_fingerprint(self.data_path + folder[1], self.image_files)) for folder in folders]
+        outdated = []
+        # The cache is checked read-only, so that other loaders can keep reading it
+        with h5py.File(self.cache_file, 'r') as cache:
+            for index, folder_name, shape, num_channels in folders:
+                name = folder_name.strip("/")
+                fingerprint = folder_fingerprint(self.data_path + folder_name, self.image_files)
+                if name in cache and cache[name].attrs.get("fingerprint") == fingerprint \
+                                 and tuple(cache[name].shape[1:]) == tuple(shape):
+                    logging.info("Using cached %s from %s" % (folder_name, self.cache_file))
+                else:
+                    outdated.append(((index, folder_name, shape, num_channels), fingerprint))
+        return outdated
+
+    def materialize(self, folders, load_function, decode_threads):
+        '''
+        Decodes and resizes all files of the folders, whose cached version is missing or outdated
+        '''
+        outdated = self.outdated_folders(folders)
+        if len(outdated) == 0:
+            return
+        self.close()
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with h5py.File(self.cache_file, 'a') as cache:
+            for (index, folder_name, shape, num_channels), fingerprint in outdated:
+                name = folder_name.strip("/")
+                logging.info("Writing %s files of %s to %s" % (len(self.image_files), folder_name, self.cache_file))
+                if name in cache:
+                    del cache[name]
+                if len(self.image_files) == 0:
+                    continue
+                path_names = [self.data_path + folder_name + img_file for img_file in self.image_files]
+                dataset = None
+                with ThreadPoolExecutor(max_workers = max(decode_threads, 1)) as executor:
+                    for row, (image_data, dtype) in enumerate(executor.map(lambda path_name: load_function(path_name, shape), path_names)):
+                        if dataset is None:
+                            dataset = cache.create_dataset(name, shape = (len(path_names),) + tuple(shape),
+                                                            dtype = dtype, chunks = (1,) + tuple(shape))
+                        dataset[row] = to_native_dtype(image_data, dataset.dtype)
+                dataset.attrs["fingerprint"] = fingerprint
+
+    def read(self, folder_name, files):
+        '''
+        Reads the images of the given files from the cache
+
+        Args:
+            folder_name: the data folder, e.g. "/image/"
+            files: list of file names
+
+        return:
+            array with the dimensions (number of files, image shape) in the dtype of the original files
+        '''
+        if self._file is None or self._pid != os.getpid():
+            self._file = h5py.File(self.cache_file, 'r')
+            self._pid = os.getpid()
+        rows = np.array([self.rows[img_file] for img_file in files])
+        # HDF5 requires increasing indices, so the rows are read sorted and then put back in order
+        order = np.argsort(rows)
+        data = self._file[folder_name.strip("/")][rows[order].tolist()]
+        return data[np.argsort(order)]
@@ -0,0 +1,313 @@
+'''
+InstantDL
+Dataset statistics which are used to normalize the data before training and testing.
+The statistics are computed in one parallel pass over all data folders and are cached
+in the logs folder of the project directory, so that they only need to be computed once.
+'''
+
+import numpy as np
+from skimage.io import imread
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+
+STATISTICS_FILE = "normalization_statistics.json"
+
+def read_min_max(file_path):
+    '''
+    Decodes one file and returns its minimum and maximum pixel value
+    .npy files are memory mapped, so volumes larger than the memory can be processed
+
+    Args:
+        file_path (str): path to the image or .npy file
+
+    return:
+        min_value, max_value: the minimum and maximum pixel value of the file
+    '''
+    if file_path.endswith(".npy"):
+        image_data = np.load(file_path, mmap_mode='r')
+    else:
+        image_data = imread(file_path)
+    return np.min(image_data), np.max(image_data)
+
+def folder_fingerprint(folder_path, image_files, stat_files = None):
+    '''
+    Creates a fingerprint of the files in a folder from their names, sizes and modification times
+    The fingerprint changes as soon as a file is added, removed or modified
+
+    Args:
+        folder_path (str): path to the data folder, e.g. project/train/image/
+        image_files (list): list of image files in this folder
+        stat_files (list): optional subset of the image files whose sizes and modification times are used,
+                            e.g. the sampled files of the approximate normalization. The other files only
+                            contribute their names, so that large folders are not scanned file by file
+
+    return:
+        fingerprint: a hex string identifying the folder content
+    '''
+    hasher = hashlib.sha1(os.path.abspath(folder_path).encode())
+    stat_files = set(image_files if stat_files is None else stat_files)
+    for img_file in sorted(image_files):
+        if img_file in stat_files:
+            stat = os.stat(os.path.join(folder_path, img_file))
+            hasher.update(("%s:%d:%d;" % (img_file, stat.st_size, stat.st_mtime_ns)).encode())
+        else:
+            hasher.update(("%s;" % img_file).encode())
+    return hasher.hexdigest()
+
+def sample_file_indices(num_files, sample_files, random_state = None):
+    '''
+    Returns the indices of the randomly selected files of the approximate normalization
+    Without a random_state the selection is the same as in estimate_min_max
+    '''
+    if random_state is None:
+        random_state = np.random.RandomState(1)
+    return random_state.choice(num_files, min(int(sample_files), num_files), replace=False)
+
+def get_statistics_file(data_path):
+    '''
+    Returns the path of the statistics file for a train or test folder
+    The file is saved to the logs folder in the project directory
+
+    Args:
+        data_path (str): path to the train or test folder in the project directory
+
+    return:
+        path to the statistics file
+    '''
+    project_path = os.path.dirname(os.path.normpath(data_path))
+    return os.path.join(project_path, "logs", STATISTICS_FILE)
+
+def load_statistics(statistics_file):
+    '''
+    Loads the cached statistics, returns an empty dictionary if the file does not exist or is corrupted
+    '''
+    if os.path.isfile(statistics_file) == False:
+        return dict()
+    try:
+        with open(statistics_file, 'r') as stream:
+            return json.load(stream)
+    except (ValueError, OSError):
+        logging.warning("Could not read %s, the statistics are computed again" % statistics_file)
+        return dict()
+
+def save_statistics(statistics_file, statistics):
+    '''
+    Saves the statistics to the statistics file
+    The file is written to a temporary file first and then moved so that it is never left half written
+    '''
+    os.makedirs(os.path.dirname(statistics_file), exist_ok=True)
+    tmp_file = statistics_file + ".%d.tmp" % os.getpid()
+    with open(tmp_file, 'w') as stream:
+        json.dump(statistics, stream, indent=1)
+    os.replace(tmp_file, statistics_file)
+
+def compute_min_max(file_paths, workers = None):
+    '''
+    Computes the minimum and maximum pixel value of a list of files in one parallel pass
+    Each file is decoded only once
+
+    Args:
+        file_paths (list): list of paths to image or .npy files
+        workers (int): number of decoding threads, defaults to the number of cpus
+
+    return:
+        Xmin, Xmax: arrays containing the minimum and maximum pixel value of each file
+    '''
+    Xmin = np.empty(len(file_paths))
+    Xmax = np.empty(len(file_paths))
+    with ThreadPoolExecutor(max_workers = workers or os.cpu_count()) as executor:
+        for i, (min_value, max_value) in enumerate(executor.map(read_min_max, file_paths)):
+            Xmin[i] = min_value
+            Xmax[i] = max_value
+    return Xmin, Xmax
+
+class StreamingHistogram(object):
+    '''
+    A fixed size histogram which is updated with batches of values without knowing the value range in advance
+    If a value outside the current range arrives the range is doubled and neighbouring bins are merged,
+    so the memory stays constant and the value error of each percentile is at most one bin width
+    '''
+    def __init__(self, bins = 4096):
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.lower = None
+        self.width = None
+        self.min_value = np.inf
+        self.max_value = -np.inf
+
+    def upper(self):
+        return self.lower + self.width * self.bins
+
+    def _grow(self, values_min, values_max):
+        while values_min < self.lower or values_max >= self.upper():
+            merged = self.counts.reshape(-1, 2).sum(axis = 1)
+            self.counts = np.zeros(self.bins, dtype=np.int64)
+            if values_min < self.lower:
+                # Extend the range to lower values, the merged bins move to the upper half
+                self.counts[self.bins // 2:] = merged
+                self.lower = self.lower - self.width * self.bins
+            else:
+                self.counts[:self.bins // 2] = merged
+            self.width = self.width * 2
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+        values_min = np.min(values)
+        values_max = np.max(values)
+        self.min_value = min(self.min_value, values_min)
+        self.max_value = max(self.max_value, values_max)
+        if self.lower is None:
+            self.lower = values_min
+            self.width = max(values_max - values_min, 1e-6) / (self.bins - 1)
+        self._grow(values_min, values_max)
+        index = np.clip(((values - self.lower) / self.width).astype(np.int64), 0, self.bins - 1)
+        self.counts += np.bincount(index, minlength = self.bins)
+
+    def count(self):
+        return int(np.sum(self.counts))
+
+    def percentile(self, q):
+        '''
+        Returns the estimated q-th percentile (0 - 100) of all values seen so far
+        '''
+        cumulative = np.cumsum(self.counts)
+        rank = q / 100. * cumulative[-1]
+        index = int(np.searchsorted(cumulative, rank))
+        below = cumulative[index - 1] if index > 0 else 0
+        fraction = (rank - below) / max(self.counts[index], 1)
+        value = self.lower + (index + fraction) * self.width
+        return float(np.clip(value, self.min_value, self.max_value))
+
+def read_pixel_sample(file_path, sample_pixels, random_state):
+    '''
+    Reads a random sample of pixel values from one file
+    .npy files are memory mapped so only the sampled pixels are read from disk
+    '''
+    if file_path.endswith(".npy"):
+        image_data = np.load(file_path, mmap_mode='r')
+    else:
+        image_data = imread(file_path)
+    image_data = np.reshape(image_data, -1)
+    if image_data.size <= sample_pixels:
+        return np.array(image_data)
+    index = np.sort(random_state.randint(0, image_data.size, size = sample_pixels))
+    return np.array(image_data[index])
+
+def estimate_min_max(file_paths, sample_files = 200, sample_pixels = 10000,
+                        percentiles = None, confidence = 0.95, workers = None):
+    '''
+    Estimates the minimum and maximum pixel value from a random sample of files and pixels
+    The sampled pixels are accumulated in a streaming histogram, so the time needed only depends on
+    the sample size and not on the size of the dataset
+
+    Args:
+        file_paths (list): list of paths to image or .npy files
+        sample_files (int): number of randomly selected files
+        sample_pixels (int): number of randomly selected pixels in each file
+        percentiles (list): optional lower and upper percentile, e.g. [0.1, 99.9], which are returned
+                            instead of the minimum and maximum for a robust normalization
+        confidence (float): confidence level of the reported error bound
+        workers (int): number of decoding threads, defaults to the number of cpus
+
+    return:
+        min_value, max_value: the estimated minimum and maximum (or lower and upper percentile)
+        error_bound: with the given confidence at most this fraction of all pixels lies outside
+                    of the estimated range (or deviates in rank from the percentile)
+    '''
+    random_state = np.random.RandomState(1)
+    num_files = min(int(sample_files), len(file_paths))
+    sampled_files = [file_paths[i] for i in sample_file_indices(len(file_paths), sample_files, random_state)]
+    seeds = random_state.randint(0, 2**31 - 1, size = num_files)
+    histogram = StreamingHistogram()
+    with ThreadPoolExecutor(max_workers = workers or os.cpu_count()) as executor:
+        samples = executor.map(lambda args: read_pixel_sample(args[0], sample_pixels, np.random.RandomState(args[1])),
+                                zip(sampled_files, seeds))
+        for sample in samples:
+            histogram.update(sample)
+    n = histogram.count()
+    if percentiles is None:
+        min_value, max_value = histogram.min_value, histogram.max_value
+        # The probability that more than a fraction eps of the pixels lies above the sample maximum is (1 - eps)^n
+        error_bound = -np.log(1 - confidence) / n
+    else:
+        min_value, max_value = histogram.percentile(percentiles[0]), histogram.percentile(percentiles[1])
+        # Dvoretzky-Kiefer-Wolfowitz bound on the rank error of the empirical distribution
+        error_bound = np.sqrt(np.log(2. / (1 - confidence)) / (2. * n))
+    logging.info("Estimated the value range from %s pixels in %s of %s files, the value error is at most %s" % \
+                                (n, num_files, len(file_paths), histogram.width))
+    return min_value, max_value, min(float(error_bound), 1.)
+
+def get_dataset_min_max(data_path, Folder_Names, image_files, workers = None, normalization_args = None):
+    '''
+    Gets the minimum and maximum pixel values for all data folders
+    Folders for which no cached statistics exist are computed together in one parallel pass,
+    the results are cached in the statistics file keyed by the file names, sizes and modification times
+    If normalization_args contains "mode": "approximate" the values are estimated from a random sample
+    of files and pixels instead (see estimate_min_max)
+
+    Args:
+        data_path (str): path to the train or test folder in the project directory
+        Folder_Names (list): the data folder names, e.g. ["/groundtruth/", "/image/", "/image1/"]
+        image_files (list): list of image files
+        workers (int): number of decoding threads, defaults to the number of cpus
+        normalization_args (dict): "mode" ("exact" or "approximate"), "sample_files", "sample_pixels"
+                                    and "percentiles" for the approximate mode
+
+    return:
+        X_min: array with the minimum pixel value of each folder, zero if the folder does not exist
+        X_max: array with the maximum pixel value of each folder, zero if the folder does not exist
+    '''
+    if normalization_args is None:
+        normalization_args = dict()
+    approximate = normalization_args.get("mode", "exact") == "approximate"
+    sample_args = {"sample_files": normalization_args.get("sample_files", 200),
+                    "sample_pixels": normalization_args.get("sample_pixels", 10000),
+                    "percentiles": normalization_args.get("percentiles", None)}
+    X_min = np.zeros((len(Folder_Names)))
+    X_max = np.zeros((len(Folder_Names)))
+    statistics_file = get_statistics_file(data_path)
+    statistics = load_statistics(statistics_file)
+    missing = []
+    stat_files = None
+    if approximate == True:
+        # Only the sampled files are checked for modifications, so the cost does not grow with the dataset
+        stat_files = [image_files[i] for i in sample_file_indices(len(image_files), sample_args["sample_files"])]
+    for i, folder_name in enumerate(Folder_Names):
+        if os.path.isdir(data_path + folder_name) == True:
+            fingerprint = folder_fingerprint(data_path + folder_name, image_files, stat_files)
+            if approximate == True:
+                fingerprint = fingerprint + "-approximate-" + json.dumps(sample_args, sort_keys=True)
+            if fingerprint in statistics:
+                X_min[i] = statistics[fingerprint]["min"]
+                X_max[i] = statistics[fingerprint]["max"]
+                logging.info("Using cached min value of %s: %s and max value: %s" % \
+                                            (folder_name, X_min[i], X_max[i]))
+            else:
+                missing.append((i, folder_name, fingerprint))
+
+    if len(missing) > 0 and approximate == True:
+        for i, folder_name, fingerprint in missing:
+            X_min[i], X_max[i], error_bound = estimate_min_max([data_path + folder_name + img_file for img_file in image_files],
+                                                                workers = workers, **sample_args)
+            statistics[fingerprint] = {"folder": folder_name, "min": float(X_min[i]), "max": float(X_max[i]),
+                                        "error_bound": error_bound}
+            logging.info("estimated min value of %s is %s and the max value is %s, "
+                            "at most %s of the pixels lie outside this range with 95%% confidence" % \
+                                            (folder_name, X_min[i], X_max[i], error_bound))
+        save_statistics(statistics_file, statistics)
+    elif len(missing) > 0:
+        file_paths = [data_path + folder_name + img_file for _, folder_name, _ in missing for img_file in image_files]
+        Xmin, Xmax = compute_min_max(file_paths, workers)
+        for j, (i, folder_name, fingerprint) in enumerate(missing):
+            X_min[i] = np.min(Xmin[j * len(image_files) : (j + 1) * len(image_files)])
+            X_max[i] = np.max(Xmax[j * len(image_files) : (j + 1) * len(image_files)])
+            statistics[fingerprint] = {"folder": folder_name, "min": float(X_min[i]), "max": float(X_max[i])}
+            logging.info("min value of %s is %s and the max value is %s" % \
+                                            (folder_name, X_min[i], X_max[i]))
+        save_statistics(statistics_file, statistics)
+    return X_min, X_max
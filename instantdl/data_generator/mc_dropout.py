@@ -0,0 +1,298 @@
+'''
+InstantDL
+Monte Carlo dropout uncertainty estimation as suggested by Gal et. al.: https://arxiv.org/abs/1506.02142
+Each test batch is read and normalized once and all stochastic forward passes are run back to back
+on the batch in memory, instead of reading the whole test set again for every pass.
+In the last layer mode only the last dropout layer of the model is active, so that the features of the
+deterministic trunk are computed once per batch and only the layers after the dropout are predicted for every sample.
+'''
+
+import numpy as np
+import logging
+from keras.layers import Input
+from keras.models import Model
+from keras import backend as K
+
+MC_SAMPLES = 20
+MIN_SAMPLES = 3
+
+class MCStatistics(object):
+    '''
+    Running statistics of the Monte Carlo samples of one batch, which are updated with Welford's algorithm
+    as the samples arrive, so that the samples never need to be held in memory at once
+    Each image of the batch has its own number of samples, so that converged images need no further samples
+    The uncertainty is computed following: https://github.com/ykwon0407/UQ_BNN
+
+    Attributes:
+        count: the number of samples of each image
+        mean: the mean of the samples
+        epistemic: the variance of the samples, mean(p**2) - mean(p)**2
+        aleatoric: the mean of p * (1 - p) over the samples
+    '''
+    def __init__(self):
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.pq = None
+
+    def image_count(self, ndim):
+        return self.count.reshape((-1,) + (1,) * (ndim - 1))
+
+    def update(self, sample, active = None):
+        '''
+        Adds one sample of the images with the indices active, by default of all images
+        The first sample has to contain all images of the batch
+        '''
+        sample = np.asarray(sample, dtype = np.float32)
+        if self.mean is None:
+            self.count = np.ones(len(sample), dtype = np.int64)
+            self.mean = sample.copy()
+            self.m2 = np.zeros_like(sample)
+            self.pq = sample * (1 - sample)
+            return
+        if active is None:
+            active = np.arange(len(self.count))
+        self.count[active] += 1
+        count = self.count[active].reshape((-1,) + (1,) * (sample.ndim - 1))
+        delta = sample - self.mean[active]
+        mean = self.mean[active] + delta / count
+        self.m2[active] += delta * (sample - mean)
+        self.mean[active] = mean
+        self.pq[active] += sample * (1 - sample)
+
+    @property
+    def epistemic(self):
+        return self.m2 / self.image_count(self.m2.ndim)
+
+    @property
+    def aleatoric(self):
+        return self.pq / self.image_count(self.pq.ndim)
+
+class ClassificationStatistics(MCStatistics):
+    '''
+    Running statistics of the Monte Carlo samples of the class probabilities of one batch
+    In addition to the MCStatistics the votes of the samples and their entropy are accumulated
+
+    Attributes:
+        votes: the number of samples of each image in which each class has the highest probability
+        prediction: the class with the most votes of each image
+        entropy: the mean entropy of the samples of each image
+    '''
+    def __init__(self):
+        super(ClassificationStatistics, self).__init__()
+        self.votes = None
+        self.entropy_sum = None
+
+    def update(self, sample, active = None):
+        sample = np.asarray(sample, dtype = np.float32)
+        if self.votes is None:
+            self.votes = np.zeros(np.shape(sample), dtype = np.int64)
+            self.entropy_sum = np.zeros(len(sample), dtype = np.float64)
+        super(ClassificationStatistics, self).update(sample, active)
+        if active is None:
+            active = np.arange(len(self.count))
+        self.votes[active, np.argmax(sample, axis = -1)] += 1
+        self.entropy_sum[active] += -1 * np.sum(sample * np.log(sample + 10e-6), axis = -1)
+
+    @property
+    def prediction(self):
+        return np.argmax(self.votes, axis = -1)
+
+    @property
+    def entropy(self):
+        return self.entropy_sum / self.count
+
+def mc_dropout_classification(model, test_sequence, num_samples = MC_SAMPLES, results = None):
+    '''
+    Computes the Monte Carlo prediction and uncertainty of a classification test set batch by batch
+    Only the running statistics of one batch are kept in memory, never all samples at once
+
+    Args:
+        model: the model with dropout active during inference
+        test_sequence: TestDataSequence of the test set
+        num_samples: the number of Monte Carlo samples
+        results: the predictions of the test set in the order of the test_sequence, which count as the first sample
+
+    return:
+        prediction: the class with the most votes of the samples for each image
+        entropy: the mean entropy of the samples for each image
+    '''
+    prediction = []
+    entropy = []
+    start = 0
+    for batch_index in range(len(test_sequence)):
+        X = test_sequence[batch_index]
+        statistics = ClassificationStatistics()
+        if results is not None:
+            statistics.update(results[start:start + len(X)])
+        else:
+            statistics.update(model.predict_on_batch(X))
+        while statistics.count[0] < num_samples:
+            statistics.update(model.predict_on_batch(X))
+        logging.info("Computed %d Monte Carlo samples of a batch of %d images" % (statistics.count[0], len(X)))
+        prediction.append(statistics.prediction)
+        entropy.append(statistics.entropy)
+        start += len(X)
+    return np.concatenate(prediction), np.concatenate(entropy)
+
+def mc_dropout_statistics(model, X, first_sample, num_samples = MC_SAMPLES, tolerance = None, min_samples = MIN_SAMPLES):
+    '''
+    Samples one batch until each image has num_samples samples or, if a tolerance is given, until the mean absolute
+    change of its epistemic uncertainty by one more sample is below the tolerance. Only the images which have not
+    converged are predicted again
+
+    Args:
+        model: the model with dropout active during inference
+        X: one batch of normalized test images, or the tiles of one image
+        first_sample: the prediction of the batch which was already computed, it counts as the first sample
+        num_samples: the number of Monte Carlo samples, the maximal number if a tolerance is given
+        tolerance: None to use num_samples samples for all images, otherwise the tolerance of the adaptive sampling
+        min_samples: the minimal number of samples of each image in the adaptive sampling
+
+    return:
+        statistics: the MCStatistics of the batch
+    '''
+    statistics = MCStatistics()
+    statistics.update(first_sample)
+    active = np.arange(len(X))[statistics.count < num_samples]
+    # The images which are sampled are only copied when the active images change, so that a
+    # LastLayerMCModel can reuse the features of the trunk
+    X_active = X if len(active) == len(X) else X[active]
+    while len(active) > 0:
+        previous = statistics.epistemic[active]
+        if len(active) == len(X):
+            statistics.update(model.predict_on_batch(X))
+        else:
+            statistics.update(model.predict_on_batch(X_active), active)
+        done = statistics.count[active] >= num_samples
+        if tolerance is not None:
+            change = np.abs(statistics.epistemic[active] - previous).reshape(len(active), -1).mean(axis = 1)
+            done |= (statistics.count[active] >= min_samples) & (change < tolerance)
+        if done.any():
+            active = active[~done]
+            X_active = X[active]
+    return statistics
+
+def mc_dropout_uncertainty(model, test_sequence, sink, num_samples = MC_SAMPLES, results = None,
+                            tolerance = None, min_samples = MIN_SAMPLES, result_sink = None, result_model = None):
+    '''
+    Computes the epistemic and aleatoric uncertainty of the test set batch by batch and hands them to the sink
+    Only the running statistics of one batch are kept in memory
+    If a tolerance is given, the sampling of an image stops as soon as the mean absolute change of its epistemic
+    uncertainty by one more sample is below the tolerance, and only the images which have not converged are
+    predicted again
+    If a result_sink is given, the test set is predicted and sampled in one pass: the prediction of each batch
+    is handed to the result_sink and counts as the first sample, so that every test batch is read only once
+
+    Args:
+        model: the model with dropout active during inference
+        test_sequence: TestDataSequence of the test set
+        sink: function which is called with the filenames, the epistemic and the aleatoric uncertainty of each batch,
+                e.g. UncertaintyWriter in data_generator.py
+        num_samples: the number of Monte Carlo samples, the maximal number if a tolerance is given
+        results: the predictions of the test set in the order of the test_sequence, which count as the first sample
+        tolerance: None to use num_samples samples for all images, otherwise the tolerance of the adaptive sampling
+        min_samples: the minimal number of samples of each image in the adaptive sampling
+        result_sink: function which is called with the filenames and the predictions of each batch,
+                e.g. ResultWriter in data_generator.py
+        result_model: the model whose predictions are handed to the result_sink, by default the model
+
+    return:
+        sample_counts: the number of samples used for each image in the order of the test_sequence
+    '''
+    sample_counts = []
+    start = 0
+    for batch_index in range(len(test_sequence)):
+        X = test_sequence[batch_index]
+        test_image_files = test_sequence.batch_files(batch_index)
+        if results is not None:
+            first_sample = results[start:start + len(X)]
+        elif result_sink is not None:
+            first_sample = (model if result_model is None else result_model).predict_on_batch(X)
+            result_sink(test_image_files, first_sample)
+        else:
+            first_sample = model.predict_on_batch(X)
+        statistics = mc_dropout_statistics(model, X, first_sample, num_samples, tolerance, min_samples)
+        for test_image_file, count in zip(test_image_files, statistics.count):
+            logging.info("Used %d Monte Carlo samples for %s" % (count, test_image_file))
+        sink(test_image_files, statistics.epistemic, statistics.aleatoric)
+        sample_counts.extend(statistics.count.tolist())
+        start += len(X)
+    return sample_counts
+
+class LastLayerMCModel(object):
+    '''
+    Monte Carlo dropout model in which only the layers after the last dropout layer are stochastic
+    The features of the deterministic trunk are computed once for each batch and reused for all samples,
+    so that one sample only costs the layers of the head
+
+    Args:
+        trunk: model from the input to the features before the last dropout layer, without active dropout
+        head: model from the features to the output, with dropout active during inference
+    '''
+    def __init__(self, trunk, head):
+        self.trunk = trunk
+        self.head = head
+        self.X = None
+        self.features = None
+
+    def predict_on_batch(self, X):
+        if X is not self.X:
+            self.features = self.trunk.predict_on_batch(X)
+            self.X = X
+        return self.head.predict_on_batch(self.features)
+
+def last_layer_mc_model(model, layer_name):
+    '''
+    Splits a model without active dropout at one of its dropout layers, e.g. the last dropout layer of the UNet
+    or ResNet50. The dropout layer and all layers which depend on it form the head, in which this dropout layer
+    is active during inference. The tensors which the head uses from the rest of the model, e.g. the skip
+    connections of the UNet, are the outputs of the trunk
+
+    Args:
+        model: the trained model, e.g. a UNet or a ResNet50 with Dropout_On = None
+        layer_name: the name of the dropout layer at which the model is split, e.g. "drop5" of the UNet
+
+    return:
+        LastLayerMCModel which shares the weights of the model
+    '''
+    split_layer = model.get_layer(layer_name)
+    depends_on_split = {}
+    head_tensors = {}
+    trunk_outputs = []
+    head_inputs = []
+
+    def inbound_node(tensor):
+        layer, node_index, tensor_index = tensor._keras_history
+        return layer, layer._inbound_nodes[node_index]
+
+    def in_head(tensor):
+        layer, node = inbound_node(tensor)
+        if id(layer) not in depends_on_split:
+            # Input layers have no inbound layers and never depend on the split layer
+            depends_on_split[id(layer)] = layer is split_layer or \
+                        (len(node.inbound_layers) > 0 and any(in_head(t) for t in node.input_tensors))
+        return depends_on_split[id(layer)]
+
+    def head_tensor(tensor):
+        if id(tensor) not in head_tensors:
+            layer, node = inbound_node(tensor)
+            if in_head(tensor):
+                inputs = [head_tensor(t) for t in node.input_tensors]
+                arguments = dict(node.arguments or {})
+                if layer is split_layer:
+                    arguments["training"] = True
+                outputs = layer(inputs if len(inputs) > 1 else inputs[0], **arguments)
+                outputs = outputs if isinstance(outputs, list) else [outputs]
+                for output_tensor, output in zip(node.output_tensors, outputs):
+                    head_tensors[id(output_tensor)] = output
+            else:
+                trunk_outputs.append(tensor)
+                head_inputs.append(Input(shape = K.int_shape(tensor)[1:]))
+                head_tensors[id(tensor)] = head_inputs[-1]
+        return head_tensors[id(tensor)]
+
+    outputs = [head_tensor(tensor) for tensor in model.outputs]
+    trunk = Model(inputs = model.inputs, outputs = trunk_outputs)
+    head = Model(inputs = head_inputs, outputs = outputs if len(outputs) > 1 else outputs[0])
+    return LastLayerMCModel(trunk, head)
@@ -102,4 +102,41 @@ def binary_focal_loss_fixed(y_true, y_pred, gamma = 2., alpha = 0.25):
     weight = alpha_t * K.pow((1 - p_t), gamma)
     loss = weight * cross_entropy
     loss = K.mean(K.sum(loss, axis=1))
-    return loss
\ No newline at end of file
+    return loss
+
+
+def heteroscedastic_loss(y_true, y_pred):
+    """ Heteroscedastic loss function following Kendall and Gal: https://arxiv.org/abs/1703.04977
+    The network predicts the mean and the log variance of each pixel, so that it learns
+    the aleatoric uncertainty of its prediction in a single forward pass.
+    Parameters
+    ----------
+    y_true : keras tensor
+        tensor containing the target.
+    y_pred : keras tensor
+        tensor containing the prediction followed by the log variance of each channel along the last axis.
+    Returns
+    -------
+    keras tensor
+        tensor containing heteroscedastic loss.
+    """
+    channels = K.int_shape(y_pred)[-1] // 2
+    mean = y_pred[..., :channels]
+    log_variance = y_pred[..., channels:]
+    return K.mean(0.5 * K.exp(-log_variance) * K.square(y_true - mean) + 0.5 * log_variance, axis=-1)
+
+def heteroscedastic_mse(y_true, y_pred):
+    """ Mean squared error of the prediction of a model trained with the heteroscedastic loss.
+    Parameters
+    ----------
+    y_true : keras tensor
+        tensor containing the target.
+    y_pred : keras tensor
+        tensor containing the prediction followed by the log variance of each channel along the last axis.
+    Returns
+    -------
+    keras tensor
+        tensor containing the mean squared error of the prediction.
+    """
+    channels = K.int_shape(y_pred)[-1] // 2
+    return K.mean(K.square(y_true - y_pred[..., :channels]), axis=-1)
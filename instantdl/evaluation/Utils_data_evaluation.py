@@ -38,7 +38,8 @@ def import_images(import_dir, files, new_file_ending):
 		if new_file_ending is not None:
 			file = (file + new_file_ending)
 		if file.endswith(".npy"):
-			imp = np.array(np.load(os.path.join(import_dir, file)))
+			# Memory mapped, so the file is read only once when the stack is created
+			imp = np.load(os.path.join(import_dir, file), mmap_mode='r')
 		else:
 			imp = np.array(imread(os.path.join(import_dir, file)))
 		if np.shape(imp)[-1] == 1:
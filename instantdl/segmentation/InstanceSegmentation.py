@@ -20,7 +20,9 @@ class InstanceSegmentation(object):
                     image_size = None,
                     seeds=False,
                     calculate_uncertainty = False,
-                    evaluation = True):
+                    evaluation = True,
+                    normalization_args = None,
+                    **options):
 
         self.use_algorithm = "InstanceSegmentation"
         self.path = path
@@ -32,6 +34,12 @@ class InstanceSegmentation(object):
         self.image_size = image_size
         self.calculate_uncertainty = calculate_uncertainty
         self.evaluation = evaluation
+        if normalization_args is None:
+            self.normalization_args = dict()
+        else:
+            self.normalization_args = normalization_args
+        # The Mask RCNN loads, augments and predicts the images itself, so none of the pipeline options are used
+        set_pipeline_options(self, options, ignored_options = tuple(PIPELINE_OPTIONS))
         
         if data_gen_args is None:
             self.data_gen_args = dict()
@@ -21,7 +21,9 @@ class Regression(object):
                     image_size = None,
                     seeds=False,
                     calculate_uncertainty = False,
-                    evaluation = True):
+                    evaluation = True,
+                    normalization_args = None,
+                    **options):
 
         self.use_algorithm = "Regression"
         self.path = path
@@ -38,6 +40,11 @@ class Regression(object):
         else:
             self.data_gen_args = data_gen_args
         self.evaluation = evaluation
+        if normalization_args is None:
+            self.normalization_args = dict()
+        else:
+            self.normalization_args = normalization_args
+        set_pipeline_options(self, options)
     
     def data_prepration(self): 
         '''
@@ -45,14 +52,18 @@ class Regression(object):
         If the last image dimension,. which should contain the channel information (1 or 3) is not existing e.g. for 
         (512,512) add a 1 as the channel number.
         '''
-        if self.image_size == False or self.image_size == None:
+        if self.patch_size is not None:
+            # The patches are cropped from images of any size, so their size is not checked
+            Training_Input_shape, num_channels, Input_image_shape = get_input_image_sizes(self.path, self.use_algorithm, check_size = False)
+            Training_Input_shape = tuple(self.patch_size) + (num_channels,)
+        elif self.image_size == False or self.image_size == None:
             Training_Input_shape, num_channels, Input_image_shape = get_input_image_sizes(self.path, self.use_algorithm)
         else:
             Training_Input_shape = self.image_size
             num_channels = int(self.image_size[-1])
             data_path = self.path + '/train'
             img_file = os.listdir(data_path + "/image/")[0]
-            Input_image_shape = np.array(np.shape(np.array(import_image(data_path + "/image/" + img_file))))
+            Input_image_shape = np.array(np.shape(import_image(data_path + "/image/" + img_file, mmap_mode = 'r')))
 
         ''' 
         Check if the 2D or 3D Pipeline is needed
@@ -79,7 +90,10 @@ class Regression(object):
         data_path = self.path + '/train'
         train_image_files, val_image_files = training_validation_data_split(data_path)
 
-        steps_per_epoch = int(len(train_image_files)/self.batchsize)
+        if self.patch_size is not None:
+            steps_per_epoch = int(np.ceil(self.patches_per_epoch/self.batchsize))
+        else:
+            steps_per_epoch = int(np.ceil(len(train_image_files)/self.batchsize))
 
         self.epochs = self.iterations_over_dataset
         logging.info("Making: %s steps per Epoch" % steps_per_epoch)
@@ -106,7 +120,7 @@ class Regression(object):
 
         img_file_label_name = os.listdir(data_path + "/groundtruth/")[0]
         logging.info("img_file_label_name: %s" % img_file_label_name)
-        Training_Input_shape_label = np.shape(np.array(import_image(data_path + "/groundtruth/" + img_file_label_name)))
+        Training_Input_shape_label = np.shape(import_image(data_path + "/groundtruth/" + img_file_label_name, mmap_mode = 'r'))
         num_channels_label = Training_Input_shape_label[-1]
         if all([num_channels_label != 1, num_channels_label != 3]):
             num_channels_label = 1
@@ -114,22 +128,72 @@ class Regression(object):
         if self.use_algorithm == "SemanticSegmentation":
             self.data_gen_args["binarize_mask"] = True
 
-        TrainingDataGenerator = training_data_generator(Training_Input_shape,
+        if self.patch_size is not None:
+            # The validation patches are drawn once, the number of patches is proportional to the number of files
+            val_patches = max(self.batchsize, int(self.patches_per_epoch * len(val_image_files) / len(train_image_files)))
+            TrainingDataGenerator = PatchDataSequence(self.patch_size,
+                                                            self.batchsize, num_channels,
+                                                            num_channels_label,
+                                                            train_image_files,
+                                                            self.data_gen_args,
+                                                            data_dimensions,
+                                                            data_path,
+                                                            self.use_algorithm,
+                                                            patches_per_epoch = self.patches_per_epoch,
+                                                            normalization_args = self.normalization_args,
+                                                            decode_threads = self.decode_threads,
+                                                            prefetch = self.prefetch,
+                                                            augment_workers = self.augment_workers,
+                                                            dtype = self.dtype)
+            ValidationDataGenerator = PatchDataSequence(self.patch_size,
+                                                              self.batchsize, num_channels,
+                                                              num_channels_label,
+                                                              val_image_files,
+                                                              self.data_gen_args,
+                                                              data_dimensions,
+                                                              data_path,
+                                                              self.use_algorithm,
+                                                              patches_per_epoch = val_patches,
+                                                              normalization_args = self.normalization_args,
+                                                              shuffle = False,
+                                                              decode_threads = self.decode_threads,
+                                                              prefetch = self.prefetch,
+                                                              augment_workers = self.augment_workers,
+                                                              dtype = self.dtype)
+            return TrainingDataGenerator, ValidationDataGenerator,num_channels_label
+
+        TrainingDataGenerator = TrainingDataSequence(Training_Input_shape,
                                                             self.batchsize, num_channels,
                                                             num_channels_label,
                                                             train_image_files,
                                                             self.data_gen_args,
                                                             data_dimensions,
                                                             data_path,
-                                                            self.use_algorithm)
-        ValidationDataGenerator = training_data_generator(Training_Input_shape,
+                                                            self.use_algorithm,
+                                                            normalization_args = self.normalization_args,
+                                                            decode_threads = self.decode_threads,
+                                                            prefetch = self.prefetch,
+                                                            augment_workers = self.augment_workers,
+                                                            dataset_cache = self.cache_dataset,
+                                                            augmentation_variants = self.augmentation_variants,
+                                                            augmentation_refresh = self.augmentation_refresh,
+                                                            dtype = self.dtype)
+        ValidationDataGenerator = TrainingDataSequence(Training_Input_shape,
                                                               self.batchsize, num_channels,
                                                               num_channels_label,
                                                               val_image_files,
                                                               self.data_gen_args,
                                                               data_dimensions,
                                                               data_path,
-                                                              self.use_algorithm)
+                                                              self.use_algorithm,
+                                                              normalization_args = self.normalization_args,
+                                                              shuffle = False,
+                                                              decode_threads = self.decode_threads,
+                                                              prefetch = self.prefetch,
+                                                              augment_workers = self.augment_workers,
+                                                              dataset_cache = self.cache_dataset,
+                                                              augmentation_variants = self.augmentation_variants,
+                                                              dtype = self.dtype)
         return TrainingDataGenerator, ValidationDataGenerator,num_channels_label
     
     def load_model(self, network_input_size,data_dimensions,num_channels_label ):
@@ -144,12 +208,17 @@ class Regression(object):
         '''
         if self.pretrained_weights == False:
             self.pretrained_weights = None
+        # For the last layer uncertainty the dropout is only active during training, so that the trunk of the
+        # trained model is deterministic during inference
+        dropout_on = None if self.uncertainty_mode == "last_layer" else True
         if data_dimensions == 3:
             logging.info("Using 3D UNet")
-            model = UNetBuilder.unet3D(self.pretrained_weights, network_input_size[-1], num_channels_label, self.num_classes, self.loss_function, Dropout_On = True)
+            model = UNetBuilder.unet3D(self.pretrained_weights, network_input_size[-1], num_channels_label, self.num_classes, self.loss_function, Dropout_On = dropout_on,
+                                            heteroscedastic = self.uncertainty_mode == "heteroscedastic")
         else:
             logging.info("Using 2D UNet")
-            model = UNetBuilder.unet2D(self.pretrained_weights, network_input_size[-1], num_channels_label, self.num_classes, self.loss_function, Dropout_On = True)
+            model = UNetBuilder.unet2D(self.pretrained_weights, network_input_size[-1], num_channels_label, self.num_classes, self.loss_function, Dropout_On = dropout_on,
+                                            heteroscedastic = self.uncertainty_mode == "heteroscedastic")
 
         logging.info(model.summary())
         return model
@@ -167,7 +236,7 @@ class Regression(object):
             steps_per_epoch: The number of train steps in one epoch
             val_image_files: List of validation files
         returns:
-            The trained model and the checkpoint file path
+            The trained model with the weights of the best epoch and the checkpoint file path
         '''
 
         early_stopping = EarlyStopping(monitor='val_loss', patience=5, mode='auto', verbose=0)
@@ -178,22 +247,45 @@ class Regression(object):
 
         tensorboard = TensorBoard(log_dir = self.path + "logs/" + "/" + format(time.time())) #, update_freq='batch')
         logging.info("Tensorboard log is created at: logs/  it can be opend using tensorboard --logdir=logs for a terminal in the Project folder")
-        callbacks_list = [model_checkpoint, tensorboard, early_stopping]
+        best_weights = BestWeights(monitor = 'val_loss')
+        callbacks_list = [model_checkpoint, tensorboard, early_stopping, best_weights]
 
         '''
         Train the model given the initialized model and the data from the data generator
+        With augment_workers the batches are loaded by threads, as the augmentation process pool can not be
+        started from the daemonic worker processes of keras
         '''
         model.fit_generator(TrainingDataGenerator,
                                 steps_per_epoch=steps_per_epoch,
                                 validation_data=ValidationDataGenerator,
-                                validation_steps=int(len(val_image_files)/self.batchsize),
-                                max_queue_size=50,
+                                validation_steps=len(ValidationDataGenerator),
+                                max_queue_size=self.max_queue_size,
+                                workers=self.workers,
                                 epochs=self.epochs,
                                 callbacks = callbacks_list,
-                                use_multiprocessing=True)
+                                use_multiprocessing=self.augment_workers <= 0)
+        TrainingDataGenerator.close()
+        ValidationDataGenerator.close()
         logging.info('finished Model.fit_generator')
         return model, checkpoint_filepath
 
+    def result_sink(self, Input_image_shape):
+        '''
+        Creates the sink which saves the predictions on the testset to the results folder
+        With the heteroscedastic UNet the predicted uncertainty is split from the predictions
+        and saved to the uncertainty and insights folders if calculate_uncertainty is True
+        Args:
+            Input_image_shape: The shape to which the predictions are resized, None to keep their size
+        returns: the sink, which is used as context manager
+        '''
+        writer = ResultWriter(self.path + "/results/", Input_image_shape, writer_threads = self.writer_threads)
+        if self.uncertainty_mode != "heteroscedastic":
+            return writer
+        uncertainty_writer = None
+        if self.calculate_uncertainty == True:
+            uncertainty_writer = UncertaintyWriter(self.path, Input_image_shape, writer_threads = self.writer_threads)
+        return HeteroscedasticSink(writer, uncertainty_writer)
+
     def test_set_evaluation(self, model, Training_Input_shape, num_channels,Input_image_shape):
         '''
         Evalute the model on the testset
@@ -207,94 +299,78 @@ class Regression(object):
         test_image_files = os.listdir(os.path.join(self.path + "/test/image"))
         num_test_img = int(len(os.listdir(self.path + "/test/image")))
 
-        '''
-        Initialize the testset generator
-        '''
-        testGene = testGenerator(Training_Input_shape, self.path, num_channels, test_image_files, self.use_algorithm)
-        logging.info('finished testGene')
-        results = model.predict_generator(testGene, steps=num_test_img, use_multiprocessing=False, verbose=1)
-        #logging.info("results"), np.shape(results))
-        logging.info('finished model.predict_generator')
-
-
-        '''
-        Save the models prediction on the testset by printing the predictions 
-        as images to the results folder in the project path
-        '''
-        saveResult(self.path + "/results/", test_image_files, results, Input_image_shape)
-        if self.calculate_uncertainty == False:
-            if self.evaluation == True:
-                segmentation_regression_evaluation(self.path)
+        if self.tile_size is not None:
+            '''
+            Predict the test images in overlapping tiles and save the predictions in their original size
+            If the uncertainty is calculated, the Monte Carlo samples are predicted in the same tiles
+            '''
+            with self.result_sink(None) as writer:
+                if self.calculate_uncertainty == True and self.uncertainty_mode != "heteroscedastic":
+                    with UncertaintyWriter(self.path, None, writer_threads = self.writer_threads) as uncertainty_writer:
+                        tiled_prediction(model, self.path, test_image_files, num_channels, self.tile_size,
+                                            overlap = self.tile_overlap,
+                                            tile_batchsize = self.tile_batchsize,
+                                            normalization_args = self.normalization_args,
+                                            dtype = self.dtype,
+                                            sink = writer,
+                                            uncertainty_sink = uncertainty_writer,
+                                            mc_model = self.uncertainty_model(model),
+                                            mc_samples = self.mc_samples,
+                                            mc_tolerance = self.mc_tolerance)
+                else:
+                    tiled_prediction(model, self.path, test_image_files, num_channels, self.tile_size,
+                                            overlap = self.tile_overlap,
+                                            tile_batchsize = self.tile_batchsize,
+                                            normalization_args = self.normalization_args,
+                                            dtype = self.dtype,
+                                            sink = writer)
+        else:
+            '''
+            Initialize the testset generator
+            '''
+            testGene = TestDataSequence(Training_Input_shape, self.test_batchsize, self.path, num_channels, test_image_files, self.use_algorithm,
+                                                normalization_args = self.normalization_args,
+                                                dataset_cache = self.cache_dataset,
+                                                decode_threads = self.decode_threads,
+                                                dtype = self.dtype)
+            test_image_files = testGene.test_image_files
+            logging.info('finished testGene')
+
+            '''
+            Save the models prediction on the testset batch by batch by printing the predictions 
+            as images to the results folder in the project path, while the next batches are predicted
+            If the uncertainty is calculated, the Monte Carlo samples are predicted on each batch while it is in memory
+            and the prediction of the model counts as the first sample, so the testset is read only once
+            '''
+            with self.result_sink(Input_image_shape) as writer:
+                if self.calculate_uncertainty == True and self.uncertainty_mode != "heteroscedastic":
+                    with UncertaintyWriter(self.path, Input_image_shape, writer_threads = self.writer_threads) as uncertainty_writer:
+                        mc_dropout_uncertainty(self.uncertainty_model(model), testGene,
+                                                uncertainty_writer, self.mc_samples, tolerance = self.mc_tolerance,
+                                                result_sink = writer, result_model = model)
+                    logging.info('finished mc_dropout_uncertainty')
+                else:
+                    predict_to_sink(model, testGene, writer)
+                    logging.info('finished predict_to_sink')
+        if self.evaluation == True:
+            segmentation_regression_evaluation(self.path)
 
+        # The predictions are written to disk as soon as they are predicted and are not kept in memory
+        results = None
         return results,test_image_files, num_test_img
 
-    def uncertainty_prediction(self, results,
-                                checkpoint_filepath, 
-                                network_input_size, 
-                                Training_Input_shape, 
-                                num_channels, 
-                                test_image_files, 
-                                num_test_img,
-                                data_dimensions ,  
-                                num_channels_label, 
-                                Input_image_shape):    
-
+    def uncertainty_model(self, model):
         '''
-        Start uncertainty prediction if selected for regression or semantic segmentation
-        As suggested by Gal et. al.: https://arxiv.org/abs/1506.02142 
-        And as implemented in: https://openreview.net/pdf?id=Sk_P2Q9sG
+        Returns the model which predicts the Monte Carlo samples, in the last_layer mode only the decoder after
+        the last dropout layer of the UNet is stochastic
         Args:
-            checkpoint_filepath: the directory where checkpoints are saved
-            network_input_size: the dimensions of the input to the network
-            Training_Input_shape: the shape of the images in the train dataset
-            num_channels: number of channels (e.g.: 3 for RGB)
-            test_image_files: list of filenames contained in the testset
-            num_test_img: number of filenames in the testset
-            data_dimensions: image dimensions
-            num_channels_label: number of channels of the groundtruth (e.g.: 3 for RGB)
-            Input_image_shape: The shape of the input images
-        returns:
-            Saves the results to the 'results' directory and the uncertainty estimations to the 'uncertainty' directory
+            model: the trained model with dropout active during inference,
+                    or without active dropout for the last_layer mode
+        returns: the model whose predict_on_batch returns one Monte Carlo sample
         '''
-        if data_dimensions == 3:
-            logging.info("Using 3D UNet")
-            if self.epochs > 0:
-                uncertainty_weights = checkpoint_filepath
-            else:
-                uncertainty_weights = self.pretrained_weights
-            model = UNetBuilder.unet3D(uncertainty_weights,
-                                               network_input_size[-1],
-                                               num_channels_label,
-                                               loss_function = self.loss_function,
-                                               num_classes = self.num_classes,
-                                               Dropout_On=True)
-        else:
-            logging.info("Using 2D UNet")
-            if self.epochs > 0:
-                uncertainty_weights = checkpoint_filepath
-            else:
-                uncertainty_weights = self.pretrained_weights
-            model = UNetBuilder.unet2D(uncertainty_weights,
-                                               network_input_size[-1],
-                                               num_channels_label,
-                                               loss_function = self.loss_function,
-                                               num_classes = self.num_classes,
-                                               Dropout_On = True)
-        resultsMCD = []
-        for i in range(0, 20):
-            testGene = testGenerator(Training_Input_shape, self.path, num_channels, test_image_files, self.use_algorithm)
-            resultsMCD.append(model.predict_generator(testGene,
-                                                              steps=num_test_img,
-                                                              use_multiprocessing=False,
-                                                              verbose=1))
-        resultsMCD = np.array(resultsMCD)
-        aleatoric_uncertainty = np.mean(resultsMCD * (1 - resultsMCD), axis=0)
-        epistemic_uncertainty = np.mean(resultsMCD**2, axis = 0) - np.mean(resultsMCD, axis = 0)**2
-        saveUncertainty(self.path + "/insights/", test_image_files, epistemic_uncertainty, aleatoric_uncertainty)
-        uncertainty = epistemic_uncertainty + aleatoric_uncertainty
-        saveResult(self.path + "/uncertainty/", test_image_files, uncertainty, Input_image_shape)
-        if self.evaluation == True:
-            segmentation_regression_evaluation(self.path)
+        if self.uncertainty_mode == "last_layer":
+            return last_layer_mc_model(model, "drop5")
+        return model
 
     def run(self):    
         data_prepration_results = self.data_prepration()
@@ -330,16 +406,5 @@ class Regression(object):
                                                                         num_channels,
                                                                         Input_image_shape)
 
-        if self.calculate_uncertainty == True:
-            self.uncertainty_prediction(    results,
-                                            checkpoint_filepath,
-                                            network_input_size,
-                                            Training_Input_shape,
-                                            num_channels,
-                                            test_image_files,
-                                            num_test_img,
-                                            data_dimensions ,
-                                            num_channels_label,
-                                            Input_image_shape)
         model = None
     
\ No newline at end of file
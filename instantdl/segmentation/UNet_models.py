@@ -11,6 +11,7 @@ from keras.optimizers import Adam, SGD, RMSprop
 import numpy as np
 from keras.losses import *
 import logging
+from instantdl.data_generator.metrics4losses import heteroscedastic_loss, heteroscedastic_mse
 
 class UNetBuilder(object):
     '''
@@ -18,9 +19,12 @@ class UNetBuilder(object):
     The layers consist of a convolution followed by a LeackyReLu activation and a Batch Normalization
     Dropout is integrated with a dropout rate of 20% during training to increase generalizability
     Padding has bee set to "same"
+    If heteroscedastic is True, a second head predicts the log variance of each output channel, which is concatenated
+    to the prediction along the channel axis. The model is then trained with the heteroscedastic loss and predicts
+    the aleatoric uncertainty in a single forward pass
     '''
 
-    def unet2D(pretrained_weights, num_channels_input, num_channels_label, num_classes, loss_function, Dropout_On, base_n_filters = 32):
+    def unet2D(pretrained_weights, num_channels_input, num_channels_label, num_classes, loss_function, Dropout_On, base_n_filters = 32, heteroscedastic = False):
         logging.info("started UNet")
         inputs = Input(shape = (None, None, num_channels_input))
         conv1 = Conv2D(base_n_filters, 3, padding='same', kernel_initializer='he_normal')(inputs)
@@ -67,7 +71,7 @@ class UNetBuilder(object):
         conv5 = Conv2D(base_n_filters*16, 3, padding='same', kernel_initializer='he_normal')(conv5)
         conv5 = BatchNormalization()(conv5)
         conv5 = LeakyReLU(alpha=0.2)(conv5)
-        drop5 = Dropout(0.2)(conv5, training = Dropout_On)
+        drop5 = Dropout(0.2, name = 'drop5')(conv5, training = Dropout_On)
 
         up6 = Conv2D(base_n_filters*8, 2, padding='same', kernel_initializer='he_normal')(UpSampling2D(size=(2, 2))(drop5))
         merge6 = concatenate([drop4, up6], axis=3)
@@ -113,10 +117,19 @@ class UNetBuilder(object):
         else:
             conv10 = Conv2D(num_channels_label, 1, activation='sigmoid')(conv9)  # Simple segmentation with only one label
 
+        metrics = ['mse']
+        if heteroscedastic == True:
+            log_variance = Conv2D(num_classes if num_classes > 1 else num_channels_label, 1, activation='linear', name='log_variance')(conv9)
+            conv10 = concatenate([conv10, log_variance], axis=-1)
+            if loss_function is not heteroscedastic_loss:
+                logging.warning("The heteroscedastic UNet is trained with the heteroscedastic loss instead of %s" % loss_function)
+            loss_function = heteroscedastic_loss
+            metrics = [heteroscedastic_mse]
+
         model2D = Model(inputs=inputs, outputs=conv10)
         logging.info("shape input UNet %s" % np.shape(inputs))
         logging.info("shape output UNet %s" % np.shape(conv10))
-        model2D.compile(optimizer="Adam", loss = loss_function, metrics=['mse'])
+        model2D.compile(optimizer="Adam", loss = loss_function, metrics=metrics)
 
         if (pretrained_weights):
             model2D.load_weights(pretrained_weights, by_name=True, skip_mismatch=True)
@@ -130,7 +143,7 @@ class UNetBuilder(object):
 
         return model2D
 
-    def unet3D(pretrained_weights, num_channels_input, num_channels_label, num_classes, loss_function, Dropout_On, base_n_filters=32):
+    def unet3D(pretrained_weights, num_channels_input, num_channels_label, num_classes, loss_function, Dropout_On, base_n_filters=32, heteroscedastic = False):
         logging.info("started UNet")
         inputs = Input(shape=(None, None, None, num_channels_input))
         conv1 = Conv3D(base_n_filters, 3, padding='same', kernel_initializer='he_normal')(inputs)
@@ -176,7 +189,7 @@ class UNetBuilder(object):
         conv5 = Conv3D(base_n_filters * 16, 3, padding='same', kernel_initializer='he_normal')(conv5)
         conv5 = BatchNormalization()(conv5)
         conv5 = LeakyReLU(alpha=0.2)(conv5)
-        drop5 = Dropout(rate=0.3)(conv5, training = Dropout_On)
+        drop5 = Dropout(rate=0.3, name = 'drop5')(conv5, training = Dropout_On)
 
         up6 = Conv3D(base_n_filters * 8, 2, padding='same', kernel_initializer='he_normal')(
             UpSampling3D(size=(2, 2, 2))(drop5))
@@ -227,10 +240,19 @@ class UNetBuilder(object):
         else:
             conv10 = Conv3D(num_channels_label, 1, activation='sigmoid')(conv9)  # Changed activiation from Relu to linear
 
+        metrics = ['mse']
+        if heteroscedastic == True:
+            log_variance = Conv3D(num_classes if num_classes > 1 else num_channels_label, 1, activation='linear', name='log_variance')(conv9)
+            conv10 = concatenate([conv10, log_variance], axis=-1)
+            if loss_function is not heteroscedastic_loss:
+                logging.warning("The heteroscedastic UNet is trained with the heteroscedastic loss instead of %s" % loss_function)
+            loss_function = heteroscedastic_loss
+            metrics = [heteroscedastic_mse]
+
         model3D = Model(inputs=inputs, outputs=conv10)
         logging.info("shape input UNet %s" % np.shape(inputs))
         logging.info("shape output UNet %s" % np.shape(conv10))
-        model3D.compile(optimizer="Adam", loss=loss_function, metrics=['mse'])
+        model3D.compile(optimizer="Adam", loss=loss_function, metrics=metrics)
 
         if (pretrained_weights):
             model3D.load_weights(pretrained_weights, by_name=True, skip_mismatch=True)
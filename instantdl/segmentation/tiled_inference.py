@@ -0,0 +1,207 @@
+'''
+InstantDL
+Sliding window inference for the fully convolutional UNet
+The test images are predicted in overlapping tiles of a fixed size, which are batched through the model and
+stitched together with a Gaussian weighting, so that the predictions are saved in the original image size
+and the memory needed by the model only depends on the tile size and the number of tiles in one batch.
+The Monte Carlo dropout uncertainty is sampled and blended in the same tiles.
+'''
+
+import numpy as np
+import logging
+import os
+from functools import partial
+from instantdl.data_generator.dataset_statistics import get_dataset_min_max
+from instantdl.data_generator.data_generator import import_image, normalize_image, get_dtype, saveResult
+from instantdl.data_generator.mc_dropout import mc_dropout_statistics, MC_SAMPLES
+
+def gaussian_weights(tile_size, sigma_scale = 0.125):
+    '''
+    Creates a weight map for one tile, which is largest in the center and decreases towards the borders
+    so that the seams between the tiles are not visible
+
+    Args:
+        tile_size: the spatial dimensions of one tile
+        sigma_scale: standard deviation of the Gaussian relative to the tile size
+
+    return:
+        weights: array with the dimensions tile_size
+    '''
+    weights = np.ones(tuple(tile_size), dtype = np.float32)
+    for axis, size in enumerate(tile_size):
+        coordinates = np.arange(size) - (size - 1) / 2.
+        axis_weights = np.exp(-coordinates**2 / (2 * (sigma_scale * size)**2)).astype(np.float32)
+        shape = [1] * len(tile_size)
+        shape[axis] = size
+        weights = weights * axis_weights.reshape(shape)
+    # The borders of the image are only covered by the borders of a tile, so the weights must not be zero
+    return np.maximum(weights / np.max(weights), 1e-3)
+
+def tile_positions(image_shape, tile_size, overlap):
+    '''
+    Returns the corners of the tiles which cover an image with the given overlap
+    The last tile of each axis is aligned with the image border
+
+    Args:
+        image_shape: the spatial dimensions of the image, each at least the tile size
+        tile_size: the spatial dimensions of one tile
+        overlap: the overlap of neighbouring tiles as fraction of the tile size (0 - 1)
+
+    return:
+        list of tile corners
+    '''
+    axis_positions = []
+    for size, tile in zip(image_shape, tile_size):
+        step = max(int(tile * (1 - overlap)), 1)
+        positions = list(range(0, size - tile + 1, step))
+        if positions[-1] != size - tile:
+            positions.append(size - tile)
+        axis_positions.append(positions)
+    return [tuple(corner) for corner in np.array(np.meshgrid(*axis_positions, indexing = 'ij')).reshape(len(tile_size), -1).T]
+
+def blend_tiles(predict_tiles, image, tile_size, overlap = 0.25, tile_batchsize = 4):
+    '''
+    Predicts one image in overlapping tiles and blends each of the maps predicted for the tiles with Gaussian weights
+
+    Args:
+        predict_tiles: function which returns a list of maps, e.g. the prediction and its uncertainty,
+                        for a batch of tiles
+        image: the normalized image with the dimensions (spatial dimensions, channels)
+        tile_size: the spatial dimensions of one tile, each divisible by 16 for the UNet
+        overlap: the overlap of neighbouring tiles as fraction of the tile size (0 - 1)
+        tile_batchsize: the number of tiles which are predicted at once
+
+    return:
+        maps: list of the blended maps with the spatial dimensions of the image
+    '''
+    tile_size = tuple(tile_size)
+    image_shape = np.shape(image)[:len(tile_size)]
+    # Images smaller than one tile are padded
+    padding = [(0, max(tile - size, 0)) for size, tile in zip(image_shape, tile_size)] + [(0, 0)]
+    if any(pad[1] > 0 for pad in padding):
+        image = np.pad(image, padding, mode = 'reflect' if all(size > 1 for size in image_shape) else 'constant')
+    padded_shape = np.shape(image)[:len(tile_size)]
+    weights = gaussian_weights(tile_size)
+    corners = tile_positions(padded_shape, tile_size, overlap)
+    maps = None
+    weight_sum = np.zeros(padded_shape, dtype = np.float32)
+    for start in range(0, len(corners), tile_batchsize):
+        batch_corners = corners[start:start + tile_batchsize]
+        regions = [tuple(slice(c, c + t) for c, t in zip(corner, tile_size)) for corner in batch_corners]
+        tiles = np.stack([image[region] for region in regions], axis = 0)
+        tile_maps = [np.asarray(tile_map, dtype = np.float32) for tile_map in predict_tiles(tiles)]
+        if maps is None:
+            maps = [np.zeros(padded_shape + np.shape(tile_map)[len(tile_size) + 1:], dtype = np.float32) for tile_map in tile_maps]
+        for i, region in enumerate(regions):
+            for blended, tile_map in zip(maps, tile_maps):
+                blended[region] += tile_map[i] * weights.reshape(weights.shape + (1,) * (tile_map[i].ndim - len(tile_size)))
+            weight_sum[region] += weights
+    crop = tuple(slice(0, size) for size in image_shape)
+    return [(blended / weight_sum.reshape(weight_sum.shape + (1,) * (blended.ndim - len(tile_size))))[crop] for blended in maps]
+
+def predict_tiled(model, image, tile_size, overlap = 0.25, tile_batchsize = 4):
+    '''
+    Predicts one image in overlapping tiles and blends the tile predictions with Gaussian weights
+
+    Args:
+        model: the trained model, which accepts inputs of the tile size
+        image: the normalized image with the dimensions (spatial dimensions, channels)
+        tile_size: the spatial dimensions of one tile, each divisible by 16 for the UNet
+        overlap: the overlap of neighbouring tiles as fraction of the tile size (0 - 1)
+        tile_batchsize: the number of tiles which are predicted at once
+
+    return:
+        prediction: the prediction with the spatial dimensions of the image
+    '''
+    return blend_tiles(lambda tiles: [model.predict(tiles)], image, tile_size, overlap, tile_batchsize)[0]
+
+def predict_tiled_uncertainty(model, mc_model, image, tile_size, overlap = 0.25, tile_batchsize = 4,
+                                num_samples = MC_SAMPLES, tolerance = None):
+    '''
+    Predicts one image in overlapping tiles together with its Monte Carlo dropout uncertainty
+    All samples of a batch of tiles are predicted back to back, so that the memory only depends on the tile size
+
+    Args:
+        model: the trained model, whose prediction counts as the first sample
+        mc_model: the model with dropout active during inference, e.g. a LastLayerMCModel
+        image: the normalized image with the dimensions (spatial dimensions, channels)
+        tile_size: the spatial dimensions of one tile, each divisible by 16 for the UNet
+        overlap: the overlap of neighbouring tiles as fraction of the tile size (0 - 1)
+        tile_batchsize: the number of tiles which are predicted at once
+        num_samples: the number of Monte Carlo samples, the maximal number if a tolerance is given
+        tolerance: None to use num_samples samples for all tiles, otherwise the tolerance of the adaptive sampling
+
+    return:
+        prediction, epistemic, aleatoric: the prediction and its uncertainty with the spatial dimensions of the image
+    '''
+    def predict_tiles(tiles):
+        prediction = model.predict(tiles)
+        statistics = mc_dropout_statistics(mc_model, tiles, prediction, num_samples, tolerance)
+        return [prediction, statistics.epistemic, statistics.aleatoric]
+    return blend_tiles(predict_tiles, image, tile_size, overlap, tile_batchsize)
+
+def load_test_image(test_path, test_file, Folder_Names, X_min, X_max, num_channels, dtype = np.float32):
+    '''
+    Imports one test image in its original size from all image folders, normalizes it and concatenates
+    the folders along the channel axis
+    '''
+    X = []
+    for index, folder_name in enumerate(Folder_Names):
+        if os.path.isdir(test_path + folder_name) == True:
+            image_data = import_image(test_path + folder_name + test_file, mmap_mode = 'r')
+            image_data = normalize_image(np.asarray(image_data, dtype = np.float32), X_min[index], X_max[index])
+            if np.shape(image_data)[-1] != num_channels:
+                image_data = image_data[..., np.newaxis]
+            X.append(image_data)
+    return np.nan_to_num(np.concatenate(X, axis = -1)).astype(dtype, copy = False)
+
+def tiled_prediction(model, path, test_image_files, num_channels, tile_size, overlap = 0.25, tile_batchsize = 4,
+                        normalization_args = None, dtype = "float32", sink = None,
+                        uncertainty_sink = None, mc_model = None, mc_samples = MC_SAMPLES, mc_tolerance = None):
+    '''
+    Predicts all images in the test folder with sliding window inference and hands the prediction of each image
+    to the sink as soon as it is predicted. By default the predictions are saved in their original size
+    to the results folder in the project directory
+    If an uncertainty_sink is given, the Monte Carlo dropout uncertainty is predicted in the same tiles
+
+    Args:
+        model: the trained model
+        path: path to the project directory
+        test_image_files: list of filenames in the test dataset
+        num_channels: the number of channels of one image. Typically 1 (grayscale) or 3 (rgb)
+        tile_size: the spatial dimensions of one tile, e.g. [256, 256], each divisible by 16
+        overlap: the overlap of neighbouring tiles as fraction of the tile size (0 - 1)
+        tile_batchsize: the number of tiles which are predicted at once
+        normalization_args: settings for the computation of the min and max values used for normalization
+        dtype: data type of the tiles passed to the model, "float32" or "float16"
+        sink: function which is called with the filename and the prediction of each image in a list,
+                see predict_to_sink in data_generator.py
+        uncertainty_sink: function which is called with the filename, the epistemic and the aleatoric uncertainty
+                of each image in a list, e.g. UncertaintyWriter in data_generator.py
+        mc_model: the model which predicts the Monte Carlo samples, by default the model
+        mc_samples: the number of Monte Carlo samples, the maximal number if mc_tolerance is given
+        mc_tolerance: None to use mc_samples samples for all tiles, otherwise the tolerance of the adaptive sampling
+
+    return:
+        the number of predicted images
+    '''
+    if any(int(tile) % 16 != 0 for tile in tile_size):
+        raise ValueError("The tile size %s needs to be divisible by 16 in each dimension" % (tile_size,))
+    test_path = path + "/test/"
+    Folder_Names = ["/image/", "/image1/", "/image2/", "/image3/",
+                        "/image4/", "/image5/", "/image6/", "/image7/"]
+    X_min, X_max = get_dataset_min_max(test_path, Folder_Names, test_image_files,
+                                        normalization_args = normalization_args)
+    if sink is None:
+        sink = partial(saveResult, path + "/results/")
+    for test_file in test_image_files:
+        image = load_test_image(test_path, test_file, Folder_Names, X_min, X_max, num_channels, get_dtype(dtype))
+        if uncertainty_sink is None:
+            prediction = predict_tiled(model, image, tile_size, overlap, tile_batchsize)
+        else:
+            prediction, epistemic, aleatoric = predict_tiled_uncertainty(model, model if mc_model is None else mc_model,
+                                                            image, tile_size, overlap, tile_batchsize, mc_samples, mc_tolerance)
+            uncertainty_sink([test_file], epistemic[np.newaxis], aleatoric[np.newaxis])
+        logging.info("Predicted %s with the shape %s" % (test_file, np.shape(prediction),))
+        sink([test_file], prediction[np.newaxis])
+    return len(test_image_files)
@@ -3,11 +3,14 @@ import logging
 import argparse
 import os
 import json
+import numpy as np
 from instantdl.data_generator.data_generator import *
 from instantdl.data_generator.auto_evaluation_classification import classification_evaluation
 from instantdl.data_generator.auto_evaluation_segmentation_regression import segmentation_regression_evaluation
 from instantdl.segmentation.UNet_models import UNetBuilder
-from keras.callbacks import ModelCheckpoint, TensorBoard, EarlyStopping
+from instantdl.segmentation.tiled_inference import tiled_prediction
+from instantdl.data_generator.mc_dropout import mc_dropout_classification, mc_dropout_uncertainty, last_layer_mc_model
+from keras.callbacks import ModelCheckpoint, TensorBoard, EarlyStopping, Callback
 import time
 import tensorflow as tf
 tf.get_logger().setLevel('WARNING')
@@ -28,3 +31,82 @@ from instantdl.data_generator.metrics4losses import *
 def load_json(file_path):
     with open(file_path, 'r') as stream:
         return json.load(stream)
+
+'''
+The options of the data loading, the patch based training, the tiled inference and the uncertainty estimation,
+which are shared by the pipelines, with their default values. They are explained in the README
+'''
+PIPELINE_OPTIONS = {"workers": 1,
+                    "max_queue_size": 50,
+                    "decode_threads": 4,
+                    "prefetch": False,
+                    "cache_dataset": False,
+                    "dtype": "float32",
+                    "patch_size": None,
+                    "patches_per_epoch": 1000,
+                    "tile_size": None,
+                    "tile_overlap": 0.25,
+                    "tile_batchsize": 4,
+                    "test_batchsize": 1,
+                    "writer_threads": 4,
+                    "mc_samples": 20,
+                    "mc_tolerance": None,
+                    "uncertainty_mode": "mc_dropout",
+                    "augment_workers": 0,
+                    "augmentation_variants": 0,
+                    "augmentation_refresh": 0}
+
+def set_pipeline_options(pipeline, options, uncertainty_modes = ("mc_dropout", "last_layer", "heteroscedastic"),
+                         ignored_options = ()):
+    '''
+    Sets the PIPELINE_OPTIONS as attributes of the pipeline, the options which are not given keep their default value
+    Args:
+        pipeline: the Regression, SemanticSegmentation, Classification or InstanceSegmentation pipeline
+        options: dict of the options given to the pipeline
+        uncertainty_modes: the uncertainty modes which the pipeline supports
+        ignored_options: the options which the pipeline does not use, a warning is logged if they are changed
+    '''
+    unknown_options = sorted(set(options) - set(PIPELINE_OPTIONS))
+    if len(unknown_options) > 0:
+        raise TypeError("%s got the unknown options %s" % (pipeline.use_algorithm, ", ".join(unknown_options)))
+    for option, default in PIPELINE_OPTIONS.items():
+        setattr(pipeline, option, options.get(option, default))
+    changed_options = [option for option in PIPELINE_OPTIONS if getattr(pipeline, option) != PIPELINE_OPTIONS[option]]
+    ignored = [option for option in changed_options if option in ignored_options]
+    if len(ignored) > 0:
+        logging.warning("%s does not use the options %s, they are ignored" % (pipeline.use_algorithm, ", ".join(ignored)))
+    if pipeline.patch_size is not None and "patch_size" not in ignored_options:
+        # The dataset cache and the augmentation variants store the resized images, while the patches are read
+        # from the images in their original size and augmented in every batch
+        ignored = [option for option in changed_options if option in ["cache_dataset", "augmentation_variants", "augmentation_refresh"]]
+        if len(ignored) > 0:
+            logging.warning("The options %s are not used with patch_size, they are ignored" % ", ".join(ignored))
+        if pipeline.tile_size is None:
+            # The model is trained on patches, so the test images of any size are predicted in tiles of the patch size
+            pipeline.tile_size = pipeline.patch_size
+    if "uncertainty_mode" not in ignored_options and pipeline.uncertainty_mode not in uncertainty_modes:
+        raise ValueError("The uncertainty_mode %s is not supported for %s, use %s" % (pipeline.uncertainty_mode, pipeline.use_algorithm,
+                                                                                     " or ".join(uncertainty_modes)))
+
+class BestWeights(Callback):
+    '''
+    Keeps the weights of the epoch with the lowest validation loss in memory and restores them into the model
+    when the training ends, so that the trained model is tested without building a new model and loading
+    the checkpoint from disk. The epoch is selected like in the ModelCheckpoint with save_best_only
+    '''
+    def __init__(self, monitor = 'val_loss'):
+        super(BestWeights, self).__init__()
+        self.monitor = monitor
+        self.best = np.inf
+        self.best_weights = None
+
+    def on_epoch_end(self, epoch, logs = None):
+        current = (logs or {}).get(self.monitor)
+        if current is not None and current < self.best:
+            self.best = current
+            self.best_weights = self.model.get_weights()
+
+    def on_train_end(self, logs = None):
+        if self.best_weights is not None:
+            logging.info("Restoring the weights with the best %s %s" % (self.monitor, self.best))
+            self.model.set_weights(self.best_weights)
@@ -0,0 +1,63 @@
+"""
+InstantDL
+Tests for the offline augmentation cache
+"""
+
+from instantdl.data_generator.augmentation_cache import *
+from instantdl.data_generator.data_generator import TrainingDataSequence
+import numpy as np
+import os
+import pickle
+import shutil
+
+def test_AugmentationCache():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_augmentation/train/image/", exist_ok=True)
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_augmentation/train/groundtruth/", exist_ok=True)
+    image_files = ["image" + str(i) + ".npy" for i in range(0, 5)]
+    for i, img_file in enumerate(image_files):
+        image = np.zeros((16, 16), dtype="float32")
+        image[:, :8] = i + 1
+        np.save(os.getcwd()+"/tests/data_generator/testimages_augmentation/train/image/" + img_file, image)
+        np.save(os.getcwd()+"/tests/data_generator/testimages_augmentation/train/groundtruth/" + img_file, image)
+    data_path = os.getcwd()+"/tests/data_generator/testimages_augmentation/train/"
+    sequence = TrainingDataSequence((16, 16, 1), 2, 1, 1, image_files[:4], {"horizontal_flip": True}, 2,
+                                    data_path, "Regression", shuffle = False, augmentation_variants = 3)
+    cache_file = os.getcwd()+"/tests/data_generator/testimages_augmentation/cache/train_augmented.h5"
+    assert os.path.isfile(cache_file)
+    with h5py.File(cache_file, 'r') as cache:
+        assert cache["X"].shape == (5, 3, 16, 16, 1) and cache["X"].dtype == CACHE_DTYPE
+        assert cache["Y"].shape == (5, 3, 16, 16, 1)
+
+    # Each batch reads one of the variants, which are flipped or not
+    X, Y = sequence[0]
+    assert np.shape(X) == (2, 16, 16, 1) and X.dtype == np.float32
+    assert (X == Y).all()
+    original = np.load(data_path + "/image/image0.npy")[..., np.newaxis] / 5.
+    assert np.allclose(X[0], original, atol = 1e-3) or np.allclose(X[0], original[:, ::-1], atol = 1e-3)
+    # The sequence is copied to the background writer, which opens the file again
+    assert np.shape(pickle.loads(pickle.dumps(sequence))[1][0]) == (2, 16, 16, 1)
+
+    # The validation data reuses the variants, other augmentation settings write them again
+    inode = os.stat(cache_file).st_ino
+    validation = TrainingDataSequence((16, 16, 1), 2, 1, 1, image_files[4:], {"horizontal_flip": True}, 2,
+                                    data_path, "Regression", shuffle = False, augmentation_variants = 3)
+    assert os.stat(cache_file).st_ino == inode
+    assert np.shape(validation[0][0]) == (1, 16, 16, 1)
+    other = TrainingDataSequence((16, 16, 1), 2, 1, 1, image_files[4:], {"vertical_flip": True}, 2,
+                                    data_path, "Regression", shuffle = False, augmentation_variants = 3)
+    assert os.stat(cache_file).st_ino != inode
+
+    # A new set of variants replaces the file, which the loaders open again
+    cache = other.augmentation_cache
+    cache.read(image_files[:1], 0)
+    inode = cache._inode
+    write_variants(other, cache.image_files, cache.variants, cache.cache_file, cache.fingerprint)
+    cache.read(image_files[:1], 0)
+    assert cache._inode != inode
+    # The variants only depend on the epoch and the batch index and not on the global random state
+    X = cache.read(image_files[:4], 1)[0]
+    np.random.rand(10)
+    assert (cache.read(image_files[:4], 1)[0] == X).all()
+    for loader in [sequence, validation, other]:
+        loader.close()
+    shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_augmentation/")
@@ -0,0 +1,24 @@
+import pytest
+import numpy as np
+from instantdl.data_generator.augmentation_pool import AugmentationPool
+
+def test_AugmentationPool():
+    X = np.tile(np.arange(16, dtype = np.float32).reshape(1, 4, 4, 1), (6, 1, 1, 1))
+    pool = AugmentationPool(8, (4, 4, 1), (4, 4, 1), {"horizontal_flip": True}, 2, depth = 2, seed = 1)
+    X_augmented, Y_augmented = pool.augment(X, X + 1, "Random")
+    assert np.shape(X_augmented) == (6, 4, 4, 1) and np.shape(Y_augmented) == (6, 4, 4, 1)
+    assert np.array_equal(Y_augmented, X_augmented + 1)
+    for image in X_augmented:
+        assert np.array_equal(image, X[0]) or np.array_equal(image, X[0, :, ::-1])
+    # Only X is augmented if there is no groundtruth
+    X_augmented, Y_augmented = pool.augment(X[:3], None, "Random")
+    assert np.shape(X_augmented) == (3, 4, 4, 1) and Y_augmented is None
+    pool.close()
+    # A worker draws the same augmentations for the same seed
+    X = np.tile(np.random.rand(1, 16, 16, 1).astype(np.float32), (8, 1, 1, 1))
+    augmented = []
+    for i in range(2):
+        pool = AugmentationPool(8, (16, 16, 1), None, {"rotation_range": 45}, 1, seed = 3)
+        augmented.append(pool.augment(X, None, "Random")[0])
+        pool.close()
+    assert np.array_equal(augmented[0], augmented[1])
@@ -1,6 +1,8 @@
 import pytest
 import numpy as np
-from instantdl.data_generator.data_augmentation import data_augentation
+from scipy.ndimage import rotate
+from skimage.transform import resize
+from instantdl.data_generator.data_augmentation import data_augentation, affine_warp, rotation_matrix, crop_matrix, compose, rotate_quarter_turns
 
 def test_data_augentation():
     shape = (128,128,3)
@@ -42,6 +44,77 @@ def test_data_augentation():
                      "threshold_background_groundtruth": False,
                      "binarize_mask": False
                      }
-    assert np.shape(data_augentation(X, X, data_gen_args, data_path_file_name)[0]) == shape
+    # The zoom may crop the image to a region inside or outside of the square
+    X_augmented = data_augentation(X, X, data_gen_args, data_path_file_name)[0]
+    assert np.shape(X_augmented) == shape
+    assert np.max(X_augmented) <= 255. and np.min(X_augmented) >= 0.
+    data_gen_args["zoom_range"] = False
     assert np.max(data_augentation(X, X, data_gen_args, data_path_file_name)[0]) == 255.
-    assert np.min(data_augentation(X, X, data_gen_args, data_path_file_name)[0]) == 0.
\ No newline at end of file
+    assert np.min(data_augentation(X, X, data_gen_args, data_path_file_name)[0]) == 0.
+
+def test_data_augentation_dtype():
+    X = np.random.rand(2, 64, 64, 1)
+    data_gen_args = {"rotation_range": 10, "zoom_range": 0.2, "width_shift_range": 0.2, "gaussian_noise": 0.1,
+                     "gaussian_blur_image": 1, "contrast_range": 0.5, "brightness_range": 0.5}
+    for i in range(0, 5):
+        X_augmented, Y_augmented = data_augentation(X, X, data_gen_args, "Random")
+        assert X_augmented.dtype == np.float32 and Y_augmented.dtype == np.float32
+
+def test_affine_warp():
+    X = np.random.rand(2, 32, 32, 1).astype(np.float32)
+    rotated = rotate(X, 10, axes = (1, 2), reshape = False, order = 1, mode = 'nearest')
+    assert np.allclose(affine_warp(X, rotation_matrix(10, (32, 32)), order = 1), rotated, atol = 1e-5)
+    cropped = X[:, 4:20, 8:32, :]
+    transform = crop_matrix((4, 8), (16, 24), (32, 32))
+    resized = resize(cropped[0, ..., 0], (32, 32), order = 0, anti_aliasing = False)
+    assert np.array_equal(affine_warp(X, transform, order = 0)[0, ..., 0], resized)
+    Y = np.random.randint(0, 3, (1, 8, 32, 32, 2)).astype(np.float32)
+    warped = affine_warp(Y, compose(rotation_matrix(30, (32, 32)), transform), order = 0)
+    assert np.shape(warped) == np.shape(Y)
+    assert set(np.unique(warped)) <= set(np.unique(Y))
+    assert np.array_equal(affine_warp(Y, np.eye(3), order = 0), Y)
+
+def test_data_augentation_per_image():
+    X = np.tile(np.arange(16, dtype = np.float32).reshape(1, 4, 4, 1), (30, 1, 1, 1))
+    X_augmented, Y_augmented = data_augentation(X, X + 1, {"horizontal_flip": True}, "Random")
+    flipped = np.array([np.array_equal(image, X[0, :, ::-1]) for image in X_augmented])
+    unchanged = np.array([np.array_equal(image, X[0]) for image in X_augmented])
+    assert np.all(flipped | unchanged) and flipped.any() and unchanged.any()
+    assert np.array_equal(Y_augmented, X_augmented + 1)
+    X = np.tile(np.random.rand(1, 32, 32, 1), (8, 1, 1, 1))
+    X_augmented, Y_augmented = data_augentation(X, X, {"rotation_range": 45}, "Random")
+    assert len(np.unique(X_augmented.reshape(8, -1), axis = 0)) > 1
+    transform = rotation_matrix(np.array([0, 10]), (32, 32))
+    assert np.shape(transform) == (2, 3, 3)
+    warped = affine_warp(X[:2], transform, order = 1)
+    assert np.allclose(warped[0], X[0])
+    assert np.allclose(warped[1], affine_warp(X[1:2], rotation_matrix(10, (32, 32)), order = 1)[0])
+
+def test_data_augentation_shift_zoom():
+    X = np.tile(np.random.RandomState(0).rand(1, 32, 32, 1).astype(np.float32), (40, 1, 1, 1))
+    for data_gen_args in [{"width_shift_range": 0.3}, {"height_shift_range": 0.3}, {"zoom_range": 0.3}]:
+        X_augmented, Y_augmented = data_augentation(X, X, data_gen_args, "Random")
+        # Each image is shifted or zoomed by a 50% chance with its own parameters
+        unchanged = np.array([np.allclose(image, X[0]) for image in X_augmented])
+        assert unchanged.any() and not unchanged.all()
+        assert len(np.unique(X_augmented[~unchanged].reshape(np.sum(~unchanged), -1), axis = 0)) > 1
+        assert np.shape(X_augmented) == np.shape(X)
+
+def test_affine_warp_volume():
+    from scipy.ndimage import affine_transform
+    X = np.random.rand(2, 6, 24, 24, 2).astype(np.float32)
+    transforms = [compose(rotation_matrix(17, (24, 24)), crop_matrix((2, 3), (20, 19), (24, 24))),
+                  crop_matrix((2, 3), (20, 19), (24, 24)), crop_matrix((3, 1), (24, 24), (24, 24))]
+    for transform in transforms:
+        for order in [0, 1]:
+            warped = affine_warp(X, transform, order = order)
+            for sample, depth, channel in [(0, 0, 0), (1, 5, 1)]:
+                expected = affine_transform(X[sample, depth, :, :, channel], transform[:2, :2], offset = transform[:2, 2],
+                                            order = order, mode = 'nearest')
+                assert np.allclose(warped[sample, depth, :, :, channel], expected, atol = 1e-5)
+    # Quarter turns of square planes permute the pixels in the direction of rotation_matrix
+    rotated = rotate_quarter_turns(X, np.array([1, 2]), (2, 3))
+    assert np.array_equal(rotated[0], affine_warp(X[:1], rotation_matrix(90, (24, 24)), order = 1)[0])
+    assert np.array_equal(rotated[1], X[1, :, ::-1, ::-1])
+    X_augmented, Y_augmented = data_augentation(X, X, {"rotation_range": 360}, "Random")
+    assert np.shape(X_augmented) == np.shape(X) and np.shape(Y_augmented) == np.shape(X)
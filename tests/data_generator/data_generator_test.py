@@ -7,7 +7,10 @@ Written by Dominik Waibel
 from instantdl.data_generator.data_generator import *
 from skimage.io import imsave, imread
 import os
+import sys
+from functools import partial
 import pandas as pd
+import pytest
 import shutil
 
 def test_get_min_max():
@@ -25,6 +28,25 @@ def test_import_image():
     assert np.mean(import_image(os.getcwd()+"/tests/data_generator/testimages/image1.jpg")) == 255.0
     assert np.mean(import_image(os.getcwd()+"/tests/data_generator/testimages/image1.jpg")) == 255.0
 
+def test_load_image_mmap(monkeypatch):
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_mmap/", exist_ok=True)
+    volume = np.arange(8*16*16, dtype="uint16").reshape(8, 16, 16)
+    np.save(os.getcwd()+"/tests/data_generator/testimages_mmap/volume.npy", volume)
+    assert isinstance(import_image(os.getcwd()+"/tests/data_generator/testimages_mmap/volume.npy", mmap_mode = 'r'), np.memmap)
+    # The memory mapped volume is normalized directly into the slot of the preallocated batch
+    X = allocate_batch(2, (8, 16, 16))
+    load_image(os.getcwd()+"/tests/data_generator/testimages_mmap/volume.npy", (8, 16, 16), 0., 2047., X[1])
+    assert np.allclose(X[1], volume / 2047.)
+    # A volume without the channel dimension is not resized to the input shape with one channel
+    def resize_not_called(*args, **kwargs):
+        raise AssertionError("the volume must not be resized")
+    monkeypatch.setattr(sys.modules[load_image.__module__], "resize", resize_not_called)
+    X = allocate_batch(2, (8, 16, 16, 1))
+    load_image(os.getcwd()+"/tests/data_generator/testimages_mmap/volume.npy", (8, 16, 16, 1), 0., 2047., X[0])
+    assert np.allclose(X[0, ..., 0], volume / 2047.)
+    assert np.shape(resize_image(volume[..., np.newaxis], (8, 16, 16))) == (8, 16, 16)
+    shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_mmap/")
+
 def test_image_generator():
     os.makedirs(os.getcwd()+"/tests/data_generator/testimages/", exist_ok=True)
     imsave(os.getcwd()+"/tests/data_generator/testimages/image.jpg", np.zeros((128,128,3)))
@@ -61,7 +83,7 @@ def test_training_data_generator_classification():
     imsave(os.getcwd()+"/tests/data_generator/testimages_classification/train/image/image.jpg", X_true)
     imsave(os.getcwd()+"/tests/data_generator/testimages_classification/train/image/image1.jpg", X_true)
     imsave(os.getcwd()+"/tests/data_generator/testimages_classification/train/image/image2.jpg", X_true)
-    labels = {"filename": ['image.jpg', 'iamge1.jpg', 'image2.jpg'], 'groundtruth': [0, 1, 2]}
+    labels = {"filename": ['image.jpg', 'image1.jpg', 'image2.jpg'], 'groundtruth': [0, 1, 2]}
     gt = pd.DataFrame(labels, columns=['filename', 'groundtruth'])
     gt.to_csv(os.getcwd()+"/tests/data_generator/testimages_classification/train/groundtruth/groundtruth.csv")
     class_generator = training_data_generator_classification((3,128,128,3), 1, 3, 3,
@@ -72,6 +94,212 @@ def test_training_data_generator_classification():
     assert ((next(class_generator)[0])== X_true).all
     assert ((next(class_generator)[1])== [1.,0.,0.,]).all
 
+def test_TrainingDataSequence():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_sequence/train/image/", exist_ok=True)
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_sequence/train/groundtruth/", exist_ok=True)
+    for i in range(0, 5):
+        image = np.zeros((32, 32), dtype="uint8")
+        image[:16, :] = i
+        imsave(os.getcwd()+"/tests/data_generator/testimages_sequence/train/image/image" + str(i) + ".tif", image)
+        imsave(os.getcwd()+"/tests/data_generator/testimages_sequence/train/groundtruth/image" + str(i) + ".tif", image)
+    train_image_files = ["image" + str(i) + ".tif" for i in range(0, 5)]
+    sequence = TrainingDataSequence((32, 32, 1), 2, 1, 1, train_image_files, {}, 2,
+                                    os.getcwd()+"/tests/data_generator/testimages_sequence/train/", "Regression", shuffle = False)
+    # The last batch contains the remaining file
+    assert len(sequence) == 3
+    assert np.shape(sequence[0][0]) == (2, 32, 32, 1)
+    assert np.shape(sequence[2][0]) == (1, 32, 32, 1)
+    assert np.max(sequence[2][0]) == 1.
+    assert np.max(sequence[0][1]) == 0.25
+    # Each file is used once per epoch, also after shuffling
+    sequence.shuffle = True
+    sequence.on_epoch_end()
+    assert sorted(sum([sequence.batch_files(i) for i in range(len(sequence))], [])) == train_image_files
+    # Decoding with a thread pool and prefetching return the same batches as sequential decoding
+    sequential = TrainingDataSequence((32, 32, 1), 2, 1, 1, train_image_files, {}, 2,
+                                    os.getcwd()+"/tests/data_generator/testimages_sequence/train/", "Regression",
+                                    shuffle = False, decode_threads = 1)
+    prefetching = TrainingDataSequence((32, 32, 1), 2, 1, 1, train_image_files, {}, 2,
+                                    os.getcwd()+"/tests/data_generator/testimages_sequence/train/", "Regression",
+                                    shuffle = False, decode_threads = 4, prefetch = True)
+    cached = TrainingDataSequence((32, 32, 1), 2, 1, 1, train_image_files, {}, 2,
+                                    os.getcwd()+"/tests/data_generator/testimages_sequence/train/", "Regression",
+                                    shuffle = False, dataset_cache = True)
+    augmenting = TrainingDataSequence((32, 32, 1), 2, 1, 1, train_image_files, {}, 2,
+                                    os.getcwd()+"/tests/data_generator/testimages_sequence/train/", "Regression",
+                                    shuffle = False, augment_workers = 2)
+    for i in range(len(sequential)):
+        assert (sequential[i][0] == prefetching[i][0]).all()
+        assert (sequential[i][1] == prefetching[i][1]).all()
+        assert (sequential[i][0] == cached[i][0]).all()
+        assert (sequential[i][1] == cached[i][1]).all()
+        assert (sequential[i][0] == augmenting[i][0]).all()
+        assert (sequential[i][1] == augmenting[i][1]).all()
+    cached.dataset_cache.close()
+    augmenting.close()
+    # The batches are loaded into float32 buffers of a ring, which are reused, so the returned batches are copies
+    assert sequential[0][0].dtype == np.float32
+    batches = [sequential[i % len(sequential)] for i in range(sequential.ring_size + 1)]
+    assert (batches[0][0] == batches[len(sequential)][0]).all()
+    assert not any(np.shares_memory(batches[0][0], X) for X, Y in batches[1:])
+    # Additional image folders are written into their channel slice of X
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_sequence/train/image1/", exist_ok=True)
+    for i in range(0, 5):
+        image = np.zeros((32, 32), dtype="uint8")
+        image[16:, :] = 2 * i
+        imsave(os.getcwd()+"/tests/data_generator/testimages_sequence/train/image1/image" + str(i) + ".tif", image)
+    sequence = TrainingDataSequence((32, 32, 1), 2, 1, 1, train_image_files, {}, 2,
+                                    os.getcwd()+"/tests/data_generator/testimages_sequence/train/", "Regression", shuffle = False)
+    X, Y = sequence[2]
+    assert np.shape(X) == (1, 32, 32, 2)
+    assert X[0, 0, 0, 0] == 1. and X[0, 0, 0, 1] == 0.
+    assert X[0, 31, 0, 0] == 0. and X[0, 31, 0, 1] == 1.
+    shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_sequence/")
+
+def test_dtype_policy():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_dtype/train/image/", exist_ok=True)
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_dtype/train/groundtruth/", exist_ok=True)
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_dtype/test/image/", exist_ok=True)
+    for i in range(0, 4):
+        image = np.zeros((32, 32), dtype="uint16")
+        image[:16, :] = 100 * i + 1
+        imsave(os.getcwd()+"/tests/data_generator/testimages_dtype/train/image/image" + str(i) + ".tif", image)
+        imsave(os.getcwd()+"/tests/data_generator/testimages_dtype/train/groundtruth/image" + str(i) + ".tif", image)
+        imsave(os.getcwd()+"/tests/data_generator/testimages_dtype/test/image/image" + str(i) + ".tif", image)
+    train_image_files = ["image" + str(i) + ".tif" for i in range(0, 4)]
+    data_gen_args = {"rotation_range": 10, "zoom_range": 0.2, "gaussian_noise": 0.1, "horizontal_flip": True}
+    # No float64 arrays are passed to fit_generator and predict_generator
+    for dtype in ["float32", "float16"]:
+        sequence = TrainingDataSequence((16, 16, 1), 2, 1, 1, train_image_files, data_gen_args, 2,
+                                        os.getcwd()+"/tests/data_generator/testimages_dtype/train/", "Regression", dtype = dtype)
+        for i in range(len(sequence)):
+            X, Y = sequence[i]
+            assert X.dtype == np.dtype(dtype) and Y.dtype == np.dtype(dtype)
+        generator = testGenerator((16, 16, 1), os.getcwd()+"/tests/data_generator/testimages_dtype/", 1,
+                                        train_image_files, "Regression", dtype = dtype)
+        assert next(generator).dtype == np.dtype(dtype)
+    with pytest.raises(ValueError):
+        get_dtype("float64")
+    shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_dtype/")
+
+def test_PatchDataSequence():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_patches/train/image/", exist_ok=True)
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_patches/train/groundtruth/", exist_ok=True)
+    images = [np.arange(100*70, dtype="uint16").reshape(100, 70), np.arange(50*300, dtype="uint16").reshape(50, 300)]
+    for i, image in enumerate(images):
+        np.save(os.getcwd()+"/tests/data_generator/testimages_patches/train/image/image" + str(i) + ".npy", image)
+        np.save(os.getcwd()+"/tests/data_generator/testimages_patches/train/groundtruth/image" + str(i) + ".npy", image)
+    imsave(os.getcwd()+"/tests/data_generator/testimages_patches/image.tif", images[1])
+    # Only the region is read from .npy and tiff files
+    assert (read_region(os.getcwd()+"/tests/data_generator/testimages_patches/image.tif", (10, 20), (16, 32)) == images[1][10:26, 20:52]).all()
+    assert np.shape(read_region(os.getcwd()+"/tests/data_generator/testimages_patches/train/image/image0.npy", (90, 0), (16, 32))) == (10, 32)
+    assert get_image_shape(os.getcwd()+"/tests/data_generator/testimages_patches/image.tif") == (50, 300)
+    train_image_files = ["image0.npy", "image1.npy"]
+    sequence = PatchDataSequence((32, 32), 4, 1, 1, train_image_files, {}, 2,
+                                    os.getcwd()+"/tests/data_generator/testimages_patches/train/", "Regression",
+                                    patches_per_epoch = 10, shuffle = False)
+    assert len(sequence) == 3
+    X, Y = sequence[2]
+    assert np.shape(X) == (2, 32, 32, 1) and np.shape(Y) == (2, 32, 32, 1)
+    # The patches of image and groundtruth are cropped at the same position
+    assert np.allclose(X * 14999., Y * 14999.)
+    files, corners = sequence.patch_positions(0)
+    for img_file, corner, patch in zip(files, corners, sequence[0][0]):
+        image = images[train_image_files.index(img_file)]
+        assert np.allclose(patch[..., 0] * 14999., image[corner[0]:corner[0] + 32, corner[1]:corner[1] + 32], atol = 0.1)
+    # Without shuffling the same patches are used in every epoch
+    sequence.on_epoch_end()
+    assert sequence.patch_positions(0) == (files, corners)
+    shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_patches/")
+
+def test_TestDataSequence():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_testsequence/test/image/", exist_ok=True)
+    test_image_files = ["image" + str(i) + ".npy" for i in range(0, 7)]
+    for i, img_file in enumerate(test_image_files):
+        image = np.zeros((48, 32) if i % 2 == 0 else (32, 32), dtype="uint16")
+        image[:16, :] = i + 1
+        np.save(os.getcwd()+"/tests/data_generator/testimages_testsequence/test/image/" + img_file, image)
+    path = os.getcwd()+"/tests/data_generator/testimages_testsequence/"
+    # The last batch is smaller and the images are in the same order as in testGenerator
+    sequence = TestDataSequence((32, 32, 1), 3, path, 1, test_image_files, "Regression")
+    assert len(sequence) == 3
+    assert [np.shape(sequence[i]) for i in range(0, 3)] == [(3, 32, 32, 1), (3, 32, 32, 1), (1, 32, 32, 1)]
+    assert sequence[0].dtype == np.float32
+    assert sequence.test_image_files == test_image_files
+    testGene = testGenerator((32, 32, 1), path, 1, test_image_files, "Regression")
+    X = np.concatenate([sequence[i] for i in range(0, 3)])
+    assert np.allclose(X, np.concatenate([next(testGene) for _ in test_image_files]))
+    # Without an input shape the images are predicted in their original size in batches of the same shape
+    sequence = TestDataSequence(None, 3, path, 1, test_image_files, "Regression")
+    assert sequence.test_image_files == ["image0.npy", "image2.npy", "image4.npy", "image6.npy", "image1.npy", "image3.npy", "image5.npy"]
+    assert [np.shape(sequence[i]) for i in range(0, 3)] == [(3, 48, 32, 1), (1, 48, 32, 1), (3, 32, 32, 1)]
+    assert sequence.image_shape(1) == (48, 32)
+    # The predictions are handed to the sink batch by batch
+    class IdentityModel(object):
+        def predict_on_batch(self, X):
+            return X
+    batches = []
+    assert predict_to_sink(IdentityModel(), sequence, lambda files, predictions: batches.append((files, np.shape(predictions)))) == 7
+    assert batches[1] == (["image6.npy"], (1, 48, 32, 1))
+    predict_to_sink(IdentityModel(), sequence, partial(saveResult, path + "/results/"))
+    assert np.shape(imread(path + "/results/image3.npy_predict.tif")) == (32, 32)
+    shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_testsequence/")
+
+def test_ResultWriter():
+    path = os.getcwd()+"/tests/data_generator/testimages_writer/"
+    results = np.random.RandomState(0).rand(5, 32, 32, 1).astype(np.float32)
+    test_image_files = ["image" + str(i) + ".tif" for i in range(0, 5)]
+    with ResultWriter(path, (64, 64), writer_threads = 2, max_pending = 1) as writer:
+        writer(test_image_files[:3], results[:3])
+        writer(test_image_files[3:], results[3:])
+    # The writers save the same images as saveResult
+    saveResult(path + "serial/", test_image_files, results, (64, 64))
+    for img_file in test_image_files:
+        assert (imread(path + img_file + "_predict.tif") == imread(path + "serial/" + img_file + "_predict.tif")).all()
+    # Errors of the writers are raised when the writer is closed
+    writer = ResultWriter(path, (64, 64))
+    writer(["image.tif"], [None])
+    with pytest.raises(Exception):
+        writer.close()
+    shutil.rmtree(path)
+
+def test_UncertaintyWriter():
+    path = os.getcwd()+"/tests/data_generator/testimages_uncertainty/"
+    epistemic = np.random.RandomState(0).rand(3, 16, 16, 1).astype(np.float32) / 4.
+    aleatoric = np.random.RandomState(1).rand(3, 16, 16, 1).astype(np.float32) / 4.
+    with UncertaintyWriter(path, (16, 16), writer_threads = 2) as writer:
+        writer(["image.tif", "image1.tif"], epistemic[:2], aleatoric[:2])
+        writer(["image2.tif"], epistemic[2:], aleatoric[2:])
+    res = pd.read_csv(path + "/insights/uncertainty.csv")
+    assert list(res["filename"].values) == ["image.tif", "image1.tif", "image2.tif"]
+    assert np.isclose(res["mean epistemic uncertainty"].values[2], np.mean(epistemic[2]))
+    assert np.shape(imread(path + "/uncertainty/image2.tif_predict.tif")) == (16, 16)
+    shutil.rmtree(path)
+
+def test_HeteroscedasticSink():
+    results = np.concatenate([np.ones((2, 8, 8, 1)), np.log(0.1) * np.ones((2, 8, 8, 1))], axis = -1)
+    predictions = []
+    uncertainties = []
+    sink = HeteroscedasticSink(lambda files, results: predictions.append(results),
+                                lambda files, epistemic, aleatoric: uncertainties.append((epistemic, aleatoric)))
+    sink(["image.tif", "image1.tif"], results)
+    assert np.shape(predictions[0]) == (2, 8, 8, 1) and np.allclose(predictions[0], 1.)
+    assert np.allclose(uncertainties[0][0], 0.) and np.allclose(uncertainties[0][1], 0.1)
+
+def test_load_classification_labels():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_classification/train/groundtruth/", exist_ok=True)
+    csvfilepath = os.getcwd()+"/tests/data_generator/testimages_classification/train/groundtruth/groundtruth.csv"
+    labels = {"filename": ['image.jpg', 'image1.jpg', 'image2.jpg'], 'groundtruth': [0, 1, 2]}
+    pd.DataFrame(labels, columns=['filename', 'groundtruth']).to_csv(csvfilepath)
+    label_index = load_classification_labels(csvfilepath, ["image.jpg", "image2.jpg"])
+    assert label_index == {'image.jpg': 0, 'image1.jpg': 1, 'image2.jpg': 2}
+    with pytest.raises(KeyError):
+        load_classification_labels(csvfilepath, ["image.jpg", "image3.jpg"])
+    labels = {"filename": ['image.jpg', 'image1.jpg', 'image1.jpg'], 'groundtruth': [0, 1, 2]}
+    pd.DataFrame(labels, columns=['filename', 'groundtruth']).to_csv(csvfilepath)
+    with pytest.raises(ValueError):
+        load_classification_labels(csvfilepath, ["image.jpg"])
+
 #def test_testGenerator(Input_image_shape, path, num_channels, test_image_files, use_algorithm):
 #    testGenerator(Input_image_shape, path, num_channels, test_image_files, use_algorithm)
 
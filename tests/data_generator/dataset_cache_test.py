@@ -0,0 +1,51 @@
+"""
+InstantDL
+Tests for the pre-decoded dataset cache
+"""
+
+from instantdl.data_generator.dataset_cache import *
+from instantdl.data_generator.data_generator import load_resized_image
+import numpy as np
+import os
+import shutil
+
+def test_DatasetCache():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_cache/train/image/", exist_ok=True)
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_cache/train/groundtruth/", exist_ok=True)
+    image_files = ["image" + str(i) + ".npy" for i in range(0, 5)]
+    for i, img_file in enumerate(image_files):
+        image = np.zeros((32, 32), dtype="uint8")
+        image[:16, :] = 10 * i + 1
+        np.save(os.getcwd()+"/tests/data_generator/testimages_cache/train/image/" + img_file, image)
+        np.save(os.getcwd()+"/tests/data_generator/testimages_cache/train/groundtruth/" + img_file, image.astype("float32"))
+    data_path = os.getcwd()+"/tests/data_generator/testimages_cache/train/"
+    folders = [(0, "/groundtruth/", (32, 32), 0), (1, "/image/", (16, 16), 1)]
+    cache = DatasetCache(data_path, folders, image_files, load_resized_image)
+    assert os.path.isfile(os.getcwd()+"/tests/data_generator/testimages_cache/cache/train.h5")
+
+    # The images are stored resized and in the dtype of the original files
+    images = cache.read("/image/", ["image3.npy", "image1.npy"])
+    assert images.dtype == np.uint8
+    assert np.shape(images) == (2, 16, 16)
+    assert images[0, 0, 0] == 31 and images[1, 0, 0] == 11
+    groundtruth = cache.read("/groundtruth/", ["image4.npy"])
+    assert groundtruth.dtype == np.float32
+    assert (groundtruth[0] == np.load(data_path + "/groundtruth/image4.npy")).all()
+
+    # Modifying a file rebuilds the cache of its folder
+    cache.close()
+    image[:16, :] = 200
+    np.save(os.getcwd()+"/tests/data_generator/testimages_cache/train/image/image1.npy", image)
+    cache = DatasetCache(data_path, folders, image_files, load_resized_image)
+    assert cache.read("/image/", ["image1.npy"])[0, 0, 0] == 200
+    cache.close()
+
+    # Resizing a constant image gives NaN values, which are stored as zeros instead of undefined integers
+    np.save(os.getcwd()+"/tests/data_generator/testimages_cache/train/image/image2.npy", 7 * np.ones((32, 32), dtype="uint8"))
+    cache = DatasetCache(data_path, folders, image_files, load_resized_image)
+    assert (cache.read("/image/", ["image2.npy"]) == 0).all()
+    cache.close()
+    assert (to_native_dtype(np.array([np.nan, 3.6, 300.]), "uint8") == [0, 4, 255]).all()
+
+    if os.path.exists(os.getcwd()+"/tests/data_generator/testimages_cache") and os.path.isdir(os.getcwd()+"/tests/data_generator/testimages_cache"):
+        shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_cache")
@@ -0,0 +1,92 @@
+"""
+InstantDL
+Tests for the cached dataset statistics
+"""
+
+from instantdl.data_generator.dataset_statistics import *
+from skimage.io import imsave
+import numpy as np
+import os
+import shutil
+
+def test_get_dataset_min_max():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_statistics/train/image/", exist_ok=True)
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_statistics/train/groundtruth/", exist_ok=True)
+    imsave(os.getcwd()+"/tests/data_generator/testimages_statistics/train/image/image.tif", np.zeros((32, 32), dtype="uint8"))
+    imsave(os.getcwd()+"/tests/data_generator/testimages_statistics/train/image/image1.tif", 200*np.ones((32, 32), dtype="uint8"))
+    imsave(os.getcwd()+"/tests/data_generator/testimages_statistics/train/groundtruth/image.tif", 10*np.ones((32, 32), dtype="uint8"))
+    imsave(os.getcwd()+"/tests/data_generator/testimages_statistics/train/groundtruth/image1.tif", 20*np.ones((32, 32), dtype="uint8"))
+    data_path = os.getcwd()+"/tests/data_generator/testimages_statistics/train/"
+    Folder_Names = ["/groundtruth/", "/image/", "/image1/"]
+    X_min, X_max = get_dataset_min_max(data_path, Folder_Names, ["image.tif", "image1.tif"])
+    assert (X_min == [10., 0., 0.]).all()
+    assert (X_max == [20., 200., 0.]).all()
+    statistics_file = os.getcwd()+"/tests/data_generator/testimages_statistics/logs/" + STATISTICS_FILE
+    assert os.path.isfile(statistics_file)
+    assert len(load_statistics(statistics_file)) == 2
+
+    # The cached statistics are used as long as the files do not change
+    statistics = load_statistics(statistics_file)
+    for fingerprint in statistics:
+        statistics[fingerprint]["max"] = 100.
+    save_statistics(statistics_file, statistics)
+    X_min, X_max = get_dataset_min_max(data_path, Folder_Names, ["image.tif", "image1.tif"])
+    assert (X_max == [100., 100., 0.]).all()
+
+    # Modifying a file invalidates the cached statistics of its folder
+    imsave(os.getcwd()+"/tests/data_generator/testimages_statistics/train/image/image1.tif", 255*np.ones((40, 40), dtype="uint8"))
+    X_min, X_max = get_dataset_min_max(data_path, Folder_Names, ["image.tif", "image1.tif"])
+    assert (X_max == [100., 255., 0.]).all()
+
+    if os.path.exists(os.getcwd()+"/tests/data_generator/testimages_statistics") and os.path.isdir(os.getcwd()+"/tests/data_generator/testimages_statistics"):
+        shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_statistics")
+
+def test_StreamingHistogram():
+    histogram = StreamingHistogram(bins = 1024)
+    values = np.random.RandomState(0).normal(0, 10, 100000)
+    for batch in np.split(values, 10):
+        histogram.update(batch)
+    histogram.update([500.])
+    assert histogram.count() == 100001
+    assert histogram.min_value == np.min(values)
+    assert histogram.max_value == 500.
+    assert abs(histogram.percentile(50) - np.percentile(values, 50)) <= histogram.width
+    assert abs(histogram.percentile(1) - np.percentile(values, 1)) <= histogram.width
+
+def test_estimate_min_max():
+    os.makedirs(os.getcwd()+"/tests/data_generator/testimages_statistics/", exist_ok=True)
+    file_paths = []
+    for i in range(0, 20):
+        file_paths.append(os.getcwd()+"/tests/data_generator/testimages_statistics/image" + str(i) + ".npy")
+        np.save(file_paths[-1], np.linspace(0, 100, 4096).reshape(64, 64))
+    min_value, max_value, error_bound = estimate_min_max(file_paths, sample_files = 5, sample_pixels = 500)
+    assert 0. <= min_value < 5.
+    assert 95. < max_value <= 100.
+    assert 0. < error_bound < 0.01
+    min_value, max_value, error_bound = estimate_min_max(file_paths, sample_files = 5, sample_pixels = 500, percentiles = [10, 90])
+    assert abs(min_value - 10.) < 3.
+    assert abs(max_value - 90.) < 3.
+    if os.path.exists(os.getcwd()+"/tests/data_generator/testimages_statistics") and os.path.isdir(os.getcwd()+"/tests/data_generator/testimages_statistics"):
+        shutil.rmtree(os.getcwd()+"/tests/data_generator/testimages_statistics")
+
+def test_folder_fingerprint():
+    folder_path = os.getcwd()+"/tests/data_generator/testimages_statistics/"
+    os.makedirs(folder_path, exist_ok=True)
+    image_files = []
+    for i in range(0, 4):
+        image_files.append("image" + str(i) + ".npy")
+        np.save(folder_path + image_files[-1], np.zeros((8, 8)))
+    fingerprint = folder_fingerprint(folder_path, image_files)
+    sampled_fingerprint = folder_fingerprint(folder_path, image_files, stat_files = ["image0.npy"])
+    assert sampled_fingerprint != fingerprint
+    # Only the sampled files are checked for modifications, but every file name is part of the fingerprint
+    np.save(folder_path + "image1.npy", np.ones((16, 16)))
+    assert folder_fingerprint(folder_path, image_files) != fingerprint
+    assert folder_fingerprint(folder_path, image_files, stat_files = ["image0.npy"]) == sampled_fingerprint
+    np.save(folder_path + "image0.npy", np.ones((16, 16)))
+    assert folder_fingerprint(folder_path, image_files, stat_files = ["image0.npy"]) != sampled_fingerprint
+    assert folder_fingerprint(folder_path, image_files[:3], stat_files = ["image0.npy"]) != sampled_fingerprint
+    assert len(sample_file_indices(20, 5)) == 5
+    assert (sample_file_indices(20, 5) == sample_file_indices(20, 5)).all()
+    if os.path.exists(folder_path) and os.path.isdir(folder_path):
+        shutil.rmtree(folder_path)
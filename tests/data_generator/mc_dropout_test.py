@@ -0,0 +1,155 @@
+"""
+InstantDL
+Tests for the Monte Carlo dropout uncertainty estimation
+"""
+
+from instantdl.data_generator.mc_dropout import *
+from keras.layers import Input, Conv2D, Dropout, concatenate
+from keras.models import Model
+import numpy as np
+
+class DropoutModel(object):
+    '''
+    Test model which returns its input multiplied with a random dropout mask and counts its forward passes
+    '''
+    def __init__(self):
+        self.random = np.random.RandomState(0)
+        self.passes = 0
+
+    def predict_on_batch(self, X):
+        self.passes += 1
+        return X * (self.random.rand(*np.shape(X)) > 0.5)
+
+class TrunkModel(object):
+    '''
+    Test model which doubles its input and counts its forward passes
+    '''
+    def __init__(self):
+        self.passes = 0
+
+    def predict_on_batch(self, X):
+        self.passes += 1
+        return 2 * X
+
+class BatchSequence(object):
+    '''
+    Test sequence which counts how often each batch is read
+    '''
+    def __init__(self, X, batchsize):
+        self.X = X
+        self.batchsize = batchsize
+        self.reads = 0
+
+    def __len__(self):
+        return int(np.ceil(len(self.X) / float(self.batchsize)))
+
+    def __getitem__(self, batch_index):
+        self.reads += 1
+        return self.X[batch_index * self.batchsize:(batch_index + 1) * self.batchsize]
+
+    def batch_files(self, batch_index):
+        return ["image" + str(i) for i in range(len(self.X))][batch_index * self.batchsize:(batch_index + 1) * self.batchsize]
+
+def test_MCStatistics():
+    samples = np.random.RandomState(1).rand(7, 3, 4, 4, 1).astype(np.float32)
+    statistics = MCStatistics()
+    for sample in samples:
+        statistics.update(sample)
+    assert (statistics.count == 7).all()
+    assert np.allclose(statistics.mean, np.mean(samples, axis = 0), atol = 1e-6)
+    assert np.allclose(statistics.epistemic, np.mean(samples**2, axis = 0) - np.mean(samples, axis = 0)**2, atol = 1e-6)
+    assert np.allclose(statistics.aleatoric, np.mean(samples * (1 - samples), axis = 0), atol = 1e-6)
+    # Images which are not active keep their statistics
+    statistics.update(samples[0, 1:], np.array([1, 2]))
+    assert list(statistics.count) == [7, 8, 8]
+    assert np.allclose(statistics.epistemic[0], np.var(samples[:, 0], axis = 0), atol = 1e-6)
+    assert np.allclose(statistics.epistemic[1], np.var(np.concatenate([samples[:, 1], samples[:1, 1]]), axis = 0), atol = 1e-6)
+
+def test_ClassificationStatistics():
+    samples = np.random.RandomState(1).dirichlet(np.ones(3), size = (7, 4)).astype(np.float32)
+    statistics = ClassificationStatistics()
+    for sample in samples:
+        statistics.update(sample)
+    assert np.allclose(statistics.mean, np.mean(samples, axis = 0), atol = 1e-6)
+    assert (statistics.votes.sum(axis = -1) == 7).all()
+    assert list(statistics.prediction) == [np.argmax(np.bincount(votes, minlength = 3)) for votes in np.argmax(samples, axis = -1).T]
+    assert np.allclose(statistics.entropy, np.mean(-1 * np.sum(samples * np.log(samples + 10e-6), axis = -1), axis = 0), atol = 1e-5)
+
+def test_mc_dropout_classification():
+    X = np.tile(np.array([0.2, 0.5, 0.3], dtype = np.float32), (5, 1))
+    sequence = BatchSequence(X, 2)
+    model = DropoutModel()
+    results = np.tile(np.array([1., 0., 0.], dtype = np.float32), (5, 1))
+    prediction, entropy = mc_dropout_classification(model, sequence, 4, results = results)
+    # Every batch is read once and the test predictions are the first sample
+    assert sequence.reads == 3
+    assert model.passes == 9
+    assert np.shape(prediction) == (5,) and np.shape(entropy) == (5,)
+    assert (entropy >= 0).all()
+
+def test_mc_dropout_uncertainty():
+    X = 0.5 * np.ones((5, 8, 8, 1), dtype = np.float32)
+    sequence = BatchSequence(X, 2)
+    model = DropoutModel()
+    batches = []
+    sample_counts = mc_dropout_uncertainty(model, sequence, lambda files, epistemic, aleatoric: batches.append((files, epistemic, aleatoric)), 6)
+    assert sample_counts == [6, 6, 6, 6, 6]
+    assert sequence.reads == 3 and model.passes == 18
+    assert [files for files, _, _ in batches] == [["image0", "image1"], ["image2", "image3"], ["image4"]]
+    # The samples are 0 or 0.5, so the variance is at most 0.0625
+    epistemic = np.concatenate([batch[1] for batch in batches])
+    assert np.shape(epistemic) == (5, 8, 8, 1)
+    assert np.max(epistemic) <= 0.0625 + 1e-6 and np.max(epistemic) > 0
+
+def test_mc_dropout_uncertainty_results():
+    X = 0.5 * np.ones((5, 8, 8, 1), dtype = np.float32)
+    sequence = BatchSequence(X, 2)
+    model = DropoutModel()
+    results = []
+    sample_counts = mc_dropout_uncertainty(model, sequence, lambda files, epistemic, aleatoric: None, 4,
+                                            result_sink = lambda files, predictions: results.append((files, predictions)),
+                                            result_model = TrunkModel())
+    # The test set is read once, the predictions of the result_model are saved and count as the first sample
+    assert sequence.reads == 3
+    assert sample_counts == [4, 4, 4, 4, 4] and model.passes == 9
+    assert [files for files, _ in results] == [["image0", "image1"], ["image2", "image3"], ["image4"]]
+    assert all(np.allclose(predictions, 1.) for _, predictions in results)
+
+def test_mc_dropout_uncertainty_adaptive():
+    X = 0.5 * np.ones((4, 8, 8, 1), dtype = np.float32)
+    # The first image is constant and converges after the minimal number of samples
+    X[0] = 0.
+    sequence = BatchSequence(X, 4)
+    model = DropoutModel()
+    sample_counts = mc_dropout_uncertainty(model, sequence, lambda files, epistemic, aleatoric: None, 50,
+                                            tolerance = 0.005, min_samples = 3)
+    assert sample_counts[0] == 3
+    assert all(3 < count < 50 for count in sample_counts[1:])
+    assert model.passes == max(sample_counts)
+
+def test_LastLayerMCModel():
+    X = 0.25 * np.ones((4, 8, 8, 1), dtype = np.float32)
+    trunk = TrunkModel()
+    head = DropoutModel()
+    model = LastLayerMCModel(trunk, head)
+    sample_counts = mc_dropout_uncertainty(model, BatchSequence(X, 4), lambda files, epistemic, aleatoric: None, 10)
+    # The features of the trunk are computed once and only the head is sampled
+    assert sample_counts == [10, 10, 10, 10]
+    assert trunk.passes == 1 and head.passes == 10
+    assert set(np.unique(model.predict_on_batch(X))) <= {0., 0.5}
+
+def test_last_layer_mc_model():
+    inputs = Input(shape = (8, 8, 1))
+    conv = Conv2D(4, 3, padding = 'same')(inputs)
+    drop = Dropout(0., name = 'drop')(conv)
+    outputs = Conv2D(1, 1, activation = 'sigmoid')(concatenate([inputs, drop], axis = -1))
+    model = Model(inputs = inputs, outputs = outputs)
+    mc_model = last_layer_mc_model(model, 'drop')
+    # The trunk computes the features before the dropout and the input of the skip connection
+    assert len(mc_model.trunk.outputs) == 2
+    X = np.random.RandomState(0).rand(2, 8, 8, 1).astype(np.float32)
+    statistics = MCStatistics()
+    for i in range(3):
+        statistics.update(mc_model.predict_on_batch(X))
+    # Without dropout the head reproduces the prediction of the model
+    assert np.allclose(statistics.mean, model.predict_on_batch(X), atol = 1e-5)
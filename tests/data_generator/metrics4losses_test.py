@@ -31,4 +31,14 @@ def test_binary_focal_loss_fixed():
     y_2 = tf.zeros([5,5])
     l_1 = binary_focal_loss_fixed(x,y_1)
     l_2 = binary_focal_loss_fixed(x,y_2)
-    assert (l_1.eval(session=K.get_session()) != l_2.eval(session=K.get_session())).all()
\ No newline at end of file
+    assert (l_1.eval(session=K.get_session()) != l_2.eval(session=K.get_session())).all()
+
+def test_heteroscedastic_loss():
+    y_true = tf.ones([5,5,1])
+    y_pred = tf.concat([tf.ones([5,5,1]), tf.zeros([5,5,1])], axis=-1)
+    y_pred_uncertain = tf.concat([tf.zeros([5,5,1]), tf.ones([5,5,1])], axis=-1)
+    l_1 = heteroscedastic_loss(y_true,y_pred)
+    l_2 = heteroscedastic_loss(y_true,y_pred_uncertain)
+    assert (l_1.eval(session=K.get_session()) == 0).all()
+    assert (l_1.eval(session=K.get_session()) < l_2.eval(session=K.get_session())).all()
+    assert (heteroscedastic_mse(y_true,y_pred).eval(session=K.get_session()) == 0).all()
@@ -0,0 +1,88 @@
+"""
+InstantDL
+Tests for the sliding window inference
+"""
+
+from instantdl.segmentation.tiled_inference import *
+from skimage.io import imsave, imread
+import numpy as np
+import os
+import pytest
+import shutil
+
+class TileModel(object):
+    '''
+    Fully convolutional test model which returns its input and records the tile batches
+    '''
+    def __init__(self):
+        self.batch_shapes = []
+
+    def predict(self, tiles):
+        self.batch_shapes.append(np.shape(tiles))
+        return tiles
+
+    def predict_on_batch(self, tiles):
+        return self.predict(tiles)
+
+class DropoutTileModel(object):
+    '''
+    Test model which returns its input multiplied with a random dropout mask
+    '''
+    def __init__(self):
+        self.random = np.random.RandomState(0)
+
+    def predict_on_batch(self, tiles):
+        return tiles * (self.random.rand(*np.shape(tiles)) > 0.5)
+
+def test_tile_positions():
+    corners = tile_positions((100, 64), (32, 32), 0.25)
+    assert (0, 0) in corners and (68, 32) in corners
+    assert all(corner[0] + 32 <= 100 and corner[1] + 32 <= 64 for corner in corners)
+    assert tile_positions((32, 32), (32, 32), 0.5) == [(0, 0)]
+
+def test_predict_tiled():
+    image = np.random.RandomState(0).rand(100, 70, 2).astype(np.float32)
+    model = TileModel()
+    prediction = predict_tiled(model, image, (32, 32), overlap = 0.5, tile_batchsize = 3)
+    # The blended tiles of the identity model reproduce the image in its original size
+    assert np.shape(prediction) == (100, 70, 2)
+    assert np.allclose(prediction, image, atol = 1e-5)
+    assert all(shape[0] <= 3 and shape[1:] == (32, 32, 2) for shape in model.batch_shapes)
+    # Images smaller than one tile are padded
+    assert np.allclose(predict_tiled(TileModel(), image[:20, :20], (32, 32)), image[:20, :20], atol = 1e-5)
+
+def test_predict_tiled_uncertainty():
+    image = np.random.RandomState(0).rand(100, 70, 1).astype(np.float32)
+    prediction, epistemic, aleatoric = predict_tiled_uncertainty(TileModel(), TileModel(), image, (32, 32),
+                                                                    overlap = 0.5, tile_batchsize = 3, num_samples = 4)
+    # The samples of a deterministic model have no epistemic uncertainty
+    assert np.allclose(prediction, image, atol = 1e-5)
+    assert np.allclose(epistemic, 0., atol = 1e-6)
+    assert np.allclose(aleatoric, image * (1 - image), atol = 1e-5)
+    prediction, epistemic, aleatoric = predict_tiled_uncertainty(TileModel(), DropoutTileModel(), image, (32, 32), num_samples = 4)
+    assert np.shape(epistemic) == (100, 70, 1) and np.shape(aleatoric) == (100, 70, 1)
+    assert np.max(epistemic) > 0
+
+def test_tiled_prediction():
+    os.makedirs(os.getcwd() + "/tests/segmentation/testimages_tiled/test/image/", exist_ok=True)
+    image = np.zeros((96, 80), dtype = "uint8")
+    image[:48, :] = 255
+    imsave(os.getcwd() + "/tests/segmentation/testimages_tiled/test/image/image.tif", image)
+    assert tiled_prediction(TileModel(), os.getcwd() + "/tests/segmentation/testimages_tiled/", ["image.tif"], 1, [32, 32]) == 1
+    saved = imread(os.getcwd() + "/tests/segmentation/testimages_tiled/results/image.tif_predict.tif")
+    assert np.shape(saved) == (96, 80)
+    assert saved[0, 0] == 255 and saved[-1, -1] == 0
+    # The prediction of each image is handed to the sink
+    results = []
+    tiled_prediction(TileModel(), os.getcwd() + "/tests/segmentation/testimages_tiled/", ["image.tif"], 1, [32, 32],
+                        sink = lambda files, predictions: results.append((files, predictions)))
+    assert results[0][0] == ["image.tif"] and np.shape(results[0][1]) == (1, 96, 80, 1)
+    # The uncertainty is predicted in the same tiles and handed to the uncertainty_sink
+    uncertainty = []
+    tiled_prediction(TileModel(), os.getcwd() + "/tests/segmentation/testimages_tiled/", ["image.tif"], 1, [32, 32],
+                        sink = lambda files, predictions: None, mc_model = DropoutTileModel(), mc_samples = 3,
+                        uncertainty_sink = lambda files, epistemic, aleatoric: uncertainty.append((files, epistemic, aleatoric)))
+    assert uncertainty[0][0] == ["image.tif"] and np.shape(uncertainty[0][1]) == (1, 96, 80, 1)
+    with pytest.raises(ValueError):
+        tiled_prediction(TileModel(), os.getcwd() + "/tests/segmentation/testimages_tiled/", ["image.tif"], 1, [30, 30])
+    shutil.rmtree(os.getcwd() + "/tests/segmentation/testimages_tiled/")